@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Benchmark generation and deployment, and catch regressions.
+
+Each benchmark runs in this interpreter, against a fixture site
+generated in a temporary directory. After a few untimed warmup runs,
+it is timed over a number of trials, and the median time is reported
+along with its spread (the median absolute deviation from the median).
+
+Medians are compared against a baseline stored in baseline.json, next
+to this file. If any benchmark got slower than its baseline by more
+than the threshold, and by more than twice the spread of both runs,
+the run exits with status 1. Baselines depend on
+the machine, so record one with --save-baseline before comparing
+changes on a new machine.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import json
+import optparse
+import os
+import os.path
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baseline.json')
+
+sys.path.insert(0, _REPO_ROOT)
+
+from pyweb import cssyaml
+from pyweb import deploy
+from pyweb import deps
+from pyweb import generator
+from pyweb import processors
+from pyweb import util
+
+
+_BASE_TEMPLATE = '''<html>
+<head><title>{%% block title %%}{%% endblock %%}</title></head>
+<body>
+<ul id="menu">
+{%% for i in range(%(links)d) %%}  <li><a href="page{{ i }}.html">Page {{ i }}</a></li>
+{%% endfor %%}</ul>
+{%% block contents %%}{%% endblock %%}
+<p>Generated on {{ timestamp }}.</p>
+</body>
+</html>
+'''
+
+_PAGE_TEMPLATE = '''{%% extends "_base.html" %%}
+{%% block title %%}Page %(n)d{%% endblock %%}
+{%% block contents %%}
+{%% for i in range(%(paragraphs)d) %%}
+<p class="p{{ i }}">Paragraph {{ i }} of page %(n)d. {{ "lorem ipsum" | upper }}</p>
+{%% endfor %%}
+{%% endblock %%}
+'''
+
+_CSS_VARS = '''VARS:
+  fg: hex(333)
+  font:
+    body: Tahoma, sans-serif
+'''
+
+_CSS_BLOCK = '''id(block%(n)d):
+  color: $fg
+  font-family: $font.body
+  margin: %(n)dpx
+  a:
+    color: hex(00%(n)04d)
+    text-decoration: none
+  .item%(n)d:
+    padding: 0 %(n)dpx
+'''
+
+
+def _WriteFile(path, content):
+    f = open(path, 'w')
+    try:
+        f.write(content)
+    finally:
+        f.close()
+
+
+def _CssYaml(blocks):
+    return _CSS_VARS + '\n'.join(_CSS_BLOCK % {'n': n} for n in xrange(blocks))
+
+
+def _BuildFixture(root, scale):
+    """Build a fixture site, its size proportional to scale."""
+    source = os.path.join(root, 'source')
+    for subdir in ('css', 'images'):
+        os.makedirs(os.path.join(source, subdir))
+
+    _WriteFile(os.path.join(source, '_base.html'),
+               _BASE_TEMPLATE % {'links': 5 * scale})
+    for n in xrange(20 * scale):
+        _WriteFile(os.path.join(source, 'page%d.html' % n),
+                   _PAGE_TEMPLATE % {'n': n, 'paragraphs': 20})
+    for n in xrange(2 * scale):
+        _WriteFile(os.path.join(source, 'css', 'style%d.css' % n),
+                   _CssYaml(10))
+    for n in xrange(10 * scale):
+        _WriteFile(os.path.join(source, 'images', 'image%d.png' % n),
+                   os.urandom(4096))
+
+    # A site generated once, for the deploy benchmarks.
+    site = os.path.join(root, 'site')
+    manifest = os.path.join(root, 'site.MANIFEST')
+    generator.Generator(source, processors.DEFAULT_PROCESSORS).Generate(
+        site, manifest_path=manifest)
+
+    return {
+        'root': root,
+        'source': source,
+        'site': site,
+        'manifest': manifest,
+        'css': _CssYaml(50 * scale),
+        }
+
+
+def _Remove(path):
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+
+
+def _Generate(fx):
+    out = os.path.join(fx['root'], 'out')
+    _Remove(out)
+    def Run():
+        generator.Generator(fx['source'],
+                            processors.DEFAULT_PROCESSORS).Generate(out)
+    return Run
+
+
+def _GenerateCss(fx):
+    def Run():
+        cssyaml.GenerateCss(StringIO.StringIO(fx['css']),
+                            'Thu Jan  1 00:00:00 1970')
+    return Run
+
+
+def _RenderHtml(fx):
+    processor = processors.HtmlJinjaProcessor()
+    pages = [os.path.join(fx['source'], name)
+             for name in sorted(os.listdir(fx['source']))
+             if name.startswith('page')]
+    ctx = {
+        'timestamp': 'Thu Jan  1 00:00:00 1970',
+        'input_root': fx['source'],
+        'output_root': os.path.join(fx['root'], 'out'),
+        'data': {},
+        'dependencies': deps.DependencyGraph(),
+        'output': util.OutputWriter(),
+        'template_archive': None,
+        }
+    def Run():
+        processor.StartProcessing(ctx)
+        try:
+            for page in pages:
+                ''.join(processor.ProcessStream(None, page))
+        finally:
+            processor.EndProcessing()
+    return Run
+
+
+def _Deploy(fx):
+    out = os.path.join(fx['root'], 'deploy')
+    _Remove(out)
+    os.mkdir(out)
+    def Run():
+        deploy.Deploy(fx['site'], out, fx['manifest'])
+    return Run
+
+
+def _LinkDeploy(fx):
+    out = os.path.join(fx['root'], 'links')
+    _Remove(out)
+    os.mkdir(out)
+    def Run():
+        deploy.LinkDeploy(fx['site'], out, fx['manifest'])
+    return Run
+
+
+# (name, setup) for every benchmark. The setup is run before each
+# trial, and returns the function to time.
+_BENCHMARKS = [
+    ('generator.Generate', _Generate),
+    ('cssyaml.GenerateCss', _GenerateCss),
+    ('HtmlJinjaProcessor', _RenderHtml),
+    ('deploy.Deploy', _Deploy),
+    ('deploy.LinkDeploy', _LinkDeploy),
+    ]
+
+
+def _Median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _RunBenchmark(setup, fixture, trials, warmup):
+    """Return the median time and spread of a benchmark, in seconds."""
+    times = []
+    for i in xrange(warmup + trials):
+        run = setup(fixture)
+        start = time.time()
+        run()
+        if i >= warmup:
+            times.append(time.time() - start)
+    median = _Median(times)
+    return median, _Median([abs(t - median) for t in times])
+
+
+def _ReadBaseline(path):
+    try:
+        return json.loads(util.ReadFileContent(path))
+    except util.FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [-n <trials>] [-w <warmup>] [-s <scale>] '
+        '[-t <percent>] [-b <baseline>] [--save-baseline] [benchmark...]')
+    parser.add_option('-n', '--trials', action='store', type='int',
+                      dest='trials', default=10)
+    parser.add_option('-w', '--warmup', action='store', type='int',
+                      dest='warmup', default=2)
+    parser.add_option('-s', '--scale', action='store', type='int',
+                      dest='scale', default=5)
+    parser.add_option('-t', '--threshold', action='store', type='float',
+                      dest='threshold', default=10.0)
+    parser.add_option('-b', '--baseline', action='store', type='string',
+                      dest='baseline', default=_BASELINE)
+    parser.add_option('--save-baseline', action='store_true',
+                      dest='save_baseline')
+    (options, args) = parser.parse_args()
+
+    baseline = _ReadBaseline(options.baseline)
+    results = {}
+    regressions = []
+
+    root = tempfile.mkdtemp(prefix='pywebgen-bench-')
+    try:
+        fixture = _BuildFixture(root, options.scale)
+        print '%-22s %12s %12s %12s %8s' % ('benchmark', 'median (ms)',
+                                             'spread (ms)', 'base (ms)',
+                                             'change')
+        for name, setup in _BENCHMARKS:
+            if args and not [a for a in args if a in name]:
+                continue
+            median, spread = _RunBenchmark(setup, fixture, options.trials,
+                                           options.warmup)
+            results[name] = {'median': median, 'spread': spread,
+                             'scale': options.scale}
+
+            base = baseline.get(name)
+            if base is None or base.get('scale') != options.scale:
+                print '%-22s %12.2f %12.2f %12s %8s' % (
+                    name, median * 1000, spread * 1000, '-', '-')
+                continue
+            change = (median - base['median']) / base['median'] * 100
+            flag = ''
+            # Differences within the noise of either run don't count.
+            noise = 2 * (spread + base['spread'])
+            if (change > options.threshold and
+                median - base['median'] > noise):
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print '%-22s %12.2f %12.2f %12.2f %+7.1f%%%s' % (
+                name, median * 1000, spread * 1000, base['median'] * 1000,
+                change, flag)
+    finally:
+        shutil.rmtree(root)
+
+    if options.save_baseline:
+        baseline.update(results)
+        util.WriteFileContent(options.baseline,
+                              json.dumps(baseline, indent=2,
+                                         sort_keys=True) + '\n')
+        print 'Saved baseline to %s.' % options.baseline
+        return 0
+
+    if regressions:
+        print '%d benchmark(s) regressed by more than %.1f%%: %s' % (
+            len(regressions), options.threshold, ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
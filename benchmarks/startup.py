@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Measure the startup time of every pywebgen and pwg subcommand.
+
+Each subcommand is run repeatedly in a fresh interpreter, against a
+small fixture site built in a temporary directory, and the minimum
+and median wall clock times are reported.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_PYWEBGEN = os.path.join(_REPO_ROOT, 'pywebgen')
+
+
+class CommandFailed(Exception):
+    """A benchmarked command didn't exit with its expected status."""
+
+
+def _Run(args, cwd=None, status=0):
+    """Run a command, and return the time it took.
+
+    Raises:
+      CommandFailed: the command exited with another status than the
+                     given one. Timing a crash would be meaningless.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = _REPO_ROOT
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        proc = subprocess.Popen([sys.executable] + args, cwd=cwd, env=env,
+                                stdout=devnull, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate()
+        elapsed = time.time() - start
+    finally:
+        devnull.close()
+    if proc.returncode != status:
+        raise CommandFailed('%s exited with status %d:\n%s' % (
+            ' '.join(args), proc.returncode, stderr))
+    return elapsed
+
+
+def _BuildFixture(root):
+    source = os.path.join(root, 'source')
+    os.makedirs(source)
+    f = open(os.path.join(source, 'index.html'), 'w')
+    f.write('<p>Generated on {{ timestamp }}.</p>\n')
+    f.close()
+
+    versions = os.path.join(root, 'versions')
+    deploy = os.path.join(root, 'deploy')
+    os.makedirs(deploy)
+    _Run([_PYWEBGEN, 'vgenerate', source, versions])
+
+    # The versions get switched and garbage collected, so deployment
+    # uses a tree of its own.
+    generated = os.path.join(root, 'generated')
+    manifest = generated + '.MANIFEST'
+    _Run([_PYWEBGEN, 'generate', '-m', manifest, source, generated])
+
+    container = os.path.join(root, 'site')
+    _Run([_PYWEBGEN, 'startsite', '-E', container])
+
+    return {
+        'source': source,
+        'out': os.path.join(root, 'out'),
+        'versions': versions,
+        'generated': generated,
+        'manifest': manifest,
+        'deploy': deploy,
+        'container': container,
+        'pwg': os.path.join(container, 'pwg'),
+        'newsite': os.path.join(root, 'newsite'),
+        }
+
+
+def _Commands(fx):
+    """Return the benchmarked commands.
+
+    Each is (name, argv, cwd, setup, cleanup, exit status). setup and
+    cleanup, if given, are run before and after each timed run.
+    """
+    def RemoveNewSite():
+        shutil.rmtree(fx['newsite'])
+
+    deploy_argv = [fx['generated'], fx['deploy'], fx['manifest']]
+    def Deploy():
+        _Run([_PYWEBGEN, 'deploy'] + deploy_argv)
+    def Undeploy():
+        _Run([_PYWEBGEN, 'undeploy'] + deploy_argv)
+
+    return [
+        ('pywebgen (no command)', [_PYWEBGEN], None, None, None, 2),
+        ('pywebgen startsite', [_PYWEBGEN, 'startsite', fx['newsite']],
+         None, None, RemoveNewSite, 0),
+        ('pywebgen generate',
+         [_PYWEBGEN, 'generate', fx['source'], fx['out']], None, None, None,
+         0),
+        ('pywebgen watch (usage)', [_PYWEBGEN, 'watch'], None, None, None, 2),
+        ('pywebgen vgenerate',
+         [_PYWEBGEN, 'vgenerate', fx['source'], fx['versions']], None, None,
+         None, 0),
+        ('pywebgen vcurrent',
+         [_PYWEBGEN, 'vcurrent', fx['versions'], '0'], None, None, None, 0),
+        ('pywebgen vinfo', [_PYWEBGEN, 'vinfo', fx['versions']], None, None,
+         None, 0),
+        ('pywebgen vgc', [_PYWEBGEN, 'vgc', fx['versions']], None, None,
+         None, 0),
+        ('pywebgen deploy', [_PYWEBGEN, 'deploy'] + deploy_argv, None, None,
+         Undeploy, 0),
+        ('pywebgen undeploy', [_PYWEBGEN, 'undeploy'] + deploy_argv, None,
+         Deploy, None, 0),
+        ('pwg versions', [fx['pwg'], 'versions'], fx['container'], None,
+         None, 0),
+        ('pwg setcurrent', [fx['pwg'], 'setcurrent', 'latest'],
+         fx['container'], None, None, 0),
+        ('pwg gc', [fx['pwg'], 'gc'], fx['container'], None, None, 0),
+        ('pwg generate', [fx['pwg'], 'generate'], fx['container'], None,
+         None, 0),
+        ('pwg compile-templates', [fx['pwg'], 'compile-templates'],
+         fx['container'], None, None, 0),
+        ]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n <runs>] [command...]')
+    parser.add_option('-n', '--runs', action='store', type='int',
+                      dest='runs', default=10)
+    (options, args) = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pywebgen-startup-')
+    try:
+        try:
+            fixture = _BuildFixture(root)
+            print '%-28s %10s %10s' % ('command', 'min (ms)', 'median (ms)')
+            for (name, argv, cwd, setup, cleanup,
+                 status) in _Commands(fixture):
+                if args and not [a for a in args if a in name]:
+                    continue
+                times = []
+                for _ in xrange(options.runs):
+                    if setup:
+                        setup()
+                    times.append(_Run(argv, cwd, status))
+                    if cleanup:
+                        cleanup()
+                times.sort()
+                print '%-28s %10.1f %10.1f' % (name, times[0] * 1000,
+                                               times[len(times) // 2] * 1000)
+        except CommandFailed, e:
+            print >>sys.stderr, 'Aborting: %s' % e
+            return 1
+    finally:
+        shutil.rmtree(root)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
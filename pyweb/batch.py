@@ -0,0 +1,102 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Generation of many site containers in one go.
+
+Containers are generated by a pool of worker processes. Each worker
+generates many containers in turn, so the caches that are shared
+within a process (compiled templates, parsed site data) serve every
+container using the same theme. A container failing to generate is
+reported, and doesn't stop the rest of the batch.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import glob
+import os.path
+import time
+
+import error
+
+
+class NotAContainer(error.Error):
+    """A batch path is not a site container."""
+
+
+class Result(object):
+    """The outcome of generating one container."""
+    def __init__(self, path, elapsed, version=None, current=False,
+                 error=None):
+        self.path = path
+        self.elapsed = elapsed
+        self.version = version
+        self.current = current
+        self.error = error
+
+
+def ExpandPaths(patterns):
+    """Expand container paths and glob patterns.
+
+    Patterns matching nothing are kept as is, so that they are
+    reported as failures, like matches that aren't containers.
+    Duplicates are dropped.
+    """
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for path in matches:
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                paths.append(path)
+    return paths
+
+
+def _GenerateContainer(path):
+    import container
+
+    start = time.time()
+    try:
+        # Containers create their missing subdirectories, which must
+        # not happen for paths that are not containers at all.
+        if not container.IsContainer(path):
+            raise NotAContainer(path)
+        ts, current = container.Container(path).Generate()
+    except Exception, e:
+        return Result(path, time.time() - start,
+                      error='%s: %s' % (type(e).__name__, e))
+    return Result(path, time.time() - start, ts, current)
+
+
+def BatchGenerate(paths, jobs=None):
+    """Generate a new version of each of the given containers.
+
+    Args:
+      paths: the container paths.
+      jobs: the number of worker processes, defaults to the number of
+            CPUs. With a single job, containers are generated in the
+            calling process.
+
+    Yields:
+      A Result for each container, in completion order.
+    """
+    if jobs == 1 or len(paths) <= 1:
+        for path in paths:
+            yield _GenerateContainer(path)
+        return
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(_GenerateContainer, paths):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
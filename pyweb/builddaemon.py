@@ -0,0 +1,226 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Long-lived build server for a website container.
+
+Every pwg invocation pays for starting Python, importing the
+generator and building cold caches. The build daemon keeps a single
+Container, and the generators and caches behind it, alive, and serves
+requests over a Unix socket in the container.
+
+The protocol is one JSON object per line: the client sends
+{"command": ..., "args": [...]}, and the daemon answers with
+{"ok": true, "result": ...} or {"ok": false, "error": ...}.
+
+Generation requests that arrive while a generation is running are
+merged: they all wait for, and share the result of, the next
+generation.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import errno
+import os
+import socket
+import SocketServer
+import threading
+
+import error
+import metrics
+
+try:
+    import json
+except ImportError:
+    raise error.MissingPythonModule('json')
+
+
+class DaemonUnavailable(error.Error):
+    """No build daemon is listening on the socket."""
+
+
+class DaemonError(error.Error):
+    """The build daemon failed to execute a request."""
+
+
+class DaemonRunning(error.Error):
+    """A build daemon is already serving this container."""
+
+
+class _Ticket(object):
+    """The eventual result of a generation, shared by merged requests."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+
+    def Set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._event.set()
+
+    def Wait(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _BuildQueue(object):
+    """Runs generations one at a time, merging queued requests."""
+    def __init__(self, build_func, lock):
+        self._build_func = build_func
+        self._lock = lock
+        self._cond = threading.Condition()
+        self._next = None
+
+        thread = threading.Thread(target=self._Run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def Build(self):
+        self._cond.acquire()
+        try:
+            if self._next is None:
+                self._next = _Ticket()
+                self._cond.notify()
+            ticket = self._next
+        finally:
+            self._cond.release()
+        return ticket.Wait()
+
+    def _Run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while self._next is None:
+                    self._cond.wait()
+                ticket = self._next
+                self._next = None
+            finally:
+                self._cond.release()
+
+            self._lock.acquire()
+            try:
+                ticket.Set(result=self._build_func())
+            except Exception, e:
+                ticket.Set(error=e)
+            finally:
+                self._lock.release()
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                result = self.server.Dispatch(request['command'],
+                                              request.get('args', []))
+                response = {'ok': True, 'result': result}
+            except Exception, e:
+                response = {'ok': False,
+                            'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class BuildServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, container, socket_path):
+        _CheckStaleSocket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _RequestHandler)
+        self._socket_path = socket_path
+        self._container = container
+        # Serializes everything that touches the versions directory.
+        self._lock = threading.Lock()
+        self._builds = _BuildQueue(container.Generate, self._lock)
+
+    def Dispatch(self, command, args):
+        try:
+            return self._Dispatch(command, args)
+        finally:
+            if command in ('generate', 'setcurrent', 'gc'):
+                # Builds done by the daemon are exported like those of
+                # standalone commands.
+                metrics.Export()
+
+    def _Dispatch(self, command, args):
+        if command == 'generate':
+            return self._builds.Build()
+        elif command == 'versions':
+            return self._container.Versions()
+        elif command in ('setcurrent', 'gc'):
+            self._lock.acquire()
+            try:
+                if command == 'setcurrent':
+                    return self._container.SetCurrent(int(args[0]))
+                return self._container.Gc()
+            finally:
+                self._lock.release()
+        elif command == 'ping':
+            return 'pong'
+        raise DaemonError('Unknown command %s' % command)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+
+def _CheckStaleSocket(socket_path):
+    """Remove a leftover socket, unless a daemon is still serving it."""
+    if not os.path.exists(socket_path):
+        return
+    try:
+        Call(socket_path, 'ping')
+    except DaemonUnavailable:
+        os.remove(socket_path)
+    else:
+        raise DaemonRunning(socket_path)
+
+
+def Serve(container, socket_path):
+    """Serve build requests for container until interrupted."""
+    server = BuildServer(container, socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def Call(socket_path, command, *args):
+    """Execute a command through the build daemon.
+
+    Raises:
+      DaemonUnavailable: no daemon is serving socket_path.
+      DaemonError: the daemon failed to execute the command.
+    """
+    if not os.path.exists(socket_path):
+        raise DaemonUnavailable(socket_path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error, e:
+            if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                raise DaemonUnavailable(socket_path)
+            raise
+
+        f = sock.makefile('rw')
+        f.write(json.dumps({'command': command, 'args': args}) + '\n')
+        f.flush()
+        line = f.readline()
+        f.close()
+    finally:
+        sock.close()
+
+    if not line:
+        raise DaemonError('Connection closed by the build daemon')
+    response = json.loads(line)
+    if not response['ok']:
+        raise DaemonError(response['error'])
+    return response['result']
@@ -0,0 +1,105 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Bundles: many scripts or stylesheets served as one file.
+
+A bundle spec is a YAML file with a .bundles extension, placed in the
+input tree where the bundles should go. It maps bundle names to the
+list of files they are made of, relative to the spec file:
+
+  site.js:
+    - js/prettify.js
+    - js/menu.js
+  site.css:
+    - css/style.css
+    - css/prettify.css
+
+Members are included as the site's processors generate them, so a
+YAML CSS stylesheet is bundled as CSS. The bundle is then minified and
+written with a fingerprint of its content in its name (site.js becomes
+site.0123456789.js), so it can be cached forever by browsers.
+
+Templates get the URL of a bundle from the bundle helper, given the
+path of the bundle from the root of the site: bundle('/site.js').
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import hashlib
+import os.path
+
+import error
+import filters
+import util
+
+try:
+    import yaml
+except ImportError:
+    raise error.MissingPythonModule('yaml')
+
+
+# The number of content hash digits in bundle names.
+FINGERPRINT_LENGTH = 10
+
+_MINIFIERS = {
+    '.js': filters.MinifyJsFilter,
+    '.css': filters.MinifyCssFilter,
+    }
+_SEPARATORS = {
+    # Guard against members missing their final semicolon.
+    '.js': ';\n',
+    '.css': '\n',
+    }
+
+
+class BundleSpecError(error.Error):
+    """A bundle spec is malformed, or one of its members can't be bundled."""
+
+
+class Spec(object):
+    def __init__(self, path):
+        self.path = path
+        try:
+            spec = yaml.safe_load(util.ReadFileContent(path))
+        except yaml.YAMLError, e:
+            raise BundleSpecError('%s: %s' % (path, e))
+
+        if not isinstance(spec, dict):
+            raise BundleSpecError('%s: spec must be a mapping' % path)
+
+        self.bundles = {}
+        spec_dir = os.path.dirname(path)
+        for name, members in spec.iteritems():
+            if os.path.basename(name) != name:
+                raise BundleSpecError('%s: bundle %s must be in the spec\'s '
+                                      'directory' % (path, name))
+            if os.path.splitext(name)[1] not in _MINIFIERS:
+                raise BundleSpecError('%s: %s is neither a .js nor a .css '
+                                      'bundle' % (path, name))
+            if (not isinstance(members, list) or
+                not all(isinstance(m, basestring) for m in members)):
+                raise BundleSpecError('%s: %s must list file paths' %
+                                      (path, name))
+            self.bundles[name] = [os.path.normpath(os.path.join(spec_dir, m))
+                                  for m in members]
+
+
+def Build(name, contents):
+    """Concatenate and minify the contents of a bundle's members.
+
+    Returns:
+      The bundle content, as a UTF-8 byte string.
+    """
+    ext = os.path.splitext(name)[1]
+    chunks = _SEPARATORS[ext].join(filters.AsText(c) for c in contents)
+    return ''.join(filters.AsBytes(c) for c in
+                   _MINIFIERS[ext]().FilterChunks([chunks]))
+
+
+def FingerprintedName(name, content):
+    """Return the name of a bundle, with content's fingerprint in it."""
+    base, ext = os.path.splitext(name)
+    fingerprint = hashlib.sha1(content).hexdigest()[:FINGERPRINT_LENGTH]
+    return '%s.%s%s' % (base, fingerprint, ext)
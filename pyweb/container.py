@@ -30,6 +30,8 @@ _DEPLOY_DIR = 'deploy'
 _CURRENT_DIR = 'current'
 _LATEST_DIR = 'latest'
 _DEVEL_DIR = 'devel'
+_TEMPLATE_ARCHIVE = 'templates.zip'
+_BUILD_SOCKET = 'pwg.sock'
 
 _CONTAINER_SCRIPT_NAME = 'pwg'
 _CONTAINER_SCRIPT = '''#!/usr/bin/env python
@@ -45,6 +47,11 @@ sys.exit(main())
 '''
 
 
+def IsContainer(path):
+    """Return True if path looks like a site container."""
+    return os.path.isdir(os.path.join(path, _SOURCE_DIR))
+
+
 def _CopyModule(module, out):
     module_path = module.__file__
     if module_path.endswith('.pyc'):
@@ -76,6 +83,9 @@ class Container(object):
         self.current_dir = self._PathInRoot(_CURRENT_DIR)
         self.latest_dir = self._PathInRoot(_LATEST_DIR)
         self.devel_dir = self._PathInRoot(_DEVEL_DIR)
+        self.template_archive = self._PathInRoot(_TEMPLATE_ARCHIVE)
+        self.build_socket = self._PathInRoot(_BUILD_SOCKET)
+        self._output_cache = None
 
         if not os.path.exists(self.deploy_dir):
             self.deploy_dir = None
@@ -87,10 +97,27 @@ class Container(object):
         return os.path.join(self.root, path)
 
     def Generate(self):
+        import outputcache
+        import processors
+
+        # Keep the same cache across generations, so that the
+        # versions' generator can be reused.
+        if self._output_cache is None:
+            self._output_cache = outputcache.Open()
         ret = self._versions.Generate(self.source_dir,
-                                      ['HtmlJinja', 'CssYaml'])
+                                      processors.DEFAULT_PROCESSORS,
+                                      self.template_archive,
+                                      self._output_cache)
+        # Refresh the precompiled templates for the next generation.
+        self.CompileTemplates()
         return ret[0], ret[3]
 
+    def CompileTemplates(self):
+        import templates
+
+        return templates.CompileTemplates(self.source_dir,
+                                          self.template_archive)
+
     def Versions(self):
         return self._versions.Versions()
 
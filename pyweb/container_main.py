@@ -7,8 +7,6 @@ import optparse
 import os.path
 import sys
 
-import pyweb.container
-import pyweb.devserver
 import pyweb.pywebgen
 
 USAGE = '''%prog command args...
@@ -27,18 +25,48 @@ Commands:
   gc
     Garbage collect all website versions older than 'current'.
 
+  compile-templates
+    Precompile the website's templates. This is done automatically
+    after generating.
+
   devel
     Run a development webserver on localhost:8000
+
+  serve-builds
+    Run a build daemon keeping generation caches warm. While it runs,
+    the generate, versions, setcurrent and gc commands are executed
+    by the daemon.
 '''
 
 
 def _MakeEnv():
+    import pyweb.container
     env_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
     return pyweb.container.Container(env_dir)
 
 
+def _Execute(command, *args):
+    """Execute a container command, through the build daemon if it runs."""
+    import pyweb.builddaemon
+
+    env = _MakeEnv()
+    try:
+        return pyweb.builddaemon.Call(env.build_socket, command, *args)
+    except pyweb.builddaemon.DaemonUnavailable:
+        pass
+
+    if command == 'generate':
+        return env.Generate()
+    elif command == 'versions':
+        return env.Versions()
+    elif command == 'setcurrent':
+        return env.SetCurrent(*args)
+    elif command == 'gc':
+        return env.Gc()
+
+
 def GenerateCmd(_):
-    ts, current = _MakeEnv().Generate()
+    ts, current = _Execute('generate')
 
     print 'Generated version %s' % ts
     if current:
@@ -48,7 +76,7 @@ def GenerateCmd(_):
 
 
 def VersionsCmd(_):
-    versions, current = _MakeEnv().Versions()
+    versions, current = _Execute('versions')
 
     if not versions:
         print 'No website versions.'
@@ -78,13 +106,13 @@ def SetCurrentCmd(args):
             print 'Invalid version specified.'
             return 2
 
-    ts = _MakeEnv().SetCurrent(version)
+    ts = _Execute('setcurrent', version)
     print 'Set current version to %s.' % ts
 
     return 0
 
 def GcCmd(_):
-    versions = _MakeEnv().Gc()
+    versions = _Execute('gc')
 
     if not versions:
         print 'Nothing to garbage collect.'
@@ -95,20 +123,47 @@ def GcCmd(_):
     return 0
 
 
+def CompileTemplatesCmd(_):
+    compiled = _MakeEnv().CompileTemplates()
+    print 'Compiled %d new or changed templates.' % compiled
+
+    return 0
+
+
 def DevelCmd(_):
+    import pyweb.devserver
+
     e = _MakeEnv()
     print 'Listening on http://localhost:8000/'
     pyweb.devserver.RunDevServer(
         ('127.0.0.1', 8000), e.source_dir, e.devel_dir)
     print 'Shutting down.'
 
+    return 0
+
+
+def ServeBuildsCmd(_):
+    import pyweb.builddaemon
+
+    e = _MakeEnv()
+    print 'Serving builds on %s' % e.build_socket
+    try:
+        pyweb.builddaemon.Serve(e, e.build_socket)
+    except KeyboardInterrupt:
+        print
+    print 'Shutting down.'
+
+    return 0
+
 
 _COMMANDS = {
     'generate': GenerateCmd,
     'versions': VersionsCmd,
     'setcurrent': SetCurrentCmd,
     'gc': GcCmd,
-    'devel': DevelCmd
+    'compile-templates': CompileTemplatesCmd,
+    'devel': DevelCmd,
+    'serve-builds': ServeBuildsCmd
 }
 
 def main():
@@ -125,4 +180,10 @@ def main():
         parser.print_help()
         return 2
 
-    return _COMMANDS[args[0]](args[1:])
+    try:
+        return _COMMANDS[args[0]](args[1:])
+    finally:
+        # Importing pyweb.metrics here would make pyweb a local name
+        # for the whole function.
+        from pyweb import metrics
+        metrics.Export()
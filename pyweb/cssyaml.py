@@ -144,21 +144,22 @@ def _MergeKeys(parent_str, child_str):
 def _GenerateBlock(name, block_dict, vars):
     """Convert a YAML CSS dict tree into a set of CSS blocks."""
     block_defs = []
-    child_blocks = []
     for k,v in block_dict.iteritems():
-        if isinstance(v, odict.OrderedDict):
-            child_blocks.extend(_GenerateBlock(_MergeKeys(name, k), v, vars))
-        else:
+        if not isinstance(v, odict.OrderedDict):
             block_defs.append('  %s: %s;' % (k, _UnescapeValue(str(v), vars)))
 
     if block_defs:
         yield '%s {\n%s\n}\n' % (name, '\n'.join(block_defs))
-    for child_block in child_blocks:
-        yield child_block
 
+    # Child blocks are generated lazily, after the parent block.
+    for k,v in block_dict.iteritems():
+        if isinstance(v, odict.OrderedDict):
+            for child_block in _GenerateBlock(_MergeKeys(name, k), v, vars):
+                yield child_block
 
-def GenerateCss(in_stream, timestamp):
-    """Generate a CSS string from a YAML CSS input stream."""
+
+def GenerateCssChunks(in_stream, timestamp):
+    """Generate CSS from a YAML CSS input stream, one block at a time."""
     data = _CssYamlToDict(in_stream)
 
     if _VARS_BLOCK_NAME in data:
@@ -167,8 +168,12 @@ def GenerateCss(in_stream, timestamp):
     else:
         vars = {}
 
-    blocks = [_CSS_HEADER % timestamp]
+    yield _CSS_HEADER % timestamp
     for k,v in data.iteritems():
-        blocks.extend(_GenerateBlock(_UnescapeKey(k), v, vars))
+        for block in _GenerateBlock(_UnescapeKey(k), v, vars):
+            yield '\n' + block
+
 
-    return '\n'.join(blocks)
+def GenerateCss(in_stream, timestamp):
+    """Generate a CSS string from a YAML CSS input stream."""
+    return ''.join(GenerateCssChunks(in_stream, timestamp))
@@ -12,24 +12,94 @@ files.
 This module assists in that task. Given a generated-only output tree
 and a manifest describing it, the generated files can be deployed or
 undeployed to/from a mixed origin directory tree.
+
+Deployment can either copy the generated files, or populate the
+deploy tree with relative symlinks that point through a link to the
+generated tree (typically the versions 'current' link). In the latter
+case, activating a new version only requires repointing that link,
+and the deploy tree only needs touching for files that appear or
+disappear between versions.
+
+A deploy directory is only ever deployed to in one mode, so that
+copies and links never end up mixed in it. The mode of each deploy
+directory is recorded next to the generated trees deployed into it
+(for versions, in the versions directory), rather than in the deploy
+directory, where it would be served.
 """
 
 __author__ = 'David Anderson <dave@natulte.net>'
 
+import json
 import os
 import os.path
 import shutil
+import time
 
 import error
+import metrics
 import util
 
 
+_DEPLOY_SECONDS = metrics.REGISTRY.Histogram(
+    'pywebgen_deploy_duration_seconds',
+    'Time spent deploying and undeploying websites.')
+_DEPLOYED_FILES = metrics.REGISTRY.Counter(
+    'pywebgen_deploy_files_total',
+    'Files and directories added to or removed from deploy trees.')
+
+
+# Records the mode each deploy directory is deployed in, 'copy' or
+# 'link'.
+_MODES_FILE = '.pywebgen-deploy-modes'
+
+
+class DeployModeError(error.Error):
+    """The deploy directory is deployed in another mode."""
+
+
+def _CheckMode(tree_root, out_root, mode, record=False):
+    """Refuse to touch a deploy directory in a mode other than its own.
+
+    Args:
+      tree_root: the generated tree, or the link to it.
+      out_root: the deploy directory.
+      mode: 'copy' or 'link'.
+      record: whether to record mode for out_root, if it has none yet.
+    """
+    modes_file = os.path.join(os.path.dirname(os.path.abspath(tree_root)),
+                              _MODES_FILE)
+    out_root = os.path.realpath(out_root)
+    try:
+        modes = json.loads(util.ReadFileContent(modes_file))
+    except util.FileNotFoundError:
+        modes = {}
+    recorded = modes.get(out_root)
+    if recorded is None:
+        if record:
+            modes[out_root] = mode
+            util.WriteFileContent(modes_file, json.dumps(modes))
+    elif recorded != mode:
+        raise DeployModeError('%s is deployed in %s mode' %
+                              (out_root, recorded))
+
+
+def _ManifestEntries(manifest_file):
+    """Yield the entries of a manifest, reading it as they are consumed."""
+    f = util.OpenFileStream(manifest_file)
+    try:
+        for line in f:
+            entry = line.rstrip(u'\r\n')
+            if entry.strip():
+                yield entry
+    finally:
+        f.close()
+
+
 def _ManifestFileIterator(in_root, out_root, manifest_file):
     in_root = os.path.abspath(in_root)
     out_root = os.path.abspath(out_root)
-    manifest = util.ReadFileContent(manifest_file)
 
-    for file in (f for f in manifest.splitlines() if f.strip()):
+    for file in _ManifestEntries(manifest_file):
         in_file = os.path.join(in_root, file)
         out_file = os.path.join(out_root, file)
 
@@ -40,6 +110,8 @@ def _ManifestFileIterator(in_root, out_root, manifest_file):
 
 
 def Deploy(in_root, out_root, manifest_file):
+    start = time.time()
+    _CheckMode(in_root, out_root, 'copy', record=True)
     # First check that no files are obstructing deployment.
     for in_file, out_file in _ManifestFileIterator(in_root, out_root,
                                                    manifest_file):
@@ -50,15 +122,24 @@ def Deploy(in_root, out_root, manifest_file):
             raise util.PathObstructedError(out_file)
 
     # All is well, deploy.
+    count = 0
     for in_file, out_file in _ManifestFileIterator(in_root, out_root,
                                                    manifest_file):
         if os.path.isdir(in_file):
             util.CreateDir(out_file)
         else:
             shutil.copy(in_file, out_file)
+        count += 1
+
+    _DEPLOY_SECONDS.Observe(time.time() - start, mode='copy',
+                            operation='deploy')
+    _DEPLOYED_FILES.Inc(count, mode='copy', operation='add')
 
 
 def Undeploy(in_root, out_root, manifest_file):
+    start = time.time()
+    _CheckMode(in_root, out_root, 'copy')
+    count = 0
     for in_file, out_file in _ManifestFileIterator(in_root, out_root,
                                                    manifest_file):
         if os.path.isdir(in_file):
@@ -66,7 +147,167 @@ def Undeploy(in_root, out_root, manifest_file):
             # directory, and it's empty.
             if os.path.isdir(out_file) and not os.listdir(out_file):
                 os.rmdir(out_file)
+                count += 1
         else:
             # Only delete if it's still a file.
             if os.path.isfile(out_file):
                 os.remove(out_file)
+                count += 1
+
+    _DEPLOY_SECONDS.Observe(time.time() - start, mode='copy',
+                            operation='undeploy')
+    _DEPLOYED_FILES.Inc(count, mode='copy', operation='remove')
+
+
+def _LinkTarget(link_root, out_file):
+    """Return the relative symlink target for a deployed file."""
+    return os.path.relpath(link_root, os.path.dirname(out_file))
+
+
+def _IsDeployedLink(link_root, file, out_file):
+    return (os.path.islink(out_file) and
+            os.readlink(out_file) == os.path.join(
+                _LinkTarget(link_root, out_file), file))
+
+
+def _LinkPaths(link_root, out_root):
+    # The deploy dir is frequently itself a symlink (see container.py),
+    # so relative links must be computed from its real location. The
+    # last component of link_root is left alone, since that is the
+    # link that gets repointed.
+    link_root = os.path.abspath(link_root)
+    link_root = os.path.join(os.path.realpath(os.path.dirname(link_root)),
+                             os.path.basename(link_root))
+    return link_root, os.path.realpath(out_root)
+
+
+def LinkDeploy(link_root, out_root, manifest_file, previous_manifest_file=None,
+               tree_root=None, prune=True):
+    """Deploy a generated tree as a farm of relative symlinks.
+
+    Directories listed in the manifest are created for real in the
+    deploy tree, and files are deployed as symlinks into link_root.
+    When link_root is a symlink to the generated tree, switching
+    versions only requires repointing link_root.
+
+    Args:
+      link_root: the path through which generated files are reached.
+      out_root: the mixed origin deploy directory.
+      manifest_file: the manifest of the tree reachable via link_root.
+      previous_manifest_file: the manifest of the previously
+                              link-deployed tree, if any. Entries
+                              present in both manifests are assumed
+                              to already be deployed and are not
+                              touched.
+      tree_root: the generated tree described by manifest_file, used
+                 to tell directories from files. Defaults to
+                 link_root, give it when link_root doesn't point to
+                 that tree yet.
+      prune: if False, links of files that are only in the previous
+             manifest are left alone. This allows adding the new links
+             before repointing link_root, and calling LinkPrune
+             afterwards, so that no deployed file ever goes missing.
+
+    Raises:
+      DeployModeError: out_root is deployed in copy mode.
+      PathObstructedError: a non-generated file obstructs deployment.
+    """
+    start = time.time()
+    _CheckMode(link_root, out_root, 'link', record=True)
+    link_root, out_root = _LinkPaths(link_root, out_root)
+    tree_root = tree_root or link_root
+    # Only the entry sets are held in memory, the manifests are
+    # otherwise streamed.
+    if previous_manifest_file:
+        old_entries = set(_ManifestEntries(previous_manifest_file))
+    else:
+        old_entries = set()
+
+    def ToAdd():
+        for file in _ManifestEntries(manifest_file):
+            if file not in old_entries:
+                yield file
+
+    # First check that no files are obstructing deployment.
+    for file in ToAdd():
+        out_file = os.path.join(out_root, file)
+        if os.path.isdir(os.path.join(tree_root, file)):
+            if os.path.lexists(out_file) and (os.path.islink(out_file) or
+                                              not os.path.isdir(out_file)):
+                raise util.PathObstructedError(out_file)
+        elif (os.path.lexists(out_file) and
+              not _IsDeployedLink(link_root, file, out_file)):
+            raise util.PathObstructedError(out_file)
+
+    # All is well, deploy.
+    count = 0
+    for file in ToAdd():
+        out_file = os.path.join(out_root, file)
+        if os.path.isdir(os.path.join(tree_root, file)):
+            util.CreateDir(out_file)
+        elif not os.path.lexists(out_file):
+            os.symlink(os.path.join(_LinkTarget(link_root, out_file), file),
+                       out_file)
+        count += 1
+    _DEPLOYED_FILES.Inc(count, mode='link', operation='add')
+
+    if prune and previous_manifest_file:
+        _RemoveLinks(link_root, out_root,
+                     _StaleEntries(manifest_file, previous_manifest_file))
+    _DEPLOY_SECONDS.Observe(time.time() - start, mode='link',
+                            operation='deploy')
+
+
+def _StaleEntries(manifest_file, previous_manifest_file):
+    """Yield the entries of the previous manifest missing from the new one."""
+    new_entries = set(_ManifestEntries(manifest_file))
+    for file in _ManifestEntries(previous_manifest_file):
+        if file not in new_entries:
+            yield file
+
+
+def LinkPrune(link_root, out_root, manifest_file, previous_manifest_file):
+    """Remove the links of files that are gone from the deployed tree.
+
+    This completes a LinkDeploy done with prune=False, once link_root
+    points to the tree described by manifest_file.
+    """
+    start = time.time()
+    _CheckMode(link_root, out_root, 'link')
+    link_root, out_root = _LinkPaths(link_root, out_root)
+    _RemoveLinks(link_root, out_root,
+                 _StaleEntries(manifest_file, previous_manifest_file))
+    _DEPLOY_SECONDS.Observe(time.time() - start, mode='link',
+                            operation='prune')
+
+
+def LinkUndeploy(link_root, out_root, manifest_file):
+    """Remove a symlink farm created by LinkDeploy."""
+    start = time.time()
+    _CheckMode(link_root, out_root, 'link')
+    link_root, out_root = _LinkPaths(link_root, out_root)
+    _RemoveLinks(link_root, out_root, _ManifestEntries(manifest_file))
+    _DEPLOY_SECONDS.Observe(time.time() - start, mode='link',
+                            operation='undeploy')
+
+
+def _RemoveLinks(link_root, out_root, files):
+    # Links are removed as the files stream by, directories are only
+    # removed afterwards, deepest first, once they've been emptied.
+    dirs = []
+    count = 0
+    for file in files:
+        out_file = os.path.join(out_root, file)
+        if _IsDeployedLink(link_root, file, out_file):
+            os.remove(out_file)
+            count += 1
+        elif os.path.isdir(out_file) and not os.path.islink(out_file):
+            dirs.append(out_file)
+
+    for out_file in reversed(dirs):
+        # Only delete an output directory if it's still a directory,
+        # and it's empty.
+        if not os.listdir(out_file):
+            os.rmdir(out_file)
+            count += 1
+    _DEPLOYED_FILES.Inc(count, mode='link', operation='remove')
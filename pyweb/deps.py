@@ -0,0 +1,177 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Dependency tracking between input files.
+
+While generating a website, processors can read files other than the
+input they are processing (site data files, included templates...). The
+dependency graph records these reads, so that when such a file
+changes, only the inputs that actually used it need regenerating.
+
+The build index remembers, for each processed input, the state of the
+input and of its dependencies at processing time, along with the
+outputs produced. Incremental generation uses it to skip inputs for
+which nothing changed.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+
+
+class DependencyGraph(object):
+    def __init__(self):
+        self._deps = {}
+        self._context = {}
+        self._current = None
+        self._collectors = []
+
+    def Begin(self, path):
+        """Start recording the dependencies of the given input file.
+
+        Any dependencies recorded for this input by a previous
+        generation are forgotten.
+        """
+        self._current = path
+        self._deps[path] = set()
+        self._context[path] = set()
+
+    def End(self):
+        """Stop recording dependencies for the current input file."""
+        self._current = None
+
+    def Record(self, dep_path):
+        """Record that the current input file depends on dep_path."""
+        if self._current is not None:
+            self._deps[self._current].add(dep_path)
+        for collected in self._collectors:
+            collected.add(dep_path)
+
+    def RecordContext(self, name):
+        """Record that the current input file used a context value.
+
+        Only values that change between generations (the timestamp,
+        the roots...) need recording.
+        """
+        if self._current is not None:
+            self._context[self._current].add(name)
+
+    def StartCollecting(self):
+        """Also collect the dependencies recorded until StopCollecting.
+
+        This lets a part of the processing of an input find out what
+        it depends on, to cache its result.
+        """
+        self._collectors.append(set())
+
+    def StopCollecting(self):
+        """Return the dependencies recorded since StartCollecting."""
+        return self._collectors.pop()
+
+    def Forget(self, path):
+        """Forget everything about an input file that no longer exists."""
+        self._deps.pop(path, None)
+        self._context.pop(path, None)
+
+    def Dependencies(self, path):
+        """Return the set of files the given input file depends on."""
+        return self._deps.get(path, set())
+
+    def ContextDependencies(self, path):
+        """Return the set of context values the given input file used."""
+        return self._context.get(path, set())
+
+    def Dependents(self, dep_paths):
+        """Return the set of input files that depend on any of dep_paths."""
+        dep_paths = set(dep_paths)
+        return set(path for path, deps in self._deps.iteritems()
+                   if not deps.isdisjoint(dep_paths))
+
+
+def Stamp(path, st=None):
+    """Return a cheap signature of a file's state, or None if it's missing.
+
+    If the file's stat result is already known, it can be given as st.
+    """
+    if st is None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+    return (st.st_mtime, st.st_size)
+
+
+class BuildIndex(object):
+    def __init__(self):
+        self._entries = {}
+
+    def Update(self, path, dep_paths, outputs, st=None):
+        """Record that path was processed into the given outputs."""
+        self._entries[path] = (Stamp(path, st),
+                               [(d, Stamp(d)) for d in dep_paths],
+                               outputs)
+
+    def Forget(self, path):
+        self._entries.pop(path, None)
+
+    def Clear(self):
+        self._entries.clear()
+
+    def Paths(self):
+        return self._entries.keys()
+
+    def Dependencies(self, path):
+        """Return the dependencies recorded when path was last processed."""
+        entry = self._entries.get(path)
+        if entry is None:
+            return []
+        return [dep_path for dep_path, _ in entry[1]]
+
+    def LastOutputs(self, path):
+        """Return the outputs path was last processed into, or None.
+
+        Unlike Outputs, doesn't check whether they are up to date.
+        """
+        entry = self._entries.get(path)
+        return entry and entry[2]
+
+    def Export(self):
+        """Return the index as a JSON serializable dict."""
+        return dict((path, {'stamp': stamp, 'dependencies': dep_stamps,
+                            'outputs': outputs})
+                    for path, (stamp, dep_stamps, outputs)
+                    in self._entries.iteritems())
+
+    def Import(self, entries):
+        """Replace the index with one returned by Export."""
+        # JSON turns tuples into lists, and strings into unicode.
+        def Tuple(stamp):
+            return stamp and tuple(stamp)
+
+        def Str(path):
+            return path.encode('utf-8')
+
+        self._entries = dict(
+            (Str(path), (Tuple(e['stamp']),
+                         [(Str(d), Tuple(s)) for d, s in e['dependencies']],
+                         [Str(o) for o in e['outputs']]))
+            for path, e in entries.iteritems())
+
+    def Outputs(self, path, st=None):
+        """Return the outputs of path if it is up to date, else None.
+
+        An input is up to date if neither it nor any of its
+        dependencies changed since it was last processed.
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        stamp, dep_stamps, outputs = entry
+        if stamp is None or Stamp(path, st) != stamp:
+            return None
+        for dep_path, dep_stamp in dep_stamps:
+            if Stamp(dep_path) != dep_stamp:
+                return None
+        return outputs
@@ -3,59 +3,401 @@
 # Redistribution of this file is permitted under
 # the terms of the GNU Public License (GPL) version 2.
 
-"""Website development server."""
+"""Website development server.
+
+Files are served with content hash ETags, so browsers can revalidate
+their caches cheaply with If-None-Match, and single byte ranges are
+supported, so that large media can be seeked into.
+
+The site is regenerated in the background whenever its input tree
+changes, and the outputs each regeneration wrote are pushed to browsers
+over a server-sent events channel. A small script injected into served
+HTML pages listens on that channel: stylesheets are swapped in place,
+and a page is only reloaded when it, or something it references, was
+rewritten.
+"""
 
 __author__ = 'David Anderson <dave@natulte.net>'
 
 
+import email.utils
+import hashlib
+import json
 import os
 import os.path
 import BaseHTTPServer
+import re
 import SimpleHTTPServer
 import shutil
-import time
+import socket
+import SocketServer
+import sys
+import threading
+import traceback
+import urlparse
 
 import generator
+import processors
+import watcher
+
+
+LIVERELOAD_PATH = '/__pywebgen/livereload'
+KEEPALIVE_INTERVAL = 15
+
+_BLOCK_SIZE = 64 * 1024
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_BODY_END_RE = re.compile(r'</body\s*>', re.IGNORECASE)
+_MAX_BUILD_HISTORY = 32
+
+# Listens for regenerations and refreshes what they touched. A null
+# event means the server lost track of what changed.
+_LIVERELOAD_SCRIPT = r"""<script type="text/javascript">
+(function() {
+  if (!window.EventSource) return;
+  var source = new EventSource('%(path)s?since=%(serial)d');
+  function resolve(path) {
+    var a = document.createElement('a');
+    a.href = '/' + path;
+    return a.href;
+  }
+  function strip(url) {
+    return url.split('#')[0].split('?')[0].replace(/\/$/, '/index.html');
+  }
+  function refresh(url) {
+    var stamp = '?livereload=' + new Date().getTime();
+    var links = document.getElementsByTagName('link');
+    if (/\.css$/.test(url)) {
+      for (var i = 0; i < links.length; i++) {
+        if (links[i].rel == 'stylesheet' && strip(links[i].href) == url)
+          links[i].href = url + stamp;
+      }
+      return false;
+    }
+    if (url == strip(location.href)) return true;
+    var images = document.images;
+    for (var i = 0; i < images.length; i++) {
+      if (strip(images[i].src) == url) images[i].src = url + stamp;
+    }
+    var scripts = document.getElementsByTagName('script');
+    for (var i = 0; i < scripts.length; i++) {
+      if (scripts[i].src && strip(scripts[i].src) == url) return true;
+    }
+    return false;
+  }
+  source.onmessage = function(event) {
+    var outputs = JSON.parse(event.data);
+    if (outputs === null) return location.reload();
+    for (var i = 0; i < outputs.length; i++) {
+      if (refresh(resolve(outputs[i]))) return location.reload();
+    }
+  };
+})();
+</script>
+"""
+
+
+def _ParseRange(header, size):
+    """Parse a Range header into (start, end) inclusive byte offsets.
+
+    Returns:
+      The requested range, None if the header should be ignored (it
+      is malformed, or asks for several ranges), or False if the
+      range can't be satisfied.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if size == 0:
+        # Not even a suffix range selects bytes of an empty file.
+        return False
+
+    if not start:
+        # Suffix range: the last N bytes.
+        length = int(end)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    if end:
+        end = min(int(end), size - 1)
+    else:
+        end = size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
 
 
-REFRESH_INTERVAL = 2
+def _InjectScript(content, script):
+    """Insert script just before the closing body tag of an HTML page."""
+    ends = list(_BODY_END_RE.finditer(content))
+    if not ends:
+        return content + script
+    pos = ends[-1].start()
+    return content[:pos] + script + content[pos:]
 
 
 class DevHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def do_HEAD(self):
-        self.RefreshSite()
-        SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+        self.ServeFile(send_body=False)
 
     def do_GET(self):
-        self.RefreshSite()
-        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+        if urlparse.urlsplit(self.path).path == LIVERELOAD_PATH:
+            self.StreamBuilds()
+        else:
+            self.ServeFile(send_body=True)
 
-    def RefreshSite(self):
-        if self.server.RefreshSite():
-            print 'Regenerated website'
+    def StreamBuilds(self):
+        """Push the outputs of each regeneration as server-sent events."""
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        # Browsers send the last event ID when they reconnect.
+        since = (self.headers.getheader('Last-Event-ID') or
+                 query.get('since', [''])[0])
+        try:
+            serial = int(since)
+        except ValueError:
+            serial = self.server.BuildSerial()
+
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while not self.server.stopping:
+                new_serial, outputs = self.server.WaitForBuild(
+                    serial, KEEPALIVE_INTERVAL)
+                if new_serial == serial:
+                    self.wfile.write(': keepalive\n\n')
+                else:
+                    serial = new_serial
+                    self.wfile.write('id: %d\ndata: %s\n\n' %
+                                     (serial, json.dumps(outputs)))
+                self.wfile.flush()
+        except socket.error:
+            # The browser went away.
+            pass
+
+    def ServeFile(self, send_body):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?')[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            # Let the base class deal with redirects, directory
+            # listings and errors.
+            if send_body:
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            else:
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+            return
+
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            etag = self.server.ETag(path, st)
+
+            if path.endswith('.html'):
+                self._ServePage(f, st, etag, send_body)
+                return
+
+            if self._NotModified(etag, st):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
 
+            size = st.st_size
+            byte_range = None
+            range_header = self.headers.getheader('Range')
+            if_range = self.headers.getheader('If-Range')
+            if range_header and (not if_range or if_range == etag):
+                byte_range = _ParseRange(range_header, size)
+                if byte_range is False:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.end_headers()
+                    return
+
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (start, end, size))
+            else:
+                start, end = 0, size - 1
+                self.send_response(200)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Last-Modified',
+                             self.date_time_string(st.st_mtime))
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            if send_body:
+                self._SendFile(f, start, end - start + 1)
+        finally:
+            f.close()
+
+    def _ServePage(self, f, st, etag, send_body):
+        # The injected script names the current build, so that builds
+        # completing before the browser connects aren't missed. The
+        # ETag follows, the file's mtime alone can't validate the page,
+        # and byte ranges aren't worth supporting.
+        serial = self.server.BuildSerial()
+        etag = '%s-%d"' % (etag[:-1], serial)
+        if self._NotModified(etag, st):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        content = _InjectScript(f.read(), _LIVERELOAD_SCRIPT % {
+            'path': LIVERELOAD_PATH, 'serial': serial})
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(f.name))
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(content)
+
+    def _NotModified(self, etag, st):
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            # Weak comparison is fine for GET and HEAD.
+            tags = [t.startswith('W/') and t[2:] or t for t in tags]
+            return '*' in tags or etag in tags
+
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(st.st_mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def _SendFile(self, f, offset, length):
+        # Files are copied by blocks, so only one block is ever held
+        # in memory.
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(_BLOCK_SIZE, length))
+            if not block:
+                break
+            self.wfile.write(block)
+            length -= len(block)
+
+
+class DevHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Live reload connections stay open, so each request gets a thread.
+    daemon_threads = True
 
-class DevHTTPServer(BaseHTTPServer.HTTPServer):
     def __init__(self, address, in_dir, out_dir):
         BaseHTTPServer.HTTPServer.__init__(self, address, DevHTTPRequestHandler)
 
         self._out_dir = os.path.abspath(out_dir)
-        in_dir = os.path.abspath(in_dir)
-        self._generator = generator.Generator(in_dir, ['HtmlJinja', 'CssYaml'])
-        self._last_generation = 0
-        self._previous_cwd = os.getcwd()
+        self._in_dir = os.path.abspath(in_dir)
+        self._generator = generator.Generator(self._in_dir,
+                                              processors.DEFAULT_PROCESSORS)
+        self._etags = {}
+        self._builds = threading.Condition()
+        self._serial = 0
+        self._history = []
+        self.stopping = False
+        self.CleanupSite()
+
+        snapshot = watcher.Snapshot(self._in_dir)
         self.RefreshSite()
+        os.chdir(self._out_dir)
+        self._watch_thread = threading.Thread(target=self._WatchSite,
+                                              args=(snapshot,))
+        self._watch_thread.setDaemon(True)
+        self._watch_thread.start()
+
+    def _WatchSite(self, snapshot):
+        while not self.stopping:
+            snapshot = watcher.WaitForChanges(self._in_dir, snapshot)
+            try:
+                outputs = self.RefreshSite()
+            except Exception:
+                # Keep serving the last good site, the next change may
+                # well fix the error.
+                traceback.print_exc()
+                continue
+            print 'Regenerated website, %d outputs changed' % len(outputs)
+            sys.stdout.flush()
 
     def RefreshSite(self):
-        t = time.time()
-        if (t - self._last_generation) < REFRESH_INTERVAL:
-            return False
+        """Regenerate the site, and announce the outputs that changed.
 
-        self._last_generation = t
-        self.CleanupSite()
-        self._generator.Generate(self._out_dir)
-        os.chdir(self._out_dir)
-        return True
+        Returns:
+          The output paths, relative to the output root, whose
+          content changed.
+        """
+        # Regenerating incrementally leaves unchanged files, and their
+        # mtimes, alone, so that browser caches stay valid.
+        self._generator.Generate(self._out_dir, incremental=True)
+        outputs = self._generator.WrittenOutputs()
+        if outputs:
+            self._builds.acquire()
+            try:
+                self._serial += 1
+                self._history.append((self._serial, outputs))
+                del self._history[:-_MAX_BUILD_HISTORY]
+                self._builds.notifyAll()
+            finally:
+                self._builds.release()
+        return outputs
+
+    def BuildSerial(self):
+        """Return the serial number of the latest regeneration."""
+        return self._serial
+
+    def WaitForBuild(self, serial, timeout):
+        """Wait for regenerations newer than serial.
+
+        Returns:
+          (serial, outputs) of the latest regeneration. outputs lists
+          every output changed since the given serial, or is None if
+          that history has been forgotten. The serial is unchanged if
+          the timeout expired first.
+        """
+        self._builds.acquire()
+        try:
+            if self._serial == serial:
+                self._builds.wait(timeout)
+            if self._serial == serial:
+                return serial, []
+            if not self._history or self._history[0][0] > serial + 1:
+                return self._serial, None
+            outputs = []
+            for build_serial, build_outputs in self._history:
+                if build_serial > serial:
+                    outputs.extend(build_outputs)
+            return self._serial, sorted(set(outputs))
+        finally:
+            self._builds.release()
+
+    def ETag(self, path, st):
+        """Return the content hash ETag of a file, cached by stat stamp."""
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        cached = self._etags.get(path)
+        if cached is None or cached[0] != stamp:
+            digest = hashlib.sha1()
+            f = open(path, 'rb')
+            try:
+                for block in iter(lambda: f.read(_BLOCK_SIZE), ''):
+                    digest.update(block)
+            finally:
+                f.close()
+            cached = (stamp, '"%s"' % digest.hexdigest())
+            self._etags[path] = cached
+        return cached[1]
 
     def CleanupSite(self):
         if os.path.isdir(self._out_dir):
@@ -68,4 +410,5 @@ def RunDevServer(address, in_dir, out_dir):
         s.serve_forever()
     except KeyboardInterrupt:
         print
+        s.stopping = True
         s.CleanupSite()
@@ -0,0 +1,163 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Fan-out specifications: one template rendered to many pages.
+
+A fan-out spec is a YAML file with a .fanout extension, placed in the
+input tree where the generated pages should go. It names a template, a
+collection of items, and an output path pattern:
+
+  template: _product.html
+  data: shop.products
+  output: products/%(slug)s.html
+
+The collection is either a list from the site data (see sitedata.py),
+given as a dotted path with 'data', or a directory of front-matter
+entry files given with 'entries', relative to the spec file. An entry
+file is a YAML mapping between two '---' lines, followed by a body
+that is exposed as the 'content' field. Entries get a default 'slug'
+field derived from their filename.
+
+Without pagination, each item is rendered to its own page, with the
+item available to the template as 'item'. If 'paginate' is set to a
+number, items are grouped in pages of that size, and the template
+gets a 'page' mapping with 'number', 'count' and 'items' keys. The
+output pattern is expanded with the item's fields, or with 'page'
+when paginating.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+
+import error
+import util
+
+try:
+    import yaml
+except ImportError:
+    raise error.MissingPythonModule('yaml')
+
+
+_FRONT_MATTER_DELIMITER = '---'
+
+
+class FanoutSpecError(error.Error):
+    """A fan-out spec or one of its entries is malformed."""
+
+
+class Spec(object):
+    def __init__(self, path):
+        self.path = path
+        try:
+            spec = yaml.safe_load(util.ReadFileContent(path))
+        except yaml.YAMLError, e:
+            raise FanoutSpecError('%s: %s' % (path, e))
+
+        if not isinstance(spec, dict):
+            raise FanoutSpecError('%s: spec must be a mapping' % path)
+        for key in ('template', 'output'):
+            if key not in spec:
+                raise FanoutSpecError('%s: missing %r' % (path, key))
+        if ('data' in spec) == ('entries' in spec):
+            raise FanoutSpecError("%s: exactly one of 'data' and "
+                                  "'entries' is required" % path)
+
+        self.template = spec['template']
+        self.output = spec['output']
+        self.data = spec.get('data')
+        self.entries = spec.get('entries')
+        self.paginate = spec.get('paginate')
+        if self.paginate is not None and (not isinstance(self.paginate, int)
+                                          or self.paginate < 1):
+            raise FanoutSpecError('%s: paginate must be a positive '
+                                  'integer' % path)
+
+    def Items(self, site_data, deps):
+        """Return the list of items in the spec's collection."""
+        if self.data:
+            items = site_data
+            try:
+                for name in self.data.split('.'):
+                    items = items[name]
+            except (KeyError, TypeError):
+                raise FanoutSpecError('%s: no site data %r' %
+                                      (self.path, self.data))
+        else:
+            entries_dir = os.path.join(os.path.dirname(self.path),
+                                       self.entries)
+            items = ReadEntries(entries_dir, deps)
+
+        if not isinstance(items, list):
+            raise FanoutSpecError('%s: collection is not a list' % self.path)
+        return items
+
+    def Pages(self, items):
+        """Yield (output path suffix, template context) for each page."""
+        if not self.paginate:
+            for item in items:
+                yield self._Expand(item), {'item': item}
+            return
+
+        count = max(1, (len(items) + self.paginate - 1) // self.paginate)
+        for number in xrange(1, count + 1):
+            start = (number - 1) * self.paginate
+            page = {
+                'number': number,
+                'count': count,
+                'items': items[start:start + self.paginate],
+                }
+            yield self._Expand({'page': number}), {'page': page}
+
+    def _Expand(self, fields):
+        try:
+            return self.output % fields
+        except (KeyError, TypeError, ValueError):
+            raise FanoutSpecError('%s: cannot expand output %r with %r' %
+                                  (self.path, self.output, fields))
+
+
+def ParseEntry(path):
+    """Parse a front-matter entry file into a dict."""
+    content = util.ReadFileContent(path)
+    entry = {}
+
+    lines = content.split('\n')
+    if lines and lines[0].strip() == _FRONT_MATTER_DELIMITER:
+        for i, line in enumerate(lines[1:]):
+            if line.strip() == _FRONT_MATTER_DELIMITER:
+                break
+        else:
+            raise FanoutSpecError('%s: unterminated front matter' % path)
+        try:
+            entry = yaml.safe_load('\n'.join(lines[1:i+1])) or {}
+        except yaml.YAMLError, e:
+            raise FanoutSpecError('%s: %s' % (path, e))
+        if not isinstance(entry, dict):
+            raise FanoutSpecError('%s: front matter must be a mapping' % path)
+        content = '\n'.join(lines[i+2:])
+
+    entry.setdefault('slug', os.path.splitext(os.path.basename(path))[0])
+    entry['content'] = content
+    return entry
+
+
+def ReadEntries(entries_dir, deps):
+    """Read all entries in a directory, in filename order."""
+    if not os.path.isdir(entries_dir):
+        raise FanoutSpecError('Missing entries directory %s' % entries_dir)
+
+    # Depending on the directory itself catches added and removed entries.
+    deps.Record(entries_dir)
+    entries = []
+    for name in sorted(os.listdir(entries_dir)):
+        path = os.path.join(entries_dir, name)
+        if (name.startswith('.') or name.endswith('~') or
+            not os.path.isfile(path)):
+            continue
+        deps.Record(path)
+        entries.append(ParseEntry(path))
+    return entries
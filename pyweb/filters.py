@@ -0,0 +1,377 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Filters transform the output of a processor, in memory.
+
+Filters are the later stages of a processor pipeline (see
+processors.PipelineProcessor). Each filter consumes the chunks
+produced by the previous stage and produces new chunks. Chunks are
+either unicode strings, or UTF-8 encoded byte strings.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import base64
+import cStringIO
+import gzip
+import mimetypes
+import os.path
+import re
+import urllib
+import urlparse
+
+import error
+
+
+class UnknownFilter(error.Error):
+    """Unknown pipeline filter."""
+
+
+class PageRequired(error.Error):
+    """A filter needs to know the page it filters."""
+
+
+def AsText(chunk):
+    if isinstance(chunk, unicode):
+        return chunk
+    return chunk.decode('utf-8')
+
+
+def AsBytes(chunk):
+    if isinstance(chunk, unicode):
+        return chunk.encode('utf-8')
+    return chunk
+
+
+class _Filter(object):
+    """Base class for pipeline filters."""
+    # True if the output only depends on the input chunks, which
+    # allows pipelines to cache it.
+    CACHEABLE = True
+
+    def StartProcessing(self, ctx):
+        """Called once the generation context is established."""
+
+    def OutputPath(self, out_path):
+        """Return the output path to use after this filter has run."""
+        return out_path
+
+    def FilterChunks(self, chunks):
+        """Transform an iterable of chunks into another."""
+        raise NotImplementedError()
+
+    def FilterFile(self, chunks, in_path):
+        """Transform the chunks produced for in_path.
+
+        Only called for filters that aren't CACHEABLE, whose output may
+        depend on more than the chunks.
+        """
+        return self.FilterChunks(chunks)
+
+    def EndProcessing(self):
+        """Called after generation of all files has finished."""
+
+
+class MinifyHtmlFilter(_Filter):
+    """Collapse whitespace and strip comments out of HTML."""
+    _PROTECTED_RE = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)',
+                               re.DOTALL | re.IGNORECASE)
+    # Conditional comments are significant, leave them be.
+    _COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+    _SPACE_RE = re.compile(r'\s+')
+
+    def _CollapseSpace(self, match):
+        if '\n' in match.group(0):
+            return '\n'
+        return ' '
+
+    def FilterChunks(self, chunks):
+        html = ''.join(AsText(c) for c in chunks)
+        bits = self._PROTECTED_RE.split(html)
+        # split() yields text, protected block, tag name, text...
+        for i in xrange(0, len(bits), 3):
+            text = self._COMMENT_RE.sub('', bits[i])
+            yield self._SPACE_RE.sub(self._CollapseSpace, text)
+            if i + 1 < len(bits):
+                yield bits[i + 1]
+
+
+class MinifyCssFilter(_Filter):
+    """Strip comments and superfluous whitespace out of CSS.
+
+    Quoted strings are left as they are.
+    """
+    _TOKEN_RE = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+                           r'|/\*.*?\*/', re.DOTALL)
+    _SPACE_RE = re.compile(r'\s+')
+    _PUNCT_RE = re.compile(r'\s*([{};,>])\s*')
+    _COLON_RE = re.compile(r':\s+')
+
+    def _Minify(self, css):
+        css = self._SPACE_RE.sub(' ', css)
+        css = self._PUNCT_RE.sub(r'\1', css)
+        css = self._COLON_RE.sub(':', css)
+        return css.replace(';}', '}')
+
+    def FilterChunks(self, chunks):
+        css = ''.join(AsText(c) for c in chunks)
+        out = []
+        code = []
+        pos = 0
+        # Comments are dropped, and the code between strings minified.
+        for match in self._TOKEN_RE.finditer(css):
+            code.append(css[pos:match.start()])
+            if match.group(1):
+                out.append(self._Minify(''.join(code)))
+                out.append(match.group(1))
+                code = []
+            pos = match.end()
+        code.append(css[pos:])
+        out.append(self._Minify(''.join(code)))
+        yield ''.join(out).strip()
+
+
+class MinifyJsFilter(_Filter):
+    """Strip comments, indentation and blank lines out of JavaScript.
+
+    Line breaks are kept, so automatic semicolon insertion still works
+    as it did. /*! comments, conventionally used for licenses, are
+    kept too.
+    """
+    _STRING_RE = re.compile(r'''"(?:\\.|[^"\\\n])*"'''
+                            r"""|'(?:\\.|[^'\\\n])*'"""
+                            r'|`(?:\\.|[^`\\])*`', re.DOTALL)
+    _REGEXP_RE = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+'
+                            r'/[a-zA-Z]*')
+    _CODE_RE = re.compile(r'''[^'"`/]+''')
+    _NEWLINE_RE = re.compile(r'\s*\n\s*')
+    # A slash after these starts a regexp literal, not a division.
+    _REGEXP_PRECEDERS = '(,=:[!&|?{};+-*%<>~^'
+    _REGEXP_KEYWORD_RE = re.compile(
+        r'\b(?:return|typeof|instanceof|in|of|new|delete|void|throw|'
+        r'case|do|else|yield)$')
+
+    def _RegexpAllowed(self, last):
+        return (not last or last[-1] in self._REGEXP_PRECEDERS or
+                self._REGEXP_KEYWORD_RE.search(last) is not None)
+
+    def FilterChunks(self, chunks):
+        js = ''.join(AsText(c) for c in chunks)
+        out = []
+        # Code and stripped comments, whose whitespace is collapsed
+        # before the next string, regexp or kept comment.
+        code = []
+        # The last significant code emitted.
+        last = ''
+        pos = 0
+        while pos < len(js):
+            if js.startswith('/*', pos):
+                end = js.find('*/', pos + 2)
+                end = end < 0 and len(js) or end + 2
+                comment = js[pos:end]
+                pos = end
+                if not comment.startswith('/*!'):
+                    code.append('\n' in comment and '\n' or ' ')
+                    continue
+                token = comment
+            elif js.startswith('//', pos):
+                end = js.find('\n', pos)
+                pos = end < 0 and len(js) or end
+                continue
+            elif js[pos] not in '\'"`/':
+                match = self._CODE_RE.match(js, pos)
+                pos = match.end()
+                code.append(match.group(0))
+                if match.group(0).strip():
+                    last = match.group(0).rstrip()
+                continue
+            else:
+                if js[pos] == '/':
+                    match = (self._RegexpAllowed(last) and
+                             self._REGEXP_RE.match(js, pos))
+                else:
+                    match = self._STRING_RE.match(js, pos)
+                token = match and match.group(0) or js[pos]
+                pos = match and match.end() or pos + 1
+                last = token
+
+            out.append(self._NEWLINE_RE.sub('\n', ''.join(code)))
+            out.append(token)
+            code = []
+
+        out.append(self._NEWLINE_RE.sub('\n', ''.join(code)))
+        yield ''.join(out).strip()
+
+
+class GzipFilter(_Filter):
+    """Compress the output with gzip, adding a .gz extension."""
+    def OutputPath(self, out_path):
+        return out_path + '.gz'
+
+    def FilterChunks(self, chunks):
+        buf = cStringIO.StringIO()
+        # A fixed mtime keeps the output reproducible.
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0)
+        for chunk in chunks:
+            gz.write(AsBytes(chunk))
+            if buf.tell():
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        gz.close()
+        yield buf.getvalue()
+
+
+class InlineAssetsFilter(_Filter):
+    """Inline small stylesheets, scripts and images into HTML.
+
+    Stylesheets and scripts are replaced by style and script blocks
+    holding their generated content, and images by data: URLs, if the
+    asset's output is at most MAX_INLINE_BYTES long. Larger assets,
+    and those that aren't part of the input tree, are left as external
+    references. Every local asset referred to is recorded as a
+    dependency of the page, even missing ones.
+    """
+    # The output depends on the assets, not only on the chunks.
+    CACHEABLE = False
+    MAX_INLINE_BYTES = 4096
+
+    _ATTR_RE = re.compile(r'''([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+    _LINK_RE = re.compile(r'<link\b([^>]*?)/?>', re.IGNORECASE)
+    _SCRIPT_RE = re.compile(r'<script\b([^>]*)>\s*</script\s*>',
+                            re.IGNORECASE)
+    _IMG_RE = re.compile(r'<img\b([^>]*?)/?>', re.IGNORECASE)
+    _SRC_RE = re.compile(r'''\bsrc\s*=\s*(?:"[^"]*"|'[^']*')''',
+                         re.IGNORECASE)
+    _CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+    def StartProcessing(self, ctx):
+        self._ctx = ctx
+
+    def _Attrs(self, attrs):
+        return dict((m.group(1).lower(), m.group(2) or m.group(3) or '')
+                    for m in self._ATTR_RE.finditer(attrs))
+
+    def _AssetPath(self, url, page_path):
+        """Return the input path of a local asset URL, or None."""
+        scheme, netloc, path, _, _ = urlparse.urlsplit(url)
+        if scheme or netloc or not path:
+            return None
+        path = urllib.unquote(path)
+        input_root = self._ctx['input_root']
+        if path.startswith('/'):
+            path = os.path.join(input_root, path.lstrip('/'))
+        else:
+            path = os.path.join(os.path.dirname(page_path), path)
+        path = os.path.normpath(path)
+        if not path.startswith(input_root + os.sep):
+            return None
+        return path
+
+    def _Asset(self, url, page_path):
+        """Return (input path, output) of a small enough asset, or None."""
+        import processors
+
+        path = self._AssetPath(url, page_path)
+        if path is None:
+            return None
+        # Recorded even if not inlined, since the asset could appear,
+        # or shrink under the limit later.
+        self._ctx['dependencies'].Record(path)
+        if not os.path.isfile(path):
+            return None
+        # Don't bother processing sources that are unlikely to shrink
+        # under the limit.
+        if os.path.getsize(path) > 4 * self.MAX_INLINE_BYTES:
+            return None
+        content = processors.ProcessToString(self._ctx['processors'], path)
+        if content is None or len(content) > self.MAX_INLINE_BYTES:
+            return None
+        return path, content
+
+    def _RebaseCssUrls(self, css, css_path, page_path):
+        """Make the relative url()s of a stylesheet relative to the page."""
+        def Rebase(match):
+            url = match.group(2)
+            if urlparse.urlsplit(url)[0] or url.startswith(('/', '#')):
+                return match.group(0)
+            path = os.path.join(os.path.dirname(css_path), url)
+            return 'url(%s)' % os.path.relpath(path,
+                                               os.path.dirname(page_path))
+        return self._CSS_URL_RE.sub(Rebase, css)
+
+    def _InlineLink(self, match, page_path):
+        attrs = self._Attrs(match.group(1))
+        if attrs.get('rel', '').lower() != 'stylesheet' or 'href' not in attrs:
+            return match.group(0)
+        asset = self._Asset(attrs['href'], page_path)
+        if asset is None:
+            return match.group(0)
+        css = asset[1].decode('utf-8')
+        if '</style' in css.lower():
+            return match.group(0)
+        css = self._RebaseCssUrls(css, asset[0], page_path)
+        if 'media' in attrs:
+            return '<style media="%s">\n%s</style>' % (attrs['media'], css)
+        return '<style>\n%s</style>' % css
+
+    def _InlineScript(self, match, page_path):
+        attrs = self._Attrs(match.group(1))
+        if 'src' not in attrs:
+            return match.group(0)
+        asset = self._Asset(attrs['src'], page_path)
+        if asset is None:
+            return match.group(0)
+        # The script must not end the block early.
+        js = asset[1].decode('utf-8').replace('</script', '<\\/script')
+        if 'type' in attrs:
+            return '<script type="%s">\n%s</script>' % (attrs['type'], js)
+        return '<script>\n%s</script>' % js
+
+    def _InlineImage(self, match, page_path):
+        attrs = self._Attrs(match.group(1))
+        if 'src' not in attrs:
+            return match.group(0)
+        mime_type = mimetypes.guess_type(attrs['src'])[0]
+        if mime_type is None or not mime_type.startswith('image/'):
+            return match.group(0)
+        asset = self._Asset(attrs['src'], page_path)
+        if asset is None:
+            return match.group(0)
+        data_url = 'data:%s;base64,%s' % (mime_type,
+                                          base64.b64encode(asset[1]))
+        return self._SRC_RE.sub(lambda m: 'src="%s"' % data_url,
+                                match.group(0), 1)
+
+    def FilterChunks(self, chunks):
+        # Assets can only be found relative to a page.
+        raise PageRequired('InlineAssets needs the page path; use it in '
+                           'a pipeline')
+
+    def FilterFile(self, chunks, in_path):
+        html = ''.join(AsText(c) for c in chunks)
+        html = self._LINK_RE.sub(lambda m: self._InlineLink(m, in_path), html)
+        html = self._SCRIPT_RE.sub(lambda m: self._InlineScript(m, in_path),
+                                   html)
+        html = self._IMG_RE.sub(lambda m: self._InlineImage(m, in_path), html)
+        yield html
+
+    def EndProcessing(self):
+        del self._ctx
+
+
+FILTERS = {
+    'MinifyHtml': MinifyHtmlFilter,
+    'MinifyCss': MinifyCssFilter,
+    'MinifyJs': MinifyJsFilter,
+    'Gzip': GzipFilter,
+    'InlineAssets': InlineAssetsFilter,
+}
+
+
+def GetFilter(name):
+    if name not in FILTERS:
+        raise UnknownFilter(name)
+    return FILTERS[name]()
@@ -8,95 +8,514 @@
 __author__ = 'David Anderson <dave@natulte.net>'
 
 import os.path
-import shutil
 import time
 
+import deps
 import error
+import metrics
 import processors
+import sitedata
 import util
+import walker
+
+
+_BUILD_SECONDS = metrics.REGISTRY.Histogram(
+    'pywebgen_build_duration_seconds', 'Time spent generating websites.')
+_BUILD_FAILURES = metrics.REGISTRY.Counter(
+    'pywebgen_build_failures_total', 'Website generations that failed.')
+_INPUTS_PROCESSED = metrics.REGISTRY.Counter(
+    'pywebgen_build_inputs_processed_total',
+    'Input files processed into outputs.')
+_OUTPUTS = metrics.REGISTRY.Counter(
+    'pywebgen_build_outputs_total',
+    'Output files produced, by whether they were written or unchanged.')
+_BYTES_WRITTEN = metrics.REGISTRY.Counter(
+    'pywebgen_build_written_bytes_total', 'Bytes written to output files.')
+_LAST_BUILD = metrics.REGISTRY.Gauge(
+    'pywebgen_build_last_success_timestamp_seconds',
+    'Time of the last successful website generation.')
 
 
 class MissingInputDirectory(error.Error):
     """The input directory is missing"""
 
 
+class MissingOutputDirectory(error.Error):
+    """The output directory is missing"""
+
+
+class NoBuildIndex(error.Error):
+    """No build index is known for the output directory."""
+
+
 class NoProcessorFound(error.Error):
     """No processor was found to process an input file."""
 
 
+class NotAnInput(error.Error):
+    """A file to regenerate is not part of the input tree."""
+
+
 class Generator(object):
-    def __init__(self, input_root, use_processors):
+    def __init__(self, input_root, use_processors, template_archive=None,
+                 output_cache=None, memory_profiler=None):
         self._input_root = os.path.abspath(input_root)
-        self._processors = processors.GetProcessors(use_processors)
+        # Processors are only created when generation actually runs.
+        self._use_processors = use_processors
+        self._processors = None
+        if template_archive:
+            template_archive = os.path.abspath(template_archive)
+        self._template_archive = template_archive
+        self._data_loader = sitedata.DataLoader()
+        self._deps = deps.DependencyGraph()
+        self._index = deps.BuildIndex()
+        self._index_root = None
+        self._writer = util.OutputWriter()
+        self._output_cache = output_cache
+        self._memory_profiler = memory_profiler
+
+    def Generate(self, output_root, timestamp=None, manifest_path=None,
+                 incremental=False, keep_index=False, public_root=None):
+        """Generate the website into the given output root.
+
+        In incremental mode, inputs that did not change since the
+        previous generation into the same output root are not
+        processed again, and outputs that are no longer generated are
+        removed from the output root.
+
+        Other generations keep no per-file state, so that their memory
+        use doesn't grow with the size of the site, unless keep_index
+        is set. The build index, the dependencies of inputs and the
+        written outputs are needed by later incremental generations,
+        SaveIndex, Dependents and WrittenOutputs.
+
+        If the output root is only a staging area, public_root is
+        where it will be moved once generated. Templates then see
+        public_root as the output root.
+
+        Returns:
+          The number of input files that were processed into outputs.
+        """
+        return self._Measure(self._Generate, output_root, timestamp,
+                             manifest_path, incremental, keep_index,
+                             public_root)
+
+    def GenerateFiles(self, output_root, paths, timestamp=None,
+                      manifest_path=None):
+        """Regenerate some inputs into an already generated output root.
 
-    def Generate(self, output_root, timestamp=None, manifest_path=None):
-        """Generate the website into the given output root."""
-        self._Prepare(output_root, timestamp, manifest_path)
-        self._GenerateTree()
+        The given input files are processed again, along with the
+        inputs depending on them, as far as this generator knows (see
+        LoadIndex). The rest of the input tree isn't looked at. Given
+        files that no longer exist have their outputs removed.
+
+        If manifest_path is given, the manifest of the output root is
+        updated with the outputs that appeared and disappeared.
+
+        Returns:
+          The number of input files that were processed into outputs.
+
+        Raises:
+          MissingOutputDirectory: the output root doesn't exist.
+          NoBuildIndex: the generator has no build index for the
+                        output root, from LoadIndex or a previous
+                        generation.
+        """
+        return self._Measure(self._GenerateFiles, output_root, paths,
+                             timestamp, manifest_path)
+
+    def _Measure(self, generate, *args):
+        start = time.time()
+        try:
+            processed = generate(*args)
+        except:
+            _BUILD_FAILURES.Inc()
+            raise
+
+        end = time.time()
+        _BUILD_SECONDS.Observe(end - start)
+        _INPUTS_PROCESSED.Inc(processed)
+        _OUTPUTS.Inc(self._writer.written, state='written')
+        _OUTPUTS.Inc(self._writer.unchanged, state='unchanged')
+        _BYTES_WRITTEN.Inc(self._writer.bytes_written)
+        _LAST_BUILD.Set(end)
+        return processed
+
+    def _Generate(self, output_root, timestamp, manifest_path, incremental,
+                  keep_index, public_root):
+        self._Prepare(output_root, timestamp, manifest_path, incremental,
+                      keep_index, public_root)
+        entries = self._GenerateTree()
+        if self._manifest_path:
+            # The manifest is written as the tree is generated, and
+            # only replaces the previous one once generation is done.
+            util.WriteFileChunks(self._manifest_path,
+                                 ('%s\n' % entry for entry in entries))
+        else:
+            for _ in entries:
+                pass
+        self._FinishProcessing()
+        if self._keep_index:
+            self._ForgetMissingInputs()
+        if self._incremental:
+            self._PruneOutputs()
+        processed = self._processed
+        self._Cleanup()
+        return processed
+
+    def _GenerateFiles(self, output_root, paths, timestamp, manifest_path):
+        output_root = os.path.abspath(output_root)
+        if not os.path.isdir(output_root):
+            raise MissingOutputDirectory(output_root)
+        # Without the index of the output root, dependent inputs and
+        # stale outputs can't be found, and saving the index would
+        # lose what is known about the rest of the tree.
+        if self._index_root != output_root:
+            raise NoBuildIndex(output_root)
+        self._Prepare(output_root, timestamp, None, False, True, None)
+
+        targets = set()
+        for path in paths:
+            path = os.path.abspath(path)
+            if not path.startswith(self._input_root + os.sep):
+                raise NotAnInput(path)
+            targets.add(path)
+        targets.update(self._deps.Dependents(targets))
+
+        added = []
+        removed = set()
+        for path in sorted(targets):
+            old_outputs = self._index.LastOutputs(path) or []
+            if os.path.isfile(path) and not self._IsIgnored(path):
+                added.extend(self._CreateOutputDirs(path))
+                outputs = self._ProcessFile(path)
+            else:
+                self._index.Forget(path)
+                self._deps.Forget(path)
+                outputs = []
+
+            added.extend(outputs)
+            for output in set(old_outputs).difference(outputs):
+                output_path = os.path.join(self._output_root, output)
+                if os.path.isfile(output_path):
+                    os.remove(output_path)
+                removed.add(output)
+
+        self._FinishProcessing()
+        if manifest_path:
+            self._UpdateManifest(manifest_path, added, removed)
+        processed = self._processed
         self._Cleanup()
+        return processed
+
+    def _FinishProcessing(self):
+        """Wait for the outputs processors write in the background."""
+        for processor in self._processors:
+            processor.Finish()
+        # Such outputs can only be cached once they are written.
+        for store in self._pending_stores:
+            self._output_cache.Store(*store)
+        self._pending_stores = []
 
-    def _Prepare(self, output_root, timestamp, manifest_path):
+    def _IsIgnored(self, path):
+        """Return True if the walker would skip an input file."""
+        parts = util.PathAsSuffix(path, self._input_root).split(os.sep)
+        for i in xrange(1, len(parts)):
+            if self._ignore_rules.IsIgnored('/'.join(parts[:i]), True):
+                return True
+        return self._ignore_rules.IsIgnored('/'.join(parts))
+
+    def _CreateOutputDirs(self, path):
+        """Create the output directories of an input file.
+
+        Returns:
+          The directories that had to be created, relative to the
+          output root, parents first.
+        """
+        created = []
+        rel_dir = util.PathAsSuffix(os.path.dirname(path), self._input_root)
+        while rel_dir and not os.path.isdir(
+            os.path.join(self._output_root, rel_dir)):
+            created.append(rel_dir)
+            rel_dir = os.path.dirname(rel_dir)
+        created.reverse()
+        for rel_dir in created:
+            util.CreateDir(os.path.join(self._output_root, rel_dir))
+        return created
+
+    def _UpdateManifest(self, manifest_path, added, removed):
+        """Rewrite a manifest, with added and without removed entries.
+
+        Added entries are listed after the existing ones, which keeps
+        directories before the files they contain.
+        """
+        entries = []
+        if os.path.exists(manifest_path):
+            f = util.OpenFileStream(manifest_path)
+            try:
+                entries = [line.rstrip(u'\r\n').encode('utf-8')
+                           for line in f if line.strip()]
+            finally:
+                f.close()
+        present = set(entries)
+        entries = [entry for entry in entries if entry not in removed]
+        for entry in added:
+            if entry not in present:
+                present.add(entry)
+                entries.append(entry)
+        util.WriteFileChunks(manifest_path,
+                             ('%s\n' % entry for entry in entries))
+
+    def _Prepare(self, output_root, timestamp, manifest_path, incremental,
+                 keep_index, public_root):
         self._output_root = os.path.abspath(output_root)
         timestamp = timestamp or time.localtime()
         self._manifest_path = manifest_path
 
+        self._keep_index = incremental or keep_index
+        self._writer.remember = self._keep_index
+        # The build index is only meaningful for the output root it
+        # was built against, and is dropped by generations that don't
+        # keep it up to date.
+        if not self._keep_index:
+            self._index.Clear()
+            self._index_root = None
+        elif self._index_root != self._output_root:
+            self._index.Clear()
+            self._index_root = self._output_root
+            incremental = False
+        self._incremental = incremental
+        if self._keep_index:
+            self._seen = set()
+        else:
+            self._seen = None
+        self._output_dirs = set()
+        self._pending_stores = []
+        self._processed = 0
+        self._writer.ResetCounts()
+        self._ignore_rules = walker.LoadIgnoreRules(self._input_root)
+
         if not os.path.isdir(self._input_root):
             raise MissingInputDirectory(self._input_root)
 
         self._ctx = {
             'timestamp': time.asctime(timestamp),
             'input_root': self._input_root,
-            'output_root': output_root
+            'output_root': (public_root and os.path.abspath(public_root) or
+                            self._output_root),
+            'data': self._data_loader.Load(self._input_root, self._deps),
+            'dependencies': self._deps,
+            'output': self._writer,
+            'template_archive': self._template_archive
             }
 
-        self._manifest = []
+        # Only pruning needs to know every generated output at once.
+        if incremental:
+            self._generated = set()
+        else:
+            self._generated = None
 
+        if self._processors is None:
+            self._processors = processors.GetProcessors(self._use_processors)
+        # Lets filters render the assets a page refers to.
+        self._ctx['processors'] = self._processors
         for processor in self._processors:
             processor.StartProcessing(self._ctx)
 
     def _Cleanup(self):
         for processor in self._processors:
             processor.EndProcessing()
+        if self._output_cache is not None:
+            self._output_cache.SaveCounts()
 
-        self._OutputManifest()
-
-        del self._manifest
+        del self._generated
         del self._ctx
         del self._output_root
+        del self._seen
+        del self._keep_index
+        del self._output_dirs
+        del self._pending_stores
+        del self._ignore_rules
 
     def _GenerateTree(self):
-        for input_dir, dirs, files in os.walk(self._input_root):
+        """Generate the tree, yielding manifest entries as they appear."""
+        for input_dir, files in walker.Walk(self._input_root,
+                                            self._ignore_rules):
             util.CreateDir(self._InputToOutput(input_dir))
-            self._manifest.append(
-                util.PathAsSuffix(input_dir, self._input_root))
+            # The output root itself isn't listed in the manifest.
+            rel_dir = util.PathAsSuffix(input_dir, self._input_root)
+            if rel_dir and self._NewDirectory(rel_dir):
+                yield self._Generated(rel_dir)
 
-            # Process each file.
-            for file in files:
-                self._ProcessFile(os.path.join(input_dir, file))
+            # Process each file, reusing the walker's stat results.
+            for entry in files:
+                for output in self._ProcessFile(entry.path, entry.stat()):
+                    if (os.path.isdir(os.path.join(self._output_root,
+                                                   output)) and
+                        not self._NewDirectory(output)):
+                        continue
+                    yield self._Generated(output)
 
-            # Filter directories to process.
-            dirs[:] = [d for d in dirs if d[0] not in ('.', '_')]
+    def _NewDirectory(self, rel_dir):
+        """Return True the first time an output directory is generated.
+
+        Several fanout specs, or a spec and an input directory, can
+        generate the same directory, which must be listed only once.
+        """
+        if rel_dir in self._output_dirs:
+            return False
+        self._output_dirs.add(rel_dir)
+        return True
+
+    def _Generated(self, output):
+        if self._generated is not None:
+            self._generated.add(output)
+        return output
+
+    def _ProcessFile(self, input_path, st=None):
+        if self._seen is not None:
+            self._seen.add(input_path)
+
+        if self._incremental:
+            outputs = self._index.Outputs(input_path, st)
+            if outputs is not None and all(
+                os.path.lexists(os.path.join(self._output_root, o))
+                for o in outputs):
+                return outputs
 
-    def _ProcessFile(self, input_path):
         for processor in self._processors:
             if processor.CanProcessFile(input_path):
                 output_path = self._InputToOutput(input_path)
-                if processor.ProcessFile(input_path, output_path):
-                    self._manifest.append(
-                        util.PathAsSuffix(output_path, self._output_root))
-                return
+                cache_key = self._CacheKey(processor, input_path)
+                processed = None
+                self._deps.Begin(input_path)
+                if self._memory_profiler is not None:
+                    self._memory_profiler.Begin()
+                try:
+                    if cache_key:
+                        processed = self._output_cache.Fetch(
+                            cache_key, self._ctx, self._output_root,
+                            self._writer, self._deps)
+                    if processed is None:
+                        processed = processor.ProcessFile(input_path,
+                                                          output_path)
+                        if processed is True:
+                            processed = [output_path]
+                        if cache_key:
+                            store = (
+                                cache_key, self._ctx, self._output_root,
+                                processed or [],
+                                self._deps.Dependencies(input_path),
+                                self._deps.ContextDependencies(input_path))
+                            if processor.ASYNCHRONOUS:
+                                self._pending_stores.append(store)
+                            else:
+                                self._output_cache.Store(*store)
+                finally:
+                    self._deps.End()
+                    if self._memory_profiler is not None:
+                        self._memory_profiler.End(processor.CacheName(),
+                                                  input_path)
+                outputs = [util.PathAsSuffix(path, self._output_root)
+                           for path in processed or []]
+                if self._keep_index:
+                    self._index.Update(input_path,
+                                       self._deps.Dependencies(input_path),
+                                       outputs, st)
+                else:
+                    self._deps.Forget(input_path)
+                if outputs:
+                    self._processed += 1
+                return outputs
 
         raise NoProcessorFound(input_path)
 
-    def _OutputManifest(self):
-        if not self._manifest_path:
+    def _CacheKey(self, processor, input_path):
+        if self._output_cache is None or not processor.CACHEABLE:
+            return None
+        return self._output_cache.Key(processor, input_path, self._ctx)
+
+    def _ForgetMissingInputs(self):
+        for path in self._index.Paths():
+            if path not in self._seen:
+                self._index.Forget(path)
+                self._deps.Forget(path)
+
+    def _PruneOutputs(self):
+        """Remove anything in the output root that wasn't generated."""
+        generated = self._generated
+        for output_dir, dirs, files in os.walk(self._output_root,
+                                               topdown=False):
+            for name in files + dirs:
+                path = os.path.join(output_dir, name)
+                if util.PathAsSuffix(path, self._output_root) in generated:
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    if not os.listdir(path):
+                        os.rmdir(path)
+                else:
+                    os.remove(path)
+
+    def SaveIndex(self, path):
+        """Save what this generator knows about its latest output root.
+
+        Another generator can load it with LoadIndex, to regenerate
+        files incrementally, or with GenerateFiles.
+        """
+        import json
+
+        if self._index_root is None:
+            return
+        util.WriteFileContent(path, json.dumps({
+            'input_root': self._input_root,
+            'output_root': self._index_root,
+            'index': self._index.Export(),
+            }))
+
+    def LoadIndex(self, path):
+        """Load an index saved by SaveIndex, if it exists.
+
+        The index is ignored if it was saved for another input tree.
+        """
+        import json
+
+        try:
+            saved = json.loads(util.ReadFileContent(path))
+        except util.FileNotFoundError:
             return
+        if saved['input_root'] != self._input_root:
+            return
+
+        self._index.Import(saved['index'])
+        self._index_root = saved['output_root'].encode('utf-8')
+        for input_path in self._index.Paths():
+            self._deps.Begin(input_path)
+            for dep_path in self._index.Dependencies(input_path):
+                self._deps.Record(dep_path)
+            self._deps.End()
+
+    def WrittenOutputs(self):
+        """Return the output paths written by the latest generation.
+
+        Paths are relative to the output root. Outputs whose content
+        didn't change are not included.
+        """
+        return [util.PathAsSuffix(path, self._index_root)
+                for path in self._writer.written_paths]
+
+    def WriteCounts(self):
+        """Return the number of outputs written and left unchanged.
+
+        The counts are those of the latest generation.
+        """
+        return self._writer.written, self._writer.unchanged
+
+    def Dependents(self, paths):
+        """Return the input files affected by changes to the given files.
 
-        # Append '' to get an \n at the end of the file, and remove
-        # the first entry because it's the '' for the output root.
-        self._manifest.append('')
-        util.WriteFileContent(self._manifest_path,
-                              '\n'.join(self._manifest[1:]))
+        Only dependencies recorded by previous generations are known.
+        """
+        return self._deps.Dependents(os.path.abspath(p) for p in paths)
 
     def _InputToOutput(self, path):
         return util.RelocatePath(path, self._input_root, self._output_root)
@@ -0,0 +1,178 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Memory usage profiling of website generation.
+
+The profiler samples memory use around the processing of every input,
+and attributes to each processor and input the memory it retained
+(still in use once it was processed), and the amount by which it
+raised the peak memory use of the generation.
+
+Allocations are traced with the tracemalloc module when it is
+available (Python 2 needs the pytracemalloc patches for that), which
+also gives the top allocation sites at the end of the generation.
+Otherwise, the resident set size of the process is sampled, and the
+object types whose population grew the most are reported instead of
+allocation sites.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import gc
+import os
+import os.path
+import resource
+
+
+def _FormatBytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return '%d%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fGB' % size
+
+
+class _TracemallocSampler(object):
+    NAME = 'tracemalloc'
+
+    def __init__(self, tracemalloc):
+        self._tracemalloc = tracemalloc
+
+    def Start(self):
+        self._tracemalloc.start()
+
+    def Sample(self):
+        """Return (current, peak) memory use, in bytes."""
+        return self._tracemalloc.get_traced_memory()
+
+    def TopSites(self, top):
+        snapshot = self._tracemalloc.take_snapshot()
+        return ['%s: %s in %d blocks' % (stat.traceback[0],
+                                         _FormatBytes(stat.size), stat.count)
+                for stat in snapshot.statistics('lineno')[:top]]
+
+    def Stop(self):
+        self._tracemalloc.stop()
+
+
+class _RssSampler(object):
+    NAME = 'resident set size'
+
+    def Start(self):
+        self._types = self._CountTypes()
+
+    def Sample(self):
+        # ru_maxrss is in kilobytes on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        try:
+            f = open('/proc/self/statm')
+            try:
+                current = int(f.read().split()[1]) * resource.getpagesize()
+            finally:
+                f.close()
+        except (IOError, ValueError, IndexError):
+            current = peak
+        return current, peak
+
+    def _CountTypes(self):
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def TopSites(self, top):
+        counts = self._CountTypes()
+        growth = sorted(((count - self._types.get(name, 0), name)
+                         for name, count in counts.iteritems()),
+                        reverse=True)[:top]
+        return ['%s: %+d objects' % (name, delta)
+                for delta, name in growth if delta > 0]
+
+    def Stop(self):
+        del self._types
+
+
+class _Usage(object):
+    def __init__(self):
+        self.inputs = 0
+        self.retained = 0
+        self.peak_raise = 0
+
+
+class MemoryProfiler(object):
+    """Attributes memory use to processors and inputs."""
+    def __init__(self, top=10):
+        self._top = top
+        try:
+            import tracemalloc
+        except ImportError:
+            self._sampler = _RssSampler()
+        else:
+            self._sampler = _TracemallocSampler(tracemalloc)
+        self._processors = {}
+        self._inputs = []
+        self._sample = None
+
+    def Start(self):
+        self._sampler.Start()
+        self._start = self._sampler.Sample()
+
+    def Begin(self):
+        """Called before an input is processed."""
+        self._sample = self._sampler.Sample()
+
+    def End(self, processor_name, input_path):
+        """Called once input_path was processed by the named processor."""
+        current, peak = self._sampler.Sample()
+        before_current, before_peak = self._sample
+        retained = current - before_current
+        peak_raise = peak - before_peak
+
+        usage = self._processors.setdefault(processor_name, _Usage())
+        usage.inputs += 1
+        usage.retained += retained
+        usage.peak_raise += peak_raise
+        self._inputs.append((peak_raise, retained, input_path,
+                             processor_name))
+        # Only keep the inputs worth reporting.
+        if len(self._inputs) > 4 * self._top:
+            self._inputs.sort(reverse=True)
+            del self._inputs[self._top:]
+
+    def Stop(self):
+        self._end = self._sampler.Sample()
+        self._sites = self._sampler.TopSites(self._top)
+        self._sampler.Stop()
+
+    def Report(self, out):
+        """Write the profile gathered between Start and Stop to out."""
+        start_current, _ = self._start
+        end_current, peak = self._end
+        out.write('Memory profile (%s):\n' % self._sampler.NAME)
+        out.write('  peak %s, retained %s\n' % (
+            _FormatBytes(peak), _FormatBytes(end_current - start_current)))
+
+        out.write('\nBy processor:\n')
+        for name, usage in sorted(self._processors.iteritems(),
+                                  key=lambda i: -i[1].peak_raise):
+            out.write('  %-30s %6d inputs  peak +%-8s retained %s\n' % (
+                name, usage.inputs, _FormatBytes(usage.peak_raise),
+                _FormatBytes(usage.retained)))
+
+        out.write('\nInputs raising the peak the most:\n')
+        for peak_raise, retained, path, name in sorted(
+            self._inputs, reverse=True)[:self._top]:
+            size = os.path.exists(path) and os.path.getsize(path) or 0
+            out.write('  peak +%-8s retained %-8s %s (%s, %s)\n' % (
+                _FormatBytes(peak_raise), _FormatBytes(retained), path,
+                _FormatBytes(size), name))
+
+        if self._sampler.NAME == 'tracemalloc':
+            out.write('\nTop allocation sites:\n')
+        else:
+            out.write('\nObject types that grew the most:\n')
+        for site in self._sites:
+            out.write('  %s\n' % site)
@@ -0,0 +1,195 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Build metrics, exported for monitoring.
+
+Modules register counters, gauges and histograms in the process-wide
+REGISTRY, and update them once per operation (a generation, a deploy,
+a garbage collection...), never per file, so collecting them costs
+next to nothing.
+
+At the end of a command, the registry can be written out as a
+Prometheus node exporter textfile, and/or as a JSON summary, as given
+on the command line or by the TEXTFILE_ENV and JSON_ENV environment
+variables. Both are replaced atomically, so collectors never read a
+partial file.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+
+import odict
+import util
+
+
+# The environment variables naming the files to export metrics to,
+# when not given on the command line.
+TEXTFILE_ENV = 'PYWEBGEN_METRICS_TEXTFILE'
+JSON_ENV = 'PYWEBGEN_METRICS_JSON'
+
+# Histogram buckets suited to durations of builds and deploys.
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600)
+
+
+def _LabelKey(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _FormatLabels(label_key):
+    if not label_key:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in label_key)
+
+
+def _FormatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+
+    def _Samples(self):
+        """Yield (name suffix, label key, value) for each sample."""
+        for label_key, value in sorted(self._values.iteritems()):
+            yield '', label_key, value
+
+    def Textfile(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        for suffix, label_key, value in self._Samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _FormatLabels(label_key),
+                                        _FormatValue(value)))
+        return '\n'.join(lines)
+
+    def Summary(self):
+        return {'type': self.TYPE, 'help': self.help,
+                'values': [{'labels': dict(label_key), 'value': value}
+                           for label_key, value in
+                           sorted(self._values.iteritems())]}
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def Inc(self, value=1, **labels):
+        key = _LabelKey(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def Set(self, value, **labels):
+        self._values[_LabelKey(labels)] = value
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        _Metric.__init__(self, name, help)
+        self._buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def Observe(self, value, **labels):
+        key = _LabelKey(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per bucket counts, sum and count.
+            state = self._values[key] = [[0] * len(self._buckets), 0, 0]
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def _Buckets(self, counts):
+        """Yield (upper bound, cumulative count) for each bucket."""
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            yield _FormatValue(bound), cumulative
+
+    def _Samples(self):
+        for label_key, (counts, total, count) in sorted(
+            self._values.iteritems()):
+            for bound, cumulative in self._Buckets(counts):
+                yield '_bucket', label_key + (('le', bound),), cumulative
+            yield '_sum', label_key, total
+            yield '_count', label_key, count
+
+    def Summary(self):
+        values = []
+        for label_key, (counts, total, count) in sorted(
+            self._values.iteritems()):
+            values.append({'labels': dict(label_key),
+                           'sum': total, 'count': count,
+                           'buckets': dict(self._Buckets(counts))})
+        return {'type': self.TYPE, 'help': self.help, 'values': values}
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = odict.OrderedDict()
+
+    def _Register(self, cls, name, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args)
+        return metric
+
+    def Counter(self, name, help):
+        return self._Register(Counter, name, help)
+
+    def Gauge(self, name, help):
+        return self._Register(Gauge, name, help)
+
+    def Histogram(self, name, help, buckets=DURATION_BUCKETS):
+        return self._Register(Histogram, name, help, buckets)
+
+    def Textfile(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        # Metrics nothing updated are left out.
+        return ''.join('%s\n' % m.Textfile()
+                       for m in self._metrics.itervalues() if m._values)
+
+    def Summary(self):
+        """Return the metrics as a dict, for JSON serialization."""
+        return dict((m.name, m.Summary())
+                    for m in self._metrics.itervalues() if m._values)
+
+    def WriteTextfile(self, path):
+        util.WriteFileContent(path, self.Textfile())
+
+    def WriteJson(self, path):
+        import json
+
+        util.WriteFileContent(path, json.dumps(self.Summary(), indent=2,
+                                               sort_keys=True) + '\n')
+
+
+# The registry used by all pyweb modules.
+REGISTRY = Registry()
+
+
+def Export(textfile=None, json_file=None):
+    """Write REGISTRY to the given files, or to those from the environment."""
+    textfile = textfile or os.environ.get(TEXTFILE_ENV)
+    json_file = json_file or os.environ.get(JSON_ENV)
+    if textfile:
+        REGISTRY.WriteTextfile(textfile)
+    if json_file:
+        REGISTRY.WriteJson(json_file)
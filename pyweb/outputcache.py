@@ -0,0 +1,348 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Persistent cache of processor outputs.
+
+Generating a new version of a website processes every input again,
+even though most of them usually didn't change since the previous
+version. The output cache remembers what each processor made of each
+input, so that unchanged inputs can have their outputs linked into
+place instead.
+
+An input's cache key combines the processor's name and version, the
+input's path, content and mode, and the context values the processor
+says its output depends on. Under that key, the cache stores the
+digest of every dependency the processor recorded, the context values
+it used (such as a template showing the timestamp), and the digests of
+the outputs it wrote. A cached result is only reused if all its
+dependencies and context values are still the same.
+
+Output contents are stored once each, named by their digest, and hard
+linked into output trees when possible. This makes the cache cheap to
+share between versions and site containers, and makes identical
+outputs of different versions share disk space.
+
+The cache is kept under a size budget by evicting the least recently
+used contents. Once the budget is exceeded, contents are evicted until
+the cache is well under it, so that eviction doesn't run on every
+store of a full cache.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import errno
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import stat
+import time
+
+import util
+
+
+# The environment variable naming the default cache directory.
+CACHE_DIR_ENV = 'PYWEBGEN_CACHE_DIR'
+
+# The default size budget of a cache.
+MAX_BYTES = 512 * 1024 * 1024
+
+# The fraction of its budget a full cache is pruned down to.
+PRUNE_RATIO = 0.8
+
+_OBJECTS_DIR = 'objects'
+_ENTRIES_DIR = 'entries'
+_COUNTS_FILE = 'counts.json'
+_BLOCK_SIZE = 64 * 1024
+
+
+def _HashFile(path):
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), ''):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _ShardedPath(root, name):
+    return os.path.join(root, name[:2], name)
+
+
+class OutputCache(object):
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+        self._dir = os.path.abspath(cache_dir)
+        self._objects_dir = os.path.join(self._dir, _OBJECTS_DIR)
+        self._entries_dir = os.path.join(self._dir, _ENTRIES_DIR)
+        self._max_bytes = max_bytes
+        self._digests = {}
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+
+    def _Digest(self, path):
+        """Return the digest of a file or directory, None if it's missing.
+
+        Directories are summarized by the names they contain. Digests
+        are remembered along with the stat signature of the path.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        cached = self._digests.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        if stat.S_ISDIR(st.st_mode):
+            listing = '\0'.join(sorted(os.listdir(path)))
+            digest = hashlib.sha1(listing).hexdigest()
+        else:
+            digest = _HashFile(path)
+        self._digests[path] = (stamp, digest)
+        return digest
+
+    def Key(self, processor, input_path, ctx):
+        """Return the cache key of processing input_path with processor."""
+        st = os.stat(input_path)
+        parts = [processor.CacheName(),
+                 util.PathAsSuffix(input_path, ctx['input_root']),
+                 self._Digest(input_path),
+                 str(stat.S_IMODE(st.st_mode))]
+        parts.extend(repr(ctx.get(k)) for k in processor.CACHE_CONTEXT)
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def Fetch(self, key, ctx, output_root, writer, dependencies):
+        """Materialize the cached outputs for key into output_root.
+
+        On a hit, the cached dependencies and context values are
+        recorded again for the current input, and outputs are written
+        through writer, so that unchanged outputs are left alone.
+
+        Returns:
+          The list of output paths, or None if nothing usable is
+          cached for key.
+        """
+        entry_path = _ShardedPath(self._entries_dir, key)
+        try:
+            entry = json.loads(util.ReadFileContent(entry_path))
+        except (util.FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+
+        for name, value in entry.get('context', ()):
+            if repr(ctx.get(name)) != value:
+                self.misses += 1
+                return None
+
+        input_root = ctx['input_root']
+        dep_paths = [os.path.join(input_root, path)
+                     for path, _ in entry['dependencies']]
+        for path, (_, digest) in zip(dep_paths, entry['dependencies']):
+            if self._Digest(path) != digest:
+                self.misses += 1
+                return None
+        for _, digest, _ in entry['outputs']:
+            if digest and not os.path.isfile(
+                _ShardedPath(self._objects_dir, digest)):
+                # Evicted content, the entry is useless now.
+                os.remove(entry_path)
+                self.misses += 1
+                return None
+
+        for path in dep_paths:
+            dependencies.Record(path)
+        for name, _ in entry.get('context', ()):
+            dependencies.RecordContext(name)
+
+        now = time.time()
+        outputs = []
+        for rel_path, digest, mode in entry['outputs']:
+            path = os.path.join(output_root, rel_path)
+            if digest is None:
+                util.CreateDir(path)
+            else:
+                object_path = _ShardedPath(self._objects_dir, digest)
+                writer.LinkFile(object_path, path, digest, mode)
+            outputs.append(path)
+        # Entry mtimes order the LRU eviction. Objects can't be used
+        # for that, they share their mtime with the outputs linked to
+        # them.
+        os.utime(entry_path, (now, now))
+
+        self.hits += 1
+        return outputs
+
+    def Store(self, key, ctx, output_root, outputs, dep_paths,
+              context_names=()):
+        """Remember the outputs and dependencies of processing an input.
+
+        context_names are the context values the processing used.
+        """
+        input_root = ctx['input_root']
+        entry = {'dependencies': [], 'outputs': [],
+                 'context': [(name, repr(ctx.get(name)))
+                             for name in sorted(context_names)]}
+        for path in sorted(dep_paths):
+            # Dependencies are stored relative to the input root, so
+            # that copies of a site can share cached outputs.
+            entry['dependencies'].append(
+                (os.path.relpath(path, input_root), self._Digest(path)))
+
+        for path in outputs:
+            rel_path = util.PathAsSuffix(path, output_root)
+            if os.path.isdir(path):
+                entry['outputs'].append((rel_path, None, None))
+                continue
+            if not os.path.isfile(path):
+                return
+            digest = self._Digest(path)
+            self._StoreObject(path, digest)
+            entry['outputs'].append(
+                (rel_path, digest, stat.S_IMODE(os.stat(path).st_mode)))
+
+        entry_path = _ShardedPath(self._entries_dir, key)
+        util.CreateDir(os.path.dirname(entry_path))
+        util.WriteFileContent(entry_path, json.dumps(entry))
+
+        # The size is kept up to date as objects are stored, so the
+        # cache is only scanned when it is actually pruned.
+        if self._max_bytes and self._Size() > self._max_bytes:
+            self.Prune(int(self._max_bytes * PRUNE_RATIO))
+
+    def _StoreObject(self, path, digest):
+        object_path = _ShardedPath(self._objects_dir, digest)
+        if os.path.exists(object_path):
+            return
+        util.CreateDir(os.path.dirname(object_path))
+        tmp_path = '%s.%d.tmp' % (object_path, os.getpid())
+        try:
+            os.link(path, tmp_path)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy(path, tmp_path)
+        os.rename(tmp_path, object_path)
+        if self._size is not None:
+            self._size += os.path.getsize(object_path)
+
+    def _Objects(self):
+        """Yield (digest, size, path) for every stored object."""
+        if not os.path.isdir(self._objects_dir):
+            return
+        for shard in os.listdir(self._objects_dir):
+            shard_dir = os.path.join(self._objects_dir, shard)
+            for name in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, name)
+                yield name, os.path.getsize(path), path
+
+    def _Entries(self):
+        if not os.path.isdir(self._entries_dir):
+            return
+        for shard in os.listdir(self._entries_dir):
+            shard_dir = os.path.join(self._entries_dir, shard)
+            for name in os.listdir(shard_dir):
+                yield os.path.join(shard_dir, name)
+
+    def _Size(self):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._Objects())
+        return self._size
+
+    def Prune(self, max_bytes=None):
+        """Evict the least recently used contents until under max_bytes.
+
+        An object was last used when the most recently used entry
+        referring to it was. Entries referring to evicted objects are
+        removed along with them.
+
+        Returns:
+          The number of bytes evicted.
+        """
+        if max_bytes is None:
+            max_bytes = self._max_bytes
+
+        entries = []
+        last_used = {}
+        for path in self._Entries():
+            try:
+                entry = json.loads(util.ReadFileContent(path))
+            except ValueError:
+                os.remove(path)
+                continue
+            mtime = os.path.getmtime(path)
+            digests = [d for _, d, _ in entry['outputs'] if d]
+            for digest in digests:
+                last_used[digest] = max(last_used.get(digest, 0), mtime)
+            entries.append((path, digests))
+
+        # Objects no entry refers to go first.
+        objects = sorted((last_used.get(digest, 0), size, path, digest)
+                         for digest, size, path in self._Objects())
+        size = sum(o[1] for o in objects)
+        evicted = 0
+        evicted_digests = set()
+        for _, object_size, path, digest in objects:
+            if size - evicted <= max_bytes:
+                break
+            os.remove(path)
+            evicted += object_size
+            evicted_digests.add(digest)
+
+        for path, digests in entries:
+            if not evicted_digests.isdisjoint(digests):
+                os.remove(path)
+
+        self._size = size - evicted
+        return evicted
+
+    def Stats(self):
+        """Return a dict describing the content and use of the cache."""
+        objects = list(self._Objects())
+        stats = {
+            'directory': self._dir,
+            'entries': sum(1 for _ in self._Entries()),
+            'objects': len(objects),
+            'bytes': sum(size for _, size, _ in objects),
+            'max_bytes': self._max_bytes,
+            }
+        stats.update(self._ReadCounts())
+        return stats
+
+    def _ReadCounts(self):
+        try:
+            return json.loads(util.ReadFileContent(
+                os.path.join(self._dir, _COUNTS_FILE)))
+        except (util.FileNotFoundError, ValueError):
+            return {'hits': 0, 'misses': 0}
+
+    def SaveCounts(self):
+        """Add the hits and misses seen so far to the persistent totals."""
+        if not self.hits and not self.misses:
+            return
+        counts = self._ReadCounts()
+        counts['hits'] += self.hits
+        counts['misses'] += self.misses
+        util.CreateDir(self._dir)
+        util.WriteFileContent(os.path.join(self._dir, _COUNTS_FILE),
+                              json.dumps(counts))
+        self.hits = self.misses = 0
+
+
+def Open(cache_dir=None, max_bytes=MAX_BYTES):
+    """Return the OutputCache in cache_dir, or in the default directory.
+
+    Returns:
+      The OutputCache, or None if no directory was given and
+      CACHE_DIR_ENV is not set.
+    """
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    return OutputCache(cache_dir, max_bytes)
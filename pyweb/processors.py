@@ -7,10 +7,15 @@
 
 __author__ = 'David Anderson <dave@natulte.net>'
 
+import collections
+import cStringIO
+import hashlib
 import os.path
-import shutil
 
+import deps
 import error
+import filters
+import odict
 import util
 
 
@@ -18,22 +23,162 @@ class UnknownProcessor(error.Error):
     """Unknown input processor."""
 
 
+class InvalidPipeline(error.Error):
+    """The processor at the head of a pipeline does not stream its output."""
+
+
+class ImageError(error.Error):
+    """An image could not be processed."""
+
+
+# The number of compiled templates shared between Jinja2 environments.
+BYTECODE_CACHE_SIZE = 1024
+
+# The context values templates see. srcset and bundle are helpers,
+# only there when the Image and Bundle processors are used.
+_TEMPLATE_CONTEXT = ('timestamp', 'input_root', 'output_root', 'data',
+                     'srcset', 'bundle')
+
+# The context values templates can use that may change between
+# generations. Templates record their use of these.
+_GENERATION_CONTEXT = frozenset(['timestamp', 'input_root', 'output_root'])
+
+_bytecode_cache = None
+
+
+def _SharedBytecodeCache():
+    """Return the Jinja2 bytecode cache shared by all environments.
+
+    Compiled templates are keyed by name and source, rather than by
+    file, so that sites sharing a theme in one process (such as a
+    batch generation) only compile it once.
+    """
+    global _bytecode_cache
+    if _bytecode_cache is not None:
+        return _bytecode_cache
+
+    import jinja2.bccache
+
+    class SharedBytecodeCache(jinja2.bccache.BytecodeCache):
+        def __init__(self):
+            self._code = odict.OrderedDict()
+
+        def get_bucket(self, environment, name, filename, source):
+            checksum = self.get_source_checksum(source)
+            key = hashlib.sha1('%s\0%s' % (name, checksum)).hexdigest()
+            bucket = jinja2.bccache.Bucket(environment, key, checksum)
+            self.load_bytecode(bucket)
+            return bucket
+
+        def load_bytecode(self, bucket):
+            code = self._code.get(bucket.key)
+            if code is not None:
+                bucket.code = code
+
+        def dump_bytecode(self, bucket):
+            self._code[bucket.key] = bucket.code
+            if len(self._code) > BYTECODE_CACHE_SIZE:
+                del self._code[self._code.keys()[0]]
+
+    _bytecode_cache = SharedBytecodeCache()
+    return _bytecode_cache
+
+
+def _JinjaEnvironment(input_root, dependencies, template_archive=None):
+    """Create a Jinja2 environment recording loaded templates.
+
+    Templates also record which of the _GENERATION_CONTEXT values
+    they use.
+
+    If template_archive is given, templates are loaded from that
+    precompiled archive whenever it is up to date. Otherwise, compiled
+    templates come from the process-wide bytecode cache.
+    """
+    import jinja2
+    import jinja2.runtime
+    import templates
+
+    class RecordingContext(jinja2.runtime.Context):
+        def resolve_or_missing(self, key):
+            if key in _GENERATION_CONTEXT:
+                dependencies.RecordContext(key)
+            return jinja2.runtime.Context.resolve_or_missing(self, key)
+
+    class RecordingEnvironment(jinja2.Environment):
+        context_class = RecordingContext
+
+        def get_template(self, name, parent=None, globals=None):
+            template = jinja2.Environment.get_template(self, name, parent,
+                                                       globals)
+            dependencies.Record(template.filename)
+            return template
+
+    if template_archive:
+        loader = templates.Loader(input_root, template_archive)
+    else:
+        loader = jinja2.FileSystemLoader(input_root)
+    return RecordingEnvironment(loader=loader,
+                                bytecode_cache=_SharedBytecodeCache())
+
+
 class _Processor(object):
     """Base class for file processors."""
+    # Whether outputs can be reused from the output cache. The cache
+    # assumes the outputs only depend on the input, the dependencies
+    # the processor records, the CACHE_CONTEXT context values, and the
+    # context values recorded with the dependencies' RecordContext.
+    CACHEABLE = True
+    # Bump when a change to the processor changes its outputs.
+    CACHE_VERSION = 1
+    CACHE_CONTEXT = ()
+    # Whether ProcessFile may return before its outputs are written,
+    # in which case they are written by the time Finish returns.
+    ASYNCHRONOUS = False
+
+    def CacheName(self):
+        """Return the name identifying this processor in the output cache."""
+        return '%s/%d' % (type(self).__name__, self.CACHE_VERSION)
+
     def StartProcessing(self, ctx):
         """Called once the context is established, before generation begins."""
-        pass
+        self._ctx = ctx
 
     def CanProcessFile(self, filename):
         """Called to determine if this processor is suitable for a file."""
         raise NotImplementedError()
 
     def ProcessFile(self, in_path, out_path):
+        """Process in_path into out_path.
+
+        The default implementation streams the input through
+        ProcessStream and writes chunks to out_path as they are
+        produced. Processors that work on whole strings override
+        this method instead, and should write through the context's
+        'output' OutputWriter.
+
+        Returns:
+          True if out_path was written, a false value if nothing was
+          output, or a list of the output paths written, in manifest
+          order (directories before the files they contain).
+        """
+        in_file = util.OpenFileStream(in_path)
+        try:
+            self._ctx['output'].WriteChunks(
+                out_path, self.ProcessStream(in_file, in_path))
+        finally:
+            in_file.close()
+        return True
+
+    def ProcessStream(self, in_file, in_path):
+        """Process an input file object into an iterable of unicode chunks."""
         raise NotImplementedError()
 
+    def Finish(self):
+        """Called once every input file was given to ProcessFile."""
+
     def EndProcessing(self):
         """Called after generation of all files has finished."""
-        pass
+        del self._ctx
 
 
 #
@@ -48,28 +193,96 @@ class HtmlJinjaProcessor(_Processor):
             raise error.MissingPythonModule('jinja2')
 
     def StartProcessing(self, ctx):
-        import jinja2
         self._ctx = ctx
-        loader = jinja2.FileSystemLoader(ctx['input_root'])
-        self._env = jinja2.Environment(loader=loader)
+        # Keep the environment, and its template cache, across
+        # generations of the same input tree, unless the precompiled
+        # templates changed.
+        archive = ctx.get('template_archive')
+        env_key = (ctx['input_root'], ctx['dependencies'],
+                   archive and deps.Stamp(archive))
+        if getattr(self, '_env_key', None) != env_key:
+            self._env = _JinjaEnvironment(ctx['input_root'],
+                                          ctx['dependencies'], archive)
+            self._env_key = env_key
 
     def CanProcessFile(self, filename):
         return filename.endswith('.html')
 
-    def ProcessFile(self, in_path, out_path):
-        # Assuming UTF-8, else screw you.
-        in_str = util.ReadFileContent(in_path)
+    def _TemplateContext(self):
+        """Return the context values templates see.
+
+        The rest of the generation context (the output writer, the
+        dependency graph...) is internal to processors.
+        """
+        return dict((name, self._ctx[name]) for name in _TEMPLATE_CONTEXT
+                    if name in self._ctx)
+
+    def ProcessStream(self, in_file, in_path):
+        name = util.PathAsSuffix(in_path, self._ctx['input_root'])
+        if in_file is None or getattr(in_file, 'name', None) == in_path:
+            # Pages read from their source file are loaded by name
+            # instead, so that they can come precompiled, and stay
+            # cached in the environment across generations.
+            template = self._env.get_template(name)
+        else:
+            code = self._env.compile(in_file.read(), name, in_path)
+            template = self._env.template_class.from_code(
+                self._env, code, self._env.make_globals(None))
+        return template.generate(**self._TemplateContext())
 
-        template = self._env.from_string(in_str)
-        out_str = template.render(**self._ctx)
+    def EndProcessing(self):
+        del self._ctx
 
-        util.WriteFileContent(out_path, out_str)
 
-        return True
+class FanoutProcessor(HtmlJinjaProcessor):
+    """Render a Jinja2 template to many pages, as described by a spec."""
+    def __init__(self):
+        HtmlJinjaProcessor.__init__(self)
+        # This import will make the processor fail at instanciation
+        # time if the fanout module is missing dependencies.
+        import fanout
 
-    def EndProcessing(self):
-        del self._env
-        del self._ctx
+    def CanProcessFile(self, filename):
+        return filename.endswith('.fanout')
+
+    def ProcessFile(self, in_path, out_path):
+        import fanout
+
+        spec = fanout.Spec(in_path)
+        dependencies = self._ctx['dependencies']
+        # The template is compiled once, and rendered for every page.
+        template = self._env.get_template(spec.template)
+
+        out_dir = os.path.dirname(out_path)
+        outputs = []
+        created_dirs = set()
+        items = spec.Items(self._ctx['data'], dependencies)
+        template_ctx = self._TemplateContext()
+        for suffix, page_ctx in spec.Pages(items):
+            page_path = os.path.normpath(os.path.join(out_dir, suffix))
+            if not page_path.startswith(out_dir + os.sep):
+                raise fanout.FanoutSpecError('%s: output %s escapes the '
+                                             'spec directory' %
+                                             (in_path, suffix))
+
+            # Record any new directories before the pages they contain.
+            parent = os.path.dirname(page_path)
+            new_dirs = []
+            while parent != out_dir and parent not in created_dirs:
+                new_dirs.append(parent)
+                created_dirs.add(parent)
+                parent = os.path.dirname(parent)
+            for d in reversed(new_dirs):
+                util.CreateDir(d)
+                outputs.append(d)
+
+            ctx = dict(template_ctx)
+            ctx.update(page_ctx)
+            self._ctx['output'].WriteChunks(page_path,
+                                            template.generate(**ctx))
+            outputs.append(page_path)
+
+        return outputs
 
 
 class CssYamlProcessor(_Processor):
@@ -85,25 +298,447 @@ class CssYamlProcessor(_Processor):
     def CanProcessFile(self, filename):
         return filename.endswith('.css')
 
-    def ProcessFile(self, in_path, out_path):
+    def ProcessStream(self, in_file, in_path):
         import cssyaml
 
-        css = cssyaml.GenerateCss(util.ReadFileContent(in_path),
-                                  self._ctx['timestamp'])
+        self._ctx['dependencies'].RecordContext('timestamp')
+        return cssyaml.GenerateCssChunks(in_file, self._ctx['timestamp'])
 
-        util.WriteFileContent(out_path, css)
+    def EndProcessing(self):
+        del self._ctx
 
-        return True
+
+def _ImportPil():
+    try:
+        from PIL import Image
+    except ImportError:
+        try:
+            import Image
+        except ImportError:
+            raise error.MissingPythonModule('PIL')
+    return Image
+
+
+def _VariantPath(path, width):
+    """Return the path of the variant of an image resized to width."""
+    base, ext = os.path.splitext(path)
+    return '%s-%dw%s' % (base, width, ext)
+
+
+def _EncodeImage(args):
+    """Recompress an image, and encode its variants of the given widths.
+
+    Runs in the image processor's worker processes. The image is only
+    decoded once.
+
+    Returns:
+      The list of encoded images, as byte strings: the image itself,
+      then its variants.
+    """
+    in_path, widths, quality = args
+    Image = _ImportPil()
+
+    try:
+        image = Image.open(in_path)
+        image_format = image.format
+        image.load()
+        resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+        encoded = []
+        for width in [None] + list(widths):
+            resized = image
+            if width:
+                height = max(1, image.size[1] * width // image.size[0])
+                resized = image.resize((width, height), resample)
+
+            out = cStringIO.StringIO()
+            if image_format == 'JPEG':
+                if resized.mode not in ('RGB', 'L'):
+                    resized = resized.convert('RGB')
+                resized.save(out, 'JPEG', quality=quality, optimize=True,
+                             progressive=True)
+            else:
+                resized.save(out, image_format, optimize=True)
+            encoded.append(out.getvalue())
+        return encoded
+    except error.Error:
+        raise
+    except Exception, e:
+        # PIL reports broken images with all sorts of exceptions.
+        raise ImageError('%s: %s' % (in_path, e))
+
+
+class ImageProcessor(_Processor):
+    """Recompress JPEG and PNG images, and make smaller variants of them.
+
+    An image wider than some of the configured widths also gets a
+    variant resized to each of them, named with a -<width>w suffix
+    (photo.jpg gets photo-640w.jpg...). Widths and JPEG quality are
+    taken from the site data file _data/images.yaml, if it exists,
+    and default to WIDTHS and QUALITY.
+
+    Templates can list an image and its variants with the srcset
+    helper: srcset('/photos/photo.jpg') returns the value of a srcset
+    attribute for that image. Paths given to the helper are relative
+    to the root of the site.
+
+    Images are encoded by a pool of worker processes, each job
+    decoding one image and encoding all of its variants. ProcessFile
+    only submits the job, and outputs are written as jobs complete,
+    all of them by the time Finish returns. Combined with an output
+    cache, unchanged images are never processed again.
+    """
+    WIDTHS = (320, 640, 1024, 1600)
+    QUALITY = 85
+    # The number of worker processes, defaults to the number of CPUs.
+    JOBS = None
+    # The number of submitted images per worker process, beyond which
+    # ProcessFile waits for encoded images to be written.
+    BACKLOG = 2
+    ASYNCHRONOUS = True
+
+    def __init__(self):
+        # Fail at instanciation time if PIL is missing.
+        _ImportPil()
+        self._pool = None
+        self._jobs = None
+
+    def StartProcessing(self, ctx):
+        self._ctx = ctx
+        ctx['srcset'] = self.SrcSet
+        # (input path, output paths, async result) of submitted images.
+        self._pending = collections.deque()
+
+    def CanProcessFile(self, filename):
+        return os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg',
+                                                         '.png')
+
+    def _Settings(self):
+        settings = self._ctx['data'].get('images') or {}
+        return (sorted(settings.get('widths', self.WIDTHS)),
+                settings.get('quality', self.QUALITY))
+
+    def _Widths(self, in_path):
+        """Return the widths of the variants of an image."""
+        Image = _ImportPil()
+        try:
+            # Only reads the image header.
+            width = Image.open(in_path).size[0]
+        except Exception, e:
+            raise ImageError('%s: %s' % (in_path, e))
+        widths, _ = self._Settings()
+        return [w for w in widths if w < width], width
+
+    def ProcessFile(self, in_path, out_path):
+        import multiprocessing
+
+        widths, _ = self._Widths(in_path)
+        _, quality = self._Settings()
+        outputs = [out_path] + [_VariantPath(out_path, w) for w in widths]
+        job = (in_path, widths, quality)
+
+        if self._jobs is None:
+            self._jobs = self.JOBS or multiprocessing.cpu_count()
+        if self._jobs == 1:
+            self._Write(in_path, outputs, _EncodeImage(job))
+            return outputs
+
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._jobs)
+        self._pending.append((in_path, outputs,
+                              self._pool.apply_async(_EncodeImage, (job,))))
+        self._Collect(self._jobs * self.BACKLOG)
+        return outputs
+
+    def _Collect(self, max_pending=0):
+        """Write encoded images, until at most max_pending are left.
+
+        Images that are already encoded are written in any case.
+        """
+        while self._pending and (len(self._pending) > max_pending or
+                                 self._pending[0][2].ready()):
+            in_path, outputs, result = self._pending.popleft()
+            self._Write(in_path, outputs, result.get())
+
+    def _Write(self, in_path, outputs, images):
+        # Keep the original if recompressing didn't make it smaller.
+        if len(images[0]) >= os.path.getsize(in_path):
+            self._ctx['output'].CopyFile(in_path, outputs[0])
+        else:
+            self._ctx['output'].WriteChunks(outputs[0], [images[0]])
+        for path, image in zip(outputs[1:], images[1:]):
+            self._ctx['output'].WriteChunks(path, [image])
+
+    def Finish(self):
+        self._Collect()
+
+    def SrcSet(self, url):
+        """Return the srcset attribute value for an image and its variants."""
+        in_path = os.path.join(self._ctx['input_root'], url.lstrip('/'))
+        self._ctx['dependencies'].Record(in_path)
+        widths, width = self._Widths(in_path)
+        candidates = ['%s %dw' % (_VariantPath(url, w), w) for w in widths]
+        candidates.append('%s %dw' % (url, width))
+        return ', '.join(candidates)
+
+    def EndProcessing(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        del self._pending
+        del self._ctx
+
+
+class BundleProcessor(_Processor):
+    """Concatenate and minify scripts and stylesheets, as a spec says.
+
+    Bundles are built when their spec is processed, or when a template
+    first asks for their URL, and kept until one of the files they
+    depend on changes. Parsed specs are kept until they change.
+    """
+    def __init__(self):
+        # This import will make the processor fail at instanciation
+        # time if the bundles module is missing dependencies.
+        import bundles
+        self._built = {}
+        self._specs = {}
+        self._spec_names = {}
+
+    def StartProcessing(self, ctx):
+        self._ctx = ctx
+        ctx['bundle'] = self.BundleUrl
+
+    def CanProcessFile(self, filename):
+        return filename.endswith('.bundles')
+
+    def _Build(self, spec, name):
+        """Return the content of a bundle, building it if needed."""
+        import bundles
+
+        members = spec.bundles[name]
+        dependencies = self._ctx['dependencies']
+        for path in members:
+            dependencies.Record(path)
+        key = (spec.path, name)
+        built = self._built.get(key)
+        if built is not None and all(deps.Stamp(path) == stamp
+                                     for path, stamp in built[0]):
+            # The page depends on everything the bundle does.
+            for path, _ in built[0]:
+                dependencies.Record(path)
+            return built[1]
+
+        stamps = dict((path, deps.Stamp(path))
+                      for path in [spec.path] + members)
+        dependencies.StartCollecting()
+        try:
+            contents = self._BuildMembers(spec, members)
+        finally:
+            # Members can depend on more files, such as templates or
+            # site data.
+            for path in dependencies.StopCollecting():
+                if path not in stamps:
+                    stamps[path] = deps.Stamp(path)
+
+        content = bundles.Build(name, contents)
+        self._built[key] = (sorted(stamps.iteritems()), content)
+        return content
+
+    def _BuildMembers(self, spec, members):
+        """Return the generated content of the members of a bundle."""
+        import bundles
+
+        contents = []
+        for path in members:
+            if not path.startswith(self._ctx['input_root'] + os.sep):
+                raise bundles.BundleSpecError('%s: %s is outside the site' %
+                                              (spec.path, path))
+            if not os.path.isfile(path):
+                raise bundles.BundleSpecError('%s: missing member %s' %
+                                              (spec.path, path))
+            content = ProcessToString(self._ctx['processors'], path)
+            if content is None:
+                raise bundles.BundleSpecError('%s: %s is not generated as '
+                                              'a single file' %
+                                              (spec.path, path))
+            contents.append(content)
+        return contents
+
+    def ProcessFile(self, in_path, out_path):
+        import bundles
+
+        spec = self._Spec(in_path)
+        out_dir = os.path.dirname(out_path)
+        outputs = []
+        for name in sorted(spec.bundles):
+            content = self._Build(spec, name)
+            bundle_path = os.path.join(out_dir,
+                                       bundles.FingerprintedName(name, content))
+            self._ctx['output'].WriteChunks(bundle_path, [content])
+            outputs.append(bundle_path)
+        return outputs
+
+    def BundleUrl(self, url):
+        """Return the URL of the bundle at url, with its fingerprint."""
+        import bundles
+
+        path = os.path.join(self._ctx['input_root'], url.lstrip('/'))
+        spec_dir, name = os.path.split(path)
+        for spec_path in self._SpecPaths(spec_dir):
+            self._ctx['dependencies'].Record(spec_path)
+            spec = self._Spec(spec_path)
+            if name in spec.bundles:
+                content = self._Build(spec, name)
+                return (url[:len(url) - len(name)] +
+                        bundles.FingerprintedName(name, content))
+        raise bundles.BundleSpecError('no spec in %s defines %s' %
+                                      (spec_dir, name))
+
+    def _SpecPaths(self, spec_dir):
+        """Return the paths of the bundle specs in a directory."""
+        import bundles
+
+        if not os.path.isdir(spec_dir):
+            raise bundles.BundleSpecError('no spec directory %s' % spec_dir)
+        stamp = deps.Stamp(spec_dir)
+        cached = self._spec_names.get(spec_dir)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, [os.path.join(spec_dir, spec_name)
+                              for spec_name in sorted(os.listdir(spec_dir))
+                              if self.CanProcessFile(spec_name)])
+            self._spec_names[spec_dir] = cached
+        return cached[1]
+
+    def _Spec(self, spec_path):
+        """Return the parsed bundle spec at spec_path."""
+        import bundles
+
+        stamp = deps.Stamp(spec_path)
+        cached = self._specs.get(spec_path)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, bundles.Spec(spec_path))
+            self._specs[spec_path] = cached
+        return cached[1]
 
     def EndProcessing(self):
         del self._ctx
 
 
+class _StageCache(object):
+    """Size-bounded LRU cache of pipeline stage outputs."""
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._entries = odict.OrderedDict()
+
+    def Get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            # Move to the most recently used end.
+            del self._entries[key]
+            self._entries[key] = value
+        return value
+
+    def Put(self, key, value):
+        if len(value) > self._max_bytes:
+            return
+        if key in self._entries:
+            self._size -= len(self._entries[key])
+            del self._entries[key]
+        self._entries[key] = value
+        self._size += len(value)
+        while self._size > self._max_bytes:
+            oldest = self._entries.keys()[0]
+            self._size -= len(self._entries[oldest])
+            del self._entries[oldest]
+
+
+class PipelineProcessor(_Processor):
+    """Chain a processor with filters, passing content along in memory.
+
+    The head processor produces chunks through its ProcessStream
+    method, each filter transforms the chunks of the previous stage,
+    and only the final output is written to disk. The output of each
+    cacheable filter is kept in memory, keyed by a hash of its input,
+    so unchanged content isn't filtered again.
+    """
+    # Upper bound on the memory used by cached stage outputs.
+    STAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, head, stages):
+        # Only processors relying on the default, streaming ProcessFile
+        # can head a pipeline.
+        if type(head).ProcessFile.im_func is not _Processor.ProcessFile.im_func:
+            raise InvalidPipeline(type(head).__name__)
+        self._head = head
+        self._stages = stages
+        self._cache = _StageCache(self.STAGE_CACHE_BYTES)
+        self.CACHEABLE = head.CACHEABLE and all(s.CACHEABLE for s in stages)
+        self.CACHE_CONTEXT = head.CACHE_CONTEXT
+
+    def CacheName(self):
+        return '+'.join([self._head.CacheName()] +
+                        [type(s).__name__ for s in self._stages])
+
+    def StartProcessing(self, ctx):
+        self._ctx = ctx
+        self._head.StartProcessing(ctx)
+        for stage in self._stages:
+            stage.StartProcessing(ctx)
+
+    def CanProcessFile(self, filename):
+        return self._head.CanProcessFile(filename)
+
+    def OutputPath(self, out_path):
+        """Return the path the output for out_path is written to."""
+        for stage in self._stages:
+            out_path = stage.OutputPath(out_path)
+        return out_path
+
+    def ProcessFile(self, in_path, out_path):
+        out_path = self.OutputPath(out_path)
+        in_file = util.OpenFileStream(in_path)
+        try:
+            self._ctx['output'].WriteChunks(
+                out_path, self.ProcessStream(in_file, in_path))
+        finally:
+            in_file.close()
+
+        return [out_path]
+
+    def ProcessStream(self, in_file, in_path):
+        chunks = self._head.ProcessStream(in_file, in_path)
+        for i, stage in enumerate(self._stages):
+            chunks = self._RunStage(i, stage, chunks, in_path)
+        return chunks
+
+    def _RunStage(self, i, stage, chunks, in_path):
+        if not stage.CACHEABLE:
+            return stage.FilterFile(chunks, in_path)
+
+        content = ''.join(filters.AsBytes(c) for c in chunks)
+        key = (i, hashlib.sha1(content).digest())
+        output = self._cache.Get(key)
+        if output is None:
+            output = ''.join(filters.AsBytes(c)
+                             for c in stage.FilterChunks([content]))
+            self._cache.Put(key, output)
+        return [output]
+
+    def EndProcessing(self):
+        for stage in self._stages:
+            stage.EndProcessing()
+        self._head.EndProcessing()
+        del self._ctx
+
+
 #
 # Special internal processors.
 #
 class IgnoreProtectedFileProcessor(_Processor):
     """Ignore temporary and hidden files."""
+    CACHEABLE = False
+
     def CanProcessFile(self, filename):
         base = os.path.basename(filename)
         if base.startswith('_') or base.startswith('.#') or base.endswith('~'):
@@ -122,26 +757,81 @@ class CopyFileProcessor(_Processor):
         return True
 
     def ProcessFile(self, in_path, out_path):
-        shutil.copy(in_path, out_path)
+        self._ctx['output'].CopyFile(in_path, out_path)
         return True
 
 
 PROCESSORS = {
     'HtmlJinja': HtmlJinjaProcessor,
     'CssYaml': CssYamlProcessor,
+    'Fanout': FanoutProcessor,
+    'Image': ImageProcessor,
+    'Bundle': BundleProcessor,
 }
 
+# The processors used when generating a website.
+DEFAULT_PROCESSORS = ['HtmlJinja', 'CssYaml', 'Fanout']
+
+
+def ProcessToString(processor_objs, in_path):
+    """Return the output processing in_path would produce, in memory.
+
+    The first of processor_objs able to process in_path is used, as
+    during generation. The processors must have been started.
+
+    Returns:
+      The output as a byte string, or None if the file is skipped, or
+      processed into something other than a single output of the
+      same name.
+    """
+    for processor in processor_objs:
+        if processor.CanProcessFile(in_path):
+            break
+    else:
+        return None
+
+    if isinstance(processor, CopyFileProcessor):
+        f = open(in_path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    if isinstance(processor, PipelineProcessor):
+        if processor.OutputPath(in_path) != in_path:
+            return None
+    elif (type(processor).ProcessFile.im_func is not
+          _Processor.ProcessFile.im_func):
+        return None
+
+    in_file = util.OpenFileStream(in_path)
+    try:
+        return ''.join(filters.AsBytes(c)
+                       for c in processor.ProcessStream(in_file, in_path))
+    finally:
+        in_file.close()
+
 
 def ListProcessors():
     return PROCESSORS.keys()
 
 
 def GetProcessors(processors):
+    """Instanciate the named processors.
+
+    A name can also describe a pipeline, as a processor name followed
+    by filter names, separated by '+' (e.g. 'HtmlJinja+MinifyHtml').
+    """
     processor_objs = []
     for processor in processors:
-        if processor not in PROCESSORS:
-            raise UnknownProcessor(processor)
-        processor_objs.append(PROCESSORS[processor]())
+        stages = processor.split('+')
+        if stages[0] not in PROCESSORS:
+            raise UnknownProcessor(stages[0])
+        processor = PROCESSORS[stages[0]]()
+        if len(stages) > 1:
+            processor = PipelineProcessor(
+                processor, [filters.GetFilter(f) for f in stages[1:]])
+        processor_objs.append(processor)
 
     return ([IgnoreProtectedFileProcessor()] +
             processor_objs +
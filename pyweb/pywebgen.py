@@ -16,11 +16,10 @@ import optparse
 import os.path
 import sys
 
-import container
-import deploy
-import generator
 import odict
-import versions
+
+# Modules needed by commands are imported by the commands themselves,
+# so that quick commands don't pay for importing the whole generator.
 
 
 VERSION = '0.1.0'
@@ -28,6 +27,8 @@ OPTPARSE_VERSION = '%prog ' + VERSION
 
 
 def startsite_cmd(cmdline):
+    import container
+
     STARTSITE_USAGE = '%prog startsite [-d <deploy_dir>] <site dir>'
     parser = optparse.OptionParser(usage=STARTSITE_USAGE,
                                    version=OPTPARSE_VERSION,
@@ -53,12 +54,80 @@ def startsite_cmd(cmdline):
 
 
 def generate_cmd(cmdline):
-    GENERATE_USAGE = '%prog generate [options] <input dir> <output dir>'
+    import generator
+    import outputcache
+    import processors
+
+    GENERATE_USAGE = ('%prog generate [options] [-i <index file> '
+                      '[--only <input file>...]] <input dir> <output dir>')
     parser = optparse.OptionParser(usage=GENERATE_USAGE,
                                    version=OPTPARSE_VERSION,
                                    add_help_option=False)
     parser.add_option('-m', '--manifest', action='store',
                       type='string', dest='manifest')
+    parser.add_option('-p', '--processor', action='append',
+                      type='string', dest='processors')
+    parser.add_option('-c', '--cache-dir', action='store',
+                      type='string', dest='cache_dir')
+    parser.add_option('--profile-memory', action='store_true',
+                      dest='profile_memory')
+    parser.add_option('-i', '--index', action='store',
+                      type='string', dest='index')
+    parser.add_option('--only', action='append',
+                      type='string', dest='only')
+
+    (options, args) = parser.parse_args(cmdline)
+
+    if len(args) != 2 or (options.only and not options.index):
+        parser.print_help()
+        return 2
+
+    profiler = None
+    if options.profile_memory:
+        import memprofile
+        profiler = memprofile.MemoryProfiler()
+        profiler.Start()
+
+    gen = generator.Generator(args[0],
+                              options.processors or
+                              processors.DEFAULT_PROCESSORS,
+                              output_cache=outputcache.Open(options.cache_dir),
+                              memory_profiler=profiler)
+    if options.index:
+        gen.LoadIndex(options.index)
+    if options.only:
+        gen.GenerateFiles(args[1], options.only,
+                          manifest_path=options.manifest)
+    else:
+        gen.Generate(args[1], manifest_path=options.manifest,
+                     keep_index=bool(options.index))
+    if options.index:
+        gen.SaveIndex(options.index)
+    print 'Wrote %d files, %d unchanged.' % gen.WriteCounts()
+
+    if profiler is not None:
+        profiler.Stop()
+        profiler.Report(sys.stdout)
+    return 0
+
+
+def watch_cmd(cmdline):
+    import generator
+    import processors
+    import watcher
+
+    WATCH_USAGE = '%prog watch [options] <input dir> <output dir>'
+    parser = optparse.OptionParser(usage=WATCH_USAGE,
+                                   version=OPTPARSE_VERSION,
+                                   add_help_option=False)
+    parser.add_option('-m', '--manifest', action='store',
+                      type='string', dest='manifest')
+    parser.add_option('-p', '--processor', action='append',
+                      type='string', dest='processors')
+    parser.add_option('-i', '--interval', action='store', type='float',
+                      dest='interval', default=watcher.POLL_INTERVAL)
+    parser.add_option('-w', '--debounce', action='store', type='float',
+                      dest='debounce', default=watcher.DEBOUNCE_WINDOW)
 
     (options, args) = parser.parse_args(cmdline)
 
@@ -66,26 +135,45 @@ def generate_cmd(cmdline):
         parser.print_help()
         return 2
 
-    gen = generator.Generator(args[0], ['HtmlJinja', 'CssYaml'])
-    gen.Generate(args[1], manifest_path=options.manifest)
+    gen = generator.Generator(args[0],
+                              options.processors or
+                              processors.DEFAULT_PROCESSORS)
+    print 'Watching %s, press Ctrl-C to stop.' % args[0]
+    try:
+        watcher.Watch(gen, args[0], args[1], manifest_path=options.manifest,
+                      poll_interval=options.interval,
+                      debounce=options.debounce)
+    except KeyboardInterrupt:
+        print
     return 0
 
 
 def vgenerate_cmd(cmdline):
+    import outputcache
+    import processors
+    import versions
+
     VGENERATE_USAGE = '%prog vgenerate <input dir> <versions dir>'
     parser = optparse.OptionParser(usage=VGENERATE_USAGE,
                                    version=OPTPARSE_VERSION,
                                    add_help_option=False)
     parser.add_option('-d', '--deploy-dir', action='store',
                       type='string', dest='deploy_dir')
+    parser.add_option('-l', '--link-deploy', action='store_true',
+                      dest='link_deploy')
+    parser.add_option('-c', '--cache-dir', action='store',
+                      type='string', dest='cache_dir')
     (options, args) = parser.parse_args(cmdline)
 
     if len(args) != 2:
         parser.print_help()
         return 2
 
-    gen = versions.VersionnedGenerator(args[1], options.deploy_dir)
-    ts, out, manifest, current = gen.Generate(args[0], ['HtmlJinja', 'CssYaml'])
+    gen = versions.VersionnedGenerator(args[1], options.deploy_dir,
+                                       options.link_deploy)
+    ts, out, manifest, current = gen.Generate(
+        args[0], processors.DEFAULT_PROCESSORS,
+        output_cache=outputcache.Open(options.cache_dir))
     if current:
         print 'Generated version %s and made current.' % ts
     else:
@@ -93,13 +181,50 @@ def vgenerate_cmd(cmdline):
     return 0
 
 
+def batch_generate_cmd(cmdline):
+    import batch
+
+    BATCH_USAGE = ('%prog batch-generate [-j <jobs>] '
+                   '<container or glob> [...]')
+    parser = optparse.OptionParser(usage=BATCH_USAGE,
+                                   version=OPTPARSE_VERSION,
+                                   add_help_option=False)
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      dest='jobs')
+    (options, args) = parser.parse_args(cmdline)
+
+    if not args or (options.jobs is not None and options.jobs < 1):
+        parser.print_help()
+        return 2
+
+    paths = batch.ExpandPaths(args)
+    failed = 0
+    for result in batch.BatchGenerate(paths, options.jobs):
+        if result.error:
+            failed += 1
+            print 'FAILED  %7.3fs  %s: %s' % (result.elapsed, result.path,
+                                               result.error)
+        else:
+            print 'OK      %7.3fs  %s: version %s%s' % (
+                result.elapsed, result.path, result.version,
+                result.current and ' (current)' or '')
+        sys.stdout.flush()
+
+    print 'Generated %d of %d sites.' % (len(paths) - failed, len(paths))
+    return failed and 1 or 0
+
+
 def vcurrent_cmd(cmdline):
+    import versions
+
     VCURRENT_USAGE = '%prog vcurrent <versions_dir> <version>'
     parser = optparse.OptionParser(usage=VCURRENT_USAGE,
                                    version=OPTPARSE_VERSION,
                                    add_help_option=False)
     parser.add_option('-d', '--deploy-dir', action='store',
                       type='string', dest='deploy_dir')
+    parser.add_option('-l', '--link-deploy', action='store_true',
+                      dest='link_deploy')
     (options, args) = parser.parse_args(cmdline)
 
     if len(args) != 2:
@@ -115,13 +240,16 @@ def vcurrent_cmd(cmdline):
             print 'Version must be an integer, or "latest"'
             return 2
 
-    gen = versions.VersionnedGenerator(args[0], options.deploy_dir)
+    gen = versions.VersionnedGenerator(args[0], options.deploy_dir,
+                                       options.link_deploy)
     ts = gen.ChangeCurrent(version)
     print 'Set current version to %s.' % ts
     return 0
 
 
 def vinfo_cmd(cmdline):
+    import versions
+
     VINFO_USAGE = '%prog vinfo <versions_dir>'
     parser = optparse.OptionParser(usage=VINFO_USAGE,
                                    version=OPTPARSE_VERSION,
@@ -141,15 +269,21 @@ def vinfo_cmd(cmdline):
 
     print 'Versions:'
     for i, ts in enumerate(site_versions):
+        if gen.IsPacked(ts):
+            state = 'packed'
+        else:
+            state = 'expanded'
         if ts == current:
-            print '  %2d. %s (current)' % (i, ts)
+            print '  %2d. %s %-8s (current)' % (i, ts, state)
         else:
-            print '  %2d. %s' % (i, ts)
+            print '  %2d. %s %s' % (i, ts, state)
 
     return 0
 
 
 def vgc_cmd(cmdline):
+    import versions
+
     VGC_USAGE = '%prog vgc <versions_dir>'
     parser = optparse.OptionParser(usage=VGC_USAGE,
                                    version=OPTPARSE_VERSION,
@@ -172,45 +306,132 @@ def vgc_cmd(cmdline):
     return 0
 
 
+def vpack_cmd(cmdline):
+    import versions
+
+    VPACK_USAGE = '%prog vpack [-k <count>] <versions_dir>'
+    parser = optparse.OptionParser(usage=VPACK_USAGE,
+                                   version=OPTPARSE_VERSION,
+                                   add_help_option=False)
+    parser.add_option('-k', '--keep', action='store', type='int',
+                      dest='keep', default=versions.PACK_KEEP)
+    (options, args) = parser.parse_args(cmdline)
+
+    if len(args) != 1 or options.keep < 0:
+        parser.print_help()
+        return 2
+
+    gen = versions.VersionnedGenerator(args[0])
+    packed = gen.PackVersions(options.keep)
+
+    if not packed:
+        print 'Nothing to pack.'
+    else:
+        print 'Packed %d versions:' % len(packed)
+        print '\n'.join(['  %s' % v for v in packed])
+
+    return 0
+
+
+def cache_cmd(cmdline):
+    import outputcache
+
+    CACHE_USAGE = ('%prog cache [-c <cache_dir>] stats\n'
+                   '       %prog cache [-c <cache_dir>] [-s <megabytes>] prune')
+    parser = optparse.OptionParser(usage=CACHE_USAGE,
+                                   version=OPTPARSE_VERSION,
+                                   add_help_option=False)
+    parser.add_option('-c', '--cache-dir', action='store',
+                      type='string', dest='cache_dir')
+    parser.add_option('-s', '--size', action='store', type='int',
+                      dest='size')
+    (options, args) = parser.parse_args(cmdline)
+
+    if len(args) != 1 or args[0] not in ('stats', 'prune'):
+        parser.print_help()
+        return 2
+
+    cache = outputcache.Open(options.cache_dir)
+    if cache is None:
+        print ('No cache directory, use -c or set $%s.' %
+               outputcache.CACHE_DIR_ENV)
+        return 2
+
+    if args[0] == 'stats':
+        stats = cache.Stats()
+        lookups = stats['hits'] + stats['misses']
+        print 'Cache directory: %s' % stats['directory']
+        print 'Entries: %d' % stats['entries']
+        print 'Stored outputs: %d (%.1f of %.1f MB)' % (
+            stats['objects'], stats['bytes'] / 1048576.0,
+            stats['max_bytes'] / 1048576.0)
+        print 'Hits: %d, misses: %d (%.1f%% hit rate)' % (
+            stats['hits'], stats['misses'],
+            lookups and 100.0 * stats['hits'] / lookups or 0)
+    else:
+        if options.size is not None:
+            evicted = cache.Prune(options.size * 1024 * 1024)
+        else:
+            evicted = cache.Prune()
+        print 'Evicted %.1f MB.' % (evicted / 1048576.0)
+    return 0
+
+
 def deploy_cmd(cmdline):
-    DEPLOY_USAGE = ('%prog deploy <webgen output dir> '
+    import deploy
+
+    DEPLOY_USAGE = ('%prog deploy [-l] <webgen output dir> '
                     '<deploy dir> <webgen manifest>')
     parser = optparse.OptionParser(usage=DEPLOY_USAGE,
                                    version=OPTPARSE_VERSION,
                                    add_help_option=False)
+    parser.add_option('-l', '--link', action='store_true', dest='link')
     (options, args) = parser.parse_args(cmdline)
 
     if len(args) != 3:
         parser.print_help()
         return 2
 
-    deploy.Deploy(args[0], args[1], args[2])
+    if options.link:
+        deploy.LinkDeploy(args[0], args[1], args[2])
+    else:
+        deploy.Deploy(args[0], args[1], args[2])
     return 0
 
 
 def undeploy_cmd(cmdline):
-    UNDEPLOY_USAGE = ('%prog undeploy <webgen output dir> '
+    import deploy
+
+    UNDEPLOY_USAGE = ('%prog undeploy [-l] <webgen output dir> '
                       '<deploy dir> <webgen manifest>')
     parser = optparse.OptionParser(usage=UNDEPLOY_USAGE,
                                    version=OPTPARSE_VERSION,
                                    add_help_option=False)
+    parser.add_option('-l', '--link', action='store_true', dest='link')
     (options, args) = parser.parse_args(cmdline)
 
     if len(args) != 3:
         parser.print_help()
         return 2
 
-    deploy.Undeploy(args[0], args[1], args[2])
+    if options.link:
+        deploy.LinkUndeploy(args[0], args[1], args[2])
+    else:
+        deploy.Undeploy(args[0], args[1], args[2])
     return 0
 
 
 COMMANDS = odict.OrderedDict((
         ('startsite', startsite_cmd),
         ('generate', generate_cmd),
+        ('watch', watch_cmd),
         ('vgenerate', vgenerate_cmd),
+        ('batch-generate', batch_generate_cmd),
         ('vcurrent', vcurrent_cmd),
         ('vinfo', vinfo_cmd),
         ('vgc', vgc_cmd),
+        ('vpack', vpack_cmd),
+        ('cache', cache_cmd),
         ('deploy', deploy_cmd),
         ('undeploy', undeploy_cmd)))
 
@@ -219,6 +440,12 @@ def main():
     USAGE = ('%prog <command> [options] <command args>\n\nCommands:\n  ' +
              '\n  '.join(COMMANDS.keys()))
     parser = optparse.OptionParser(usage=USAGE, version=OPTPARSE_VERSION)
+    parser.add_option('--metrics-textfile', action='store', type='string',
+                      dest='metrics_textfile',
+                      help='Write build metrics to this Prometheus textfile')
+    parser.add_option('--metrics-json', action='store', type='string',
+                      dest='metrics_json',
+                      help='Write build metrics to this JSON file')
     parser.disable_interspersed_args()
     (options, args) = parser.parse_args()
 
@@ -231,4 +458,8 @@ def main():
         parser.print_help()
         return 2
 
-    return COMMANDS[args[0]](args[1:])
+    try:
+        return COMMANDS[args[0]](args[1:])
+    finally:
+        import metrics
+        metrics.Export(options.metrics_textfile, options.metrics_json)
@@ -0,0 +1,180 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Structured site data exposed to templates.
+
+YAML and JSON files placed in the _data directory of the input tree
+are made available to templates as a nested mapping: the file
+_data/nav.yaml is reachable as data.nav, and _data/shop/products.json
+as data.shop.products.
+
+Names of mapping methods (keys, items, values, get...) are reserved,
+since templates would reach the method rather than the data under
+them, and data files with these names are rejected. So are files and
+directories that would be reachable under the same name, such as
+nav.yaml and nav.json.
+
+Files are only read and parsed when a template first uses them, at
+most once per generation. Parsed values are kept across generations,
+and shared between the sites generated by a process, keyed by file
+content, so a file is only parsed again when its content changes.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import hashlib
+import os
+import os.path
+import UserDict
+
+import error
+import odict
+
+
+DATA_DIR = '_data'
+
+# The number of parsed data files kept in memory.
+PARSED_CACHE_SIZE = 256
+
+_parsed = odict.OrderedDict()
+
+# Names that attribute lookups resolve to SiteData's own methods.
+_RESERVED_NAMES = frozenset(['keys'] +
+                            [name for name in dir(UserDict.DictMixin)
+                             if not name.startswith('_')])
+
+
+class DataFileError(error.Error):
+    """A site data file could not be parsed."""
+
+
+def _ParseJson(content):
+    try:
+        import json
+    except ImportError:
+        raise error.MissingPythonModule('json')
+    return json.loads(content.decode('utf-8'))
+
+
+def _ParseYaml(content):
+    try:
+        import yaml
+    except ImportError:
+        raise error.MissingPythonModule('yaml')
+    return yaml.safe_load(content)
+
+
+_PARSERS = {
+    '.json': _ParseJson,
+    '.yaml': _ParseYaml,
+    '.yml': _ParseYaml,
+}
+
+
+def IsDataFile(filename):
+    return os.path.splitext(filename)[1] in _PARSERS
+
+
+class DataLoader(object):
+    """Parses site data files, caching results by content hash."""
+    def Load(self, input_root, deps):
+        """Return the site data for a new generation of input_root.
+
+        Args:
+          input_root: the root of the website input tree.
+          deps: the DependencyGraph in which to record data file reads.
+        """
+        return SiteData(self, os.path.join(input_root, DATA_DIR), deps)
+
+    def Parse(self, path):
+        f = open(path, 'rb')
+        content = f.read()
+        f.close()
+
+        ext = os.path.splitext(path)[1]
+        key = (ext, hashlib.sha1(content).digest())
+        if key in _parsed:
+            # Move to the most recently used end.
+            value = _parsed[key]
+            del _parsed[key]
+            _parsed[key] = value
+            return value
+
+        try:
+            value = _PARSERS[ext](content)
+        except error.Error:
+            raise
+        except Exception, e:
+            raise DataFileError('%s: %s' % (path, e))
+
+        _parsed[key] = value
+        if len(_parsed) > PARSED_CACHE_SIZE:
+            del _parsed[_parsed.keys()[0]]
+        return value
+
+
+class SiteData(UserDict.DictMixin):
+    """Lazy mapping over one directory of site data files."""
+    def __init__(self, loader, data_dir, deps):
+        self._loader = loader
+        self._data_dir = data_dir
+        self._deps = deps
+        self._paths = {}
+        self._dirs = set()
+        self._values = {}
+
+        if os.path.isdir(data_dir):
+            for name in sorted(os.listdir(data_dir)):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(data_dir, name)
+                if os.path.isdir(path):
+                    key = name
+                    self._dirs.add(name)
+                elif IsDataFile(name):
+                    key = os.path.splitext(name)[0]
+                else:
+                    continue
+                if key in _RESERVED_NAMES:
+                    raise DataFileError('%s: %s is a reserved name' %
+                                        (path, key))
+                if key in self._paths:
+                    raise DataFileError('%s: %s is also defined by %s' %
+                                        (path, key, self._paths[key]))
+                self._paths[key] = path
+
+    def __getitem__(self, key):
+        if key not in self._paths:
+            # The file may be added later, which changes the directory.
+            self._deps.Record(self._data_dir)
+            raise KeyError(key)
+        path = self._paths[key]
+        if key not in self._values:
+            if key in self._dirs:
+                self._values[key] = SiteData(self._loader, path, self._deps)
+            else:
+                self._values[key] = self._loader.Parse(path)
+
+        if key not in self._dirs:
+            self._deps.Record(path)
+        return self._values[key]
+
+    def __contains__(self, key):
+        if key not in self._paths:
+            self._deps.Record(self._data_dir)
+            return False
+        return True
+
+    def keys(self):
+        # Files added or removed later change the keys.
+        self._deps.Record(self._data_dir)
+        return sorted(self._paths.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self._deps.Record(self._data_dir)
+        return len(self._paths)
@@ -0,0 +1,168 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Precompiled Jinja2 template archives.
+
+Compiling a Jinja2 template (lexing, parsing and generating Python
+code) is the most expensive part of rendering a page. This module can
+precompile every template of an input tree into a zip archive of
+Python modules, along with an index of the state of each template
+source at compile time.
+
+When generating, templates whose source still matches the index are
+loaded from the archive, and the others are compiled from source as
+usual, so a stale archive is never harmful.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import zipfile
+
+import deps
+import error
+import util
+import walker
+
+
+_INDEX_NAME = 'INDEX'
+
+
+def _ListTemplates(input_root):
+    """Return the names of all templates in an input tree."""
+    # Underscore templates are never published, but they are
+    # extended and included by the others.
+    rules = walker.LoadIgnoreRules(input_root, ['.*/'])
+    names = []
+    for input_dir, files in walker.Walk(input_root, rules):
+        for entry in files:
+            if entry.name.endswith('.html'):
+                names.append((util.PathAsSuffix(entry.path, input_root),
+                              deps.Stamp(entry.path, entry.stat())))
+    return names
+
+
+def ReadIndex(archive_path):
+    """Return a dict of template name to source stamp for an archive."""
+    if not os.path.isfile(archive_path):
+        return {}
+    try:
+        archive = zipfile.ZipFile(archive_path)
+        try:
+            index = archive.read(_INDEX_NAME).decode('utf-8')
+        finally:
+            archive.close()
+    except (zipfile.BadZipfile, KeyError):
+        return {}
+
+    stamps = {}
+    for line in index.splitlines():
+        name, mtime, size = line.rsplit('\t', 2)
+        stamps[name] = (float(mtime), int(size))
+    return stamps
+
+
+def CompileTemplates(input_root, archive_path):
+    """Precompile the templates of an input tree into an archive.
+
+    Templates that didn't change since the archive was last built are
+    carried over without being compiled again. Templates that fail to
+    compile are left out, and will be compiled from source (and fail
+    there) when generating.
+
+    Returns:
+      The number of templates that were compiled.
+    """
+    try:
+        import jinja2
+    except ImportError:
+        raise error.MissingPythonModule('jinja2')
+
+    input_root = os.path.abspath(input_root)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(input_root))
+    old_index = ReadIndex(archive_path)
+    if old_index:
+        old_archive = zipfile.ZipFile(archive_path)
+    else:
+        old_archive = None
+
+    tmp_path = archive_path + '.tmp'
+    archive = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED)
+    index = []
+    compiled = 0
+    try:
+        for name, stamp in _ListTemplates(input_root):
+            module_name = jinja2.ModuleLoader.get_module_filename(name)
+            if old_index.get(name) == stamp:
+                code = old_archive.read(module_name)
+            else:
+                source, filename, _ = env.loader.get_source(env, name)
+                try:
+                    code = env.compile(source, name, filename, True, True)
+                except jinja2.TemplateSyntaxError:
+                    continue
+                code = code.encode('utf-8')
+                compiled += 1
+            archive.writestr(module_name, code)
+            index.append(u'%s\t%r\t%d' % (name, stamp[0], stamp[1]))
+
+        archive.writestr(_INDEX_NAME, u'\n'.join(index).encode('utf-8'))
+    finally:
+        archive.close()
+        if old_archive:
+            old_archive.close()
+
+    os.rename(tmp_path, archive_path)
+    return compiled
+
+
+def Loader(input_root, archive_path):
+    """Return a Jinja2 loader using precompiled templates when fresh.
+
+    Templates missing from the archive, or whose source changed since
+    the archive was built, are loaded from source.
+    """
+    import jinja2
+
+    fs_loader = jinja2.FileSystemLoader(input_root)
+    index = ReadIndex(archive_path)
+    if not index:
+        return fs_loader
+
+    class PrecompiledLoader(jinja2.BaseLoader):
+        def get_source(self, environment, template):
+            return fs_loader.get_source(environment, template)
+
+        def list_templates(self):
+            return fs_loader.list_templates()
+
+        def load(self, environment, name, globals=None):
+            path = os.path.join(input_root, *name.split('/'))
+            stamp = deps.Stamp(path)
+            if stamp is None or index.get(name) != stamp:
+                return fs_loader.load(environment, name, globals)
+
+            # Modules are read from the archive as they are needed,
+            # rather than imported, so a rebuilt archive is never
+            # seen stale through import caches.
+            archive = zipfile.ZipFile(archive_path)
+            try:
+                code = archive.read(
+                    jinja2.ModuleLoader.get_module_filename(name))
+            finally:
+                archive.close()
+            namespace = {
+                '__name__': jinja2.ModuleLoader.get_template_key(name),
+                '__file__': path,
+                }
+            exec compile(code, path, 'exec') in namespace
+            template = environment.template_class.from_module_dict(
+                environment, namespace, globals)
+            template.filename = path
+            template._uptodate = lambda: deps.Stamp(path) == stamp
+            return template
+
+    return PrecompiledLoader()
@@ -7,7 +7,14 @@
 
 __author__ = 'David Anderson <dave@natulte.net>'
 
+import codecs
+import errno
+import hashlib
+import itertools
+import os
 import os.path
+import shutil
+import stat
 
 import error
 
@@ -54,34 +61,106 @@ def ReadFileContent(filename, codec='utf-8'):
         raise FileEncodingError(filename)
 
 
+def OpenFileStream(filename, codec='utf-8'):
+    """Open a file for streaming reads of its decoded content.
+
+    Args:
+      filename: the path to the file to read.
+      codec: the encoding used in the file (default: utf-8).
+
+    Returns:
+      A file object whose read methods return unicode strings. The
+      caller must close it. Reads raise FileEncodingError if the
+      given codec can't decode the file content.
+
+    Raises:
+      FileNotFoundError: the requested file does not exist.
+      IOError: an error occured while opening the file.
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(filename)
+
+    return _DecodedFile(filename,
+                        codecs.getreader(codec)(open(filename, 'rb')))
+
+
+class _DecodedFile(object):
+    """A decoding stream reader, reporting decode errors by filename."""
+    def __init__(self, filename, reader):
+        self.name = filename
+        self._reader = reader
+
+    def _Decode(self, method, *args):
+        try:
+            return method(*args)
+        except UnicodeDecodeError:
+            raise FileEncodingError(self.name)
+
+    def read(self, *args):
+        return self._Decode(self._reader.read, *args)
+
+    def readline(self, *args):
+        return self._Decode(self._reader.readline, *args)
+
+    def readlines(self, *args):
+        return self._Decode(self._reader.readlines, *args)
+
+    def next(self):
+        return self._Decode(self._reader.next)
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self._reader.close()
+
+
 def WriteFileContent(filename, content, codec='utf-8'):
     """Write the given content to a file.
 
     The content is assumed to a unicode object, and will be encoded
     using the given codec (defaults to UTF-8). If the file already
-    exists, it is overwritten.
+    exists, it is atomically replaced, unless it already holds the
+    exact same content, in which case it is left untouched.
 
     Args:
       filename: the path to the file to write.
       content: the unicode content to write.
       codec: the encoding to use in the file (default: utf-8).
 
+    Returns:
+      True if the file was written, False if it was left untouched.
+
     Raises:
       PathObstructedError: a non-file exists at the given path.
       FileEncodingError: translation using the given codec failed.
       IOError: an error occured while writing the file.
     """
-    if os.path.exists(filename) and not os.path.isfile(filename):
-        raise PathObstructedError(filename)
+    return OutputWriter().WriteChunks(filename, [content], codec)
 
-    try:
-        content = content.encode(codec)
-    except UnicodeEncodeError:
-        raise FileEncodingError(filename)
 
-    f = open(filename, 'wb')
-    f.write(content)
-    f.close()
+def WriteFileChunks(filename, chunks, codec='utf-8'):
+    """Write content to a file, one chunk at a time.
+
+    Like WriteFileContent, but takes an iterable of chunks, which are
+    encoded and written as they are produced, so that the full content
+    never needs to be held in memory. Byte string chunks are assumed
+    to be encoded already, and are written as-is.
+
+    Args:
+      filename: the path to the file to write.
+      chunks: an iterable of unicode or byte strings.
+      codec: the encoding to use in the file (default: utf-8).
+
+    Returns:
+      True if the file was written, False if it was left untouched.
+
+    Raises:
+      PathObstructedError: a non-file exists at the given path.
+      FileEncodingError: translation using the given codec failed.
+      IOError: an error occured while writing the file.
+    """
+    return OutputWriter().WriteChunks(filename, chunks, codec)
 
 
 def PathAsSuffix(path, root):
@@ -141,3 +220,195 @@ def CreateDir(path):
             os.makedirs(path)
         except os.error:
             raise PathObstructedError(path)
+
+
+_COPY_BLOCK_SIZE = 64 * 1024
+
+
+def _FileDigest(filename):
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        for block in iter(lambda: f.read(_COPY_BLOCK_SIZE), ''):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _FileStamp(st):
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class OutputWriter(object):
+    """Writes output files, leaving files with unchanged content alone.
+
+    New content is compared to the existing file by size first, then
+    by SHA-1 digest. The writer remembers the digest of every file it
+    writes or checks, along with its stat signature, so that a file
+    that wasn't modified since isn't read back for the comparison.
+
+    Content is buffered in memory up to SPOOL_BYTES, then spooled to
+    a temporary file next to the output. Changed files are replaced
+    atomically by renaming the temporary file over them.
+
+    If remember is set to False, neither digests nor the paths of
+    written files are kept, so that memory use doesn't grow with the
+    number of files written.
+    """
+    SPOOL_BYTES = 1024 * 1024
+    _tmp_counter = itertools.count()
+
+    def __init__(self):
+        self._digests = {}
+        self.remember = True
+        self.ResetCounts()
+
+    def ResetCounts(self):
+        self.written = 0
+        self.unchanged = 0
+        self.bytes_written = 0
+        self.written_paths = []
+
+    def WriteContent(self, filename, content, codec='utf-8'):
+        """Write unicode content to a file. See WriteFileContent."""
+        return self.WriteChunks(filename, [content], codec)
+
+    def WriteChunks(self, filename, chunks, codec='utf-8'):
+        """Write an iterable of chunks to a file. See WriteFileChunks."""
+        if os.path.exists(filename) and not os.path.isfile(filename):
+            raise PathObstructedError(filename)
+
+        digest = hashlib.sha1()
+        size = 0
+        spool = []
+        tmp_file = tmp_path = None
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    try:
+                        chunk = chunk.encode(codec)
+                    except UnicodeEncodeError:
+                        raise FileEncodingError(filename)
+                digest.update(chunk)
+                size += len(chunk)
+                if tmp_file is not None:
+                    tmp_file.write(chunk)
+                    continue
+                spool.append(chunk)
+                if size > self.SPOOL_BYTES:
+                    tmp_file, tmp_path = self._OpenTemp(filename)
+                    tmp_file.write(''.join(spool))
+                    spool = None
+
+            digest = digest.hexdigest()
+            if self._IsUnchanged(filename, size, digest):
+                self.unchanged += 1
+                return False
+
+            if tmp_file is None:
+                tmp_file, tmp_path = self._OpenTemp(filename)
+                tmp_file.write(''.join(spool))
+            tmp_file.close()
+            tmp_file = None
+            os.rename(tmp_path, filename)
+            tmp_path = None
+        finally:
+            if tmp_file is not None:
+                tmp_file.close()
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+        self._Written(filename, digest)
+        self.bytes_written += size
+        return True
+
+    def CopyFile(self, src, dst):
+        """Copy src to dst, along with its permission bits."""
+        f = open(src, 'rb')
+        try:
+            written = self.WriteChunks(
+                dst, iter(lambda: f.read(_COPY_BLOCK_SIZE), ''))
+        finally:
+            f.close()
+        if written:
+            shutil.copymode(src, dst)
+        return written
+
+    def LinkFile(self, src, dst, digest, mode=None):
+        """Make dst a copy of src, whose SHA-1 digest is known.
+
+        dst is hard linked to src when possible, and copied otherwise.
+        Either way, src must never be modified in place afterwards.
+
+        Args:
+          src: the file to copy.
+          dst: the file to write.
+          digest: the hex SHA-1 digest of src's content.
+          mode: the permission bits dst should have, if not src's.
+        """
+        if os.path.exists(dst) and not os.path.isfile(dst):
+            raise PathObstructedError(dst)
+
+        st = os.stat(src)
+        if self._IsUnchanged(dst, st.st_size, digest):
+            self.unchanged += 1
+            return False
+
+        tmp_path = self._TempPath(dst)
+        try:
+            if mode is None or mode == stat.S_IMODE(st.st_mode):
+                try:
+                    os.link(src, tmp_path)
+                except OSError, e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM,
+                                       errno.EMLINK):
+                        raise
+                    shutil.copy(src, tmp_path)
+            else:
+                shutil.copyfile(src, tmp_path)
+                os.chmod(tmp_path, mode)
+            os.rename(tmp_path, dst)
+            tmp_path = None
+        finally:
+            if tmp_path is not None and os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+        self._Written(dst, digest)
+        self.bytes_written += st.st_size
+        return True
+
+    def _Written(self, filename, digest):
+        self.written += 1
+        if self.remember:
+            self._digests[filename] = (_FileStamp(os.stat(filename)), digest)
+            self.written_paths.append(filename)
+        else:
+            self._digests.pop(filename, None)
+
+    def _TempPath(self, filename):
+        return os.path.join(os.path.dirname(filename), '.%s.%d.%d.tmp' % (
+            os.path.basename(filename), os.getpid(),
+            self._tmp_counter.next()))
+
+    def _OpenTemp(self, filename):
+        # os.open honors the umask, unlike tempfile.mkstemp.
+        tmp_path = self._TempPath(filename)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        return os.fdopen(fd, 'wb'), tmp_path
+
+    def _IsUnchanged(self, filename, size, digest):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if st.st_size != size:
+            return False
+
+        stamp = _FileStamp(st)
+        known = self._digests.get(filename)
+        if known is None or known[0] != stamp:
+            known = (stamp, _FileDigest(filename))
+            if self.remember:
+                self._digests[filename] = known
+        return known[1] == digest
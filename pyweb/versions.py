@@ -14,31 +14,94 @@ This module provides that support, by controlling the base generator
 to generate timestamped instances of a website, and manages a
 "current" symlink that can be atomically repointed between these
 versions.
+
+When a deploy directory is given, the current version is either
+copied into it, or, in link deploy mode, exposed there as a farm of
+symlinks going through the "current" link, so that activating another
+version is a matter of atomically repointing that link. The deploy
+mode is recorded in the versions directory, and a directory deployed
+in one mode is never deployed to in the other.
+
+Old versions can be packed into one compressed zip archive each, to
+save disk space and inodes while keeping them available for rollback.
+The zip central directory indexes each archive, and members are
+compressed and extracted as streams. A packed version is expanded
+again when it is made current.
+
+Several processes can safely work on the same versions directory.
+Versions are generated in a private staging directory, under a name
+reserved when generation starts, and published by renaming it into
+place. Publishing, switching versions, packing and
+garbage collection take an exclusive lock on the directory, so that
+the links and the deploy directory stay consistent, but generation
+itself runs in parallel. Builds started within the same second get
+distinct timestamps.
 """
 
 __author__ = 'David Anderson <dave@natulte.net>'
 
+import errno
+import fcntl
+import itertools
 import os
 import os.path
 import re
 import shutil
+import stat
 import time
+import zipfile
 
 import deploy
 import error
-import generator
+import metrics
 import util
 
 
-_TS_RE_FORM = r'(\d{8}-\d{6})'
+# Builds published within the same second get a sequence suffix.
+_TS_RE_FORM = r'(\d{8}-\d{6}(?:\.\d{3})?)'
 _TS_RE = re.compile(_TS_RE_FORM)
-_MANIFEST_RE = re.compile(_TS_RE_FORM + r'\.MANIFEST')
+_MANIFEST_RE = re.compile(_TS_RE_FORM + r'\.MANIFEST$')
+# Staging directories and name reservations, named after their build's
+# process.
+_STAGING_RE = re.compile(r'^\.(?:staging|reserved)-(\d+)-')
+_RESERVED_RE = re.compile(r'^\.reserved-\d+-' + _TS_RE_FORM + '$')
+_LOCK_FILE = '.lock'
 
 
 # The name of the various symlinks we maintain.
 _CURRENT_LINK = 'current'
 _LATEST_LINK = 'latest'
 
+# The number of most recent versions PackVersions leaves expanded.
+PACK_KEEP = 2
+
+_PUBLISHED = metrics.REGISTRY.Counter(
+    'pywebgen_versions_published_total', 'Website versions published.')
+_SWITCHES = metrics.REGISTRY.Counter(
+    'pywebgen_versions_switches_total', 'Changes of the current version.')
+_LOCK_WAIT_SECONDS = metrics.REGISTRY.Histogram(
+    'pywebgen_versions_lock_wait_seconds',
+    'Time spent waiting for the versions directory lock.')
+_GC_VERSIONS = metrics.REGISTRY.Counter(
+    'pywebgen_gc_versions_total', 'Website versions garbage collected.')
+_GC_BYTES = metrics.REGISTRY.Counter(
+    'pywebgen_gc_reclaimed_bytes_total',
+    'Disk space reclaimed by garbage collection.')
+_PACKED = metrics.REGISTRY.Counter(
+    'pywebgen_versions_packed_total', 'Website versions packed.')
+
+
+def _TreeSize(root):
+    """Return the space that removing a tree would free."""
+    size = 0
+    for dir_path, dirs, files in os.walk(root):
+        for name in files:
+            st = os.lstat(os.path.join(dir_path, name))
+            # Files hard linked elsewhere (see outputcache) stay.
+            if st.st_nlink == 1:
+                size += st.st_size
+    return size
+
 
 class InvalidLinkError(error.Error):
     """Version symlink is not valid."""
@@ -48,14 +111,101 @@ class NoVersionsError(error.Error):
     """No website versions exist."""
 
 
+def _PackTree(root, archive_path):
+    """Pack the tree under root into a compressed zip archive.
+
+    The archive is built on the side and renamed into place once
+    complete. zipfile compresses files as it reads them, so memory use
+    doesn't depend on their size.
+    """
+    tmp_path = os.path.join(os.path.dirname(archive_path),
+                            '.%s.tmp' % os.path.basename(archive_path))
+    try:
+        archive = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED,
+                                  allowZip64=True)
+        try:
+            for dir_path, dirs, files in os.walk(root):
+                dirs.sort()
+                # Directories are archived too, to keep empty ones.
+                for name in dirs + sorted(files):
+                    path = os.path.join(dir_path, name)
+                    archive.write(path, util.PathAsSuffix(path, root))
+        finally:
+            archive.close()
+        os.rename(tmp_path, archive_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _UnpackTree(archive_path, root):
+    """Expand an archive made by _PackTree into root.
+
+    The tree is extracted on the side and renamed into place once
+    complete. File modes and modification times are restored.
+    """
+    tmp_root = os.path.join(os.path.dirname(root),
+                            '.%s.tmp' % os.path.basename(root))
+    if os.path.exists(tmp_root):
+        shutil.rmtree(tmp_root)
+
+    archive = zipfile.ZipFile(archive_path)
+    try:
+        for info in archive.infolist():
+            path = archive.extract(info, tmp_root)
+            if info.filename.endswith('/'):
+                continue
+            mode = info.external_attr >> 16
+            if mode:
+                os.chmod(path, stat.S_IMODE(mode))
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+    finally:
+        archive.close()
+    os.rename(tmp_root, root)
+
+
+def _ProcessExists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class _DirectoryLock(object):
+    """An exclusive lock on a versions directory, shared by processes."""
+    def __init__(self, lock_path):
+        self._lock_path = lock_path
+        self._lock_file = None
+
+    def Acquire(self):
+        start = time.time()
+        self._lock_file = open(self._lock_path, 'a')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        _LOCK_WAIT_SECONDS.Observe(time.time() - start)
+
+    def Release(self):
+        # Closing the file drops the lock.
+        self._lock_file.close()
+        self._lock_file = None
+
+
 class VersionnedGenerator(object):
-    def __init__(self, output_root, deploy_dir=None):
+    _staging_counter = itertools.count()
+
+    def __init__(self, output_root, deploy_dir=None, link_deploy=False):
         self._output_root = os.path.abspath(output_root)
         if deploy_dir:
             self._deploy_dir = os.path.abspath(deploy_dir)
         else:
             self._deploy_dir = None
+        self._link_deploy = link_deploy
+        self._generators = {}
         util.CreateDir(self._output_root)
+        self._lock = _DirectoryLock(os.path.join(self._output_root,
+                                                 _LOCK_FILE))
 
     def _FindTimestamps(self):
         timestamps = []
@@ -72,6 +222,15 @@ class VersionnedGenerator(object):
     def _ManifestLocation(self, ts):
         return os.path.join(self._output_root, '%s.MANIFEST' % ts)
 
+    def _VersionExists(self, ts, reserved=()):
+        return (ts in reserved or
+                os.path.lexists(self._SiteLocation(ts)) or
+                os.path.lexists(self._ManifestLocation(ts)) or
+                os.path.lexists(self._ArchiveLocation(ts)))
+
+    def _ArchiveLocation(self, ts):
+        return os.path.join(self._output_root, '%s.zip' % ts)
+
     def _LinkLocation(self, link):
         return os.path.join(self._output_root, link)
 
@@ -98,32 +257,187 @@ class VersionnedGenerator(object):
         return True
 
     def _SetLink(self, link, ts):
-        link_path = self._LinkLocation(link)
-        if self._LinkExists(link):
-            os.remove(link_path)
+        # Validate whatever currently sits at the link location.
+        self._LinkExists(link)
 
-        os.symlink(ts, link_path)
-
-    def Generate(self, input_root, use_processors):
+        # Build the new link on the side and rename it over the old
+        # one, so that the link is never missing.
+        link_path = self._LinkLocation(link)
+        tmp_path = self._LinkLocation('.%s.tmp' % link)
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(ts, tmp_path)
+        os.rename(tmp_path, link_path)
+
+    def _SwitchCurrent(self, ts, previous_ts=None):
+        """Point the current link at ts, and update the deploy dir.
+
+        The deploy directory is updated around the link switch, so
+        that no deployed file is ever missing: links to new files are
+        added before it, and links to removed files are pruned after.
+        """
+        if not self._deploy_dir:
+            self._SetLink(_CURRENT_LINK, ts)
+            return
+
+        util.CreateDir(self._deploy_dir)
+        if previous_ts:
+            previous_manifest = self._ManifestLocation(previous_ts)
+        else:
+            previous_manifest = None
+
+        if self._link_deploy:
+            deploy.LinkDeploy(self._LinkLocation(_CURRENT_LINK),
+                              self._deploy_dir,
+                              self._ManifestLocation(ts),
+                              previous_manifest,
+                              tree_root=self._SiteLocation(ts),
+                              prune=False)
+            self._SetLink(_CURRENT_LINK, ts)
+            if previous_manifest:
+                deploy.LinkPrune(self._LinkLocation(_CURRENT_LINK),
+                                 self._deploy_dir,
+                                 self._ManifestLocation(ts),
+                                 previous_manifest)
+        else:
+            if previous_ts:
+                deploy.Undeploy(self._SiteLocation(previous_ts),
+                                self._deploy_dir,
+                                previous_manifest)
+            deploy.Deploy(self._SiteLocation(ts),
+                          self._deploy_dir,
+                          self._ManifestLocation(ts))
+            self._SetLink(_CURRENT_LINK, ts)
+
+    def _Generator(self, input_root, use_processors, template_archive,
+                   output_cache):
+        """Return a Generator, reused across calls with the same arguments.
+
+        Reusing generators keeps their caches warm, which helps long
+        lived users generating many versions.
+        """
+        import generator
+
+        key = (os.path.abspath(input_root), tuple(use_processors),
+               template_archive, output_cache)
+        if key not in self._generators:
+            self._generators[key] = generator.Generator(
+                input_root, use_processors, template_archive, output_cache)
+        return self._generators[key]
+
+    def Generate(self, input_root, use_processors, template_archive=None,
+                 output_cache=None):
         ts = time.localtime()
         ts_str = time.strftime('%Y%m%d-%H%M%S', ts)
-        out_dir = self._SiteLocation(ts_str)
-        manifest_file = self._ManifestLocation(ts_str)
-
-        generator.Generator(input_root, use_processors).Generate(
-            out_dir, timestamp=ts, manifest_path=manifest_file)
-
-        self._SetLink(_LATEST_LINK, ts_str)
-
-        if not self._LinkExists(_CURRENT_LINK):
-            self._SetLink(_CURRENT_LINK, ts_str)
-            if self._deploy_dir:
-                deploy.Deploy(out_dir, self._deploy_dir, manifest_file)
-            current = True
-        else:
-            current = False
 
-        return ts_str, out_dir, manifest_file, current
+        # Generate into a private staging directory, so that neither
+        # concurrent builds nor readers ever see a partial version.
+        # The version's name is reserved upfront, so that templates
+        # see where the version will end up rather than the staging
+        # directory.
+        staging_dir = self._MakeStagingDir()
+        staging_manifest = staging_dir + '.MANIFEST'
+        reservation = None
+        try:
+            self._lock.Acquire()
+            try:
+                self._RemoveAbandonedStaging()
+                ts_str, reservation = self._ReserveName(ts_str)
+            finally:
+                self._lock.Release()
+
+            gen = self._Generator(input_root, use_processors,
+                                  template_archive, output_cache)
+            gen.Generate(staging_dir, timestamp=ts,
+                         manifest_path=staging_manifest,
+                         public_root=self._SiteLocation(ts_str))
+
+            self._lock.Acquire()
+            try:
+                self._Publish(ts_str, staging_dir, staging_manifest)
+                current = self._UpdateLinks(ts_str)
+            finally:
+                self._lock.Release()
+        finally:
+            # Once published, the version itself holds its name.
+            if reservation:
+                os.remove(reservation)
+            if os.path.isdir(staging_dir):
+                shutil.rmtree(staging_dir)
+            if os.path.exists(staging_manifest):
+                os.remove(staging_manifest)
+
+        return (ts_str, self._SiteLocation(ts_str),
+                self._ManifestLocation(ts_str), current)
+
+    def _MakeStagingDir(self):
+        # Unlike tempfile.mkdtemp, os.mkdir honors the umask, which the
+        # published version should.
+        while True:
+            staging_dir = os.path.join(self._output_root, '.staging-%d-%d' % (
+                os.getpid(), self._staging_counter.next()))
+            try:
+                os.mkdir(staging_dir)
+                return staging_dir
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _ReserveName(self, ts_str):
+        """Reserve a version name after ts_str, for a build to publish.
+
+        The name is held by a reservation file named after the build's
+        process, which the build removes when it is done, and garbage
+        collection once the process is gone. Must be called with the
+        lock held.
+
+        Returns:
+          (the name of the new version, the path of its reservation)
+        """
+        reserved = set()
+        for filename in os.listdir(self._output_root):
+            match = _RESERVED_RE.match(filename)
+            if match:
+                reserved.add(match.group(1))
+
+        name = ts_str
+        for i in itertools.count(1):
+            if not self._VersionExists(name, reserved):
+                break
+            name = '%s.%03d' % (ts_str, i)
+        reservation = os.path.join(self._output_root, '.reserved-%d-%s' % (
+            os.getpid(), name))
+        util.WriteFileContent(reservation, '')
+        return name, reservation
+
+    def _Publish(self, name, staging_dir, staging_manifest):
+        """Move a staged build into place, under its reserved name.
+
+        Must be called with the lock held.
+        """
+        os.rename(staging_dir, self._SiteLocation(name))
+        # The manifest makes the version visible, so it goes last.
+        os.rename(staging_manifest, self._ManifestLocation(name))
+        _PUBLISHED.Inc()
+
+    def _UpdateLinks(self, ts_str):
+        """Point the links at a newly published version, as needed.
+
+        Must be called with the lock held.
+
+        Returns:
+          True if the version was made current.
+        """
+        # A build that started earlier may finish later, latest must
+        # not go backwards.
+        latest = self._LinkTimestamp(_LATEST_LINK)
+        if latest is None or ts_str > latest:
+            self._SetLink(_LATEST_LINK, ts_str)
+
+        if self._LinkExists(_CURRENT_LINK):
+            return False
+        self._SwitchCurrent(ts_str)
+        return True
 
     def Versions(self):
         ts = self._FindTimestamps()
@@ -131,6 +445,13 @@ class VersionnedGenerator(object):
         return ts, current
 
     def ChangeCurrent(self, version=0):
+        self._lock.Acquire()
+        try:
+            return self._ChangeCurrent(version)
+        finally:
+            self._lock.Release()
+
+    def _ChangeCurrent(self, version):
         ts = self._FindTimestamps()
         if not ts:
             raise NoVersionsError()
@@ -145,19 +466,37 @@ class VersionnedGenerator(object):
             return current
 
         # (re)point the symlink
-        if self._deploy_dir:
-            deploy.Undeploy(self._SiteLocation(current),
-                            self._deploy_dir,
-                            self._ManifestLocation(current))
-        self._SetLink(_CURRENT_LINK, ts[version])
-        if self._deploy_dir:
-            deploy.Deploy(self._SiteLocation(ts[version]),
-                          self._deploy_dir,
-                          self._ManifestLocation(ts[version]))
+        self._Expand(ts[version])
+        self._SwitchCurrent(ts[version], current)
+        _SWITCHES.Inc()
 
         return ts[version]
 
     def GarbageCollect(self):
+        self._lock.Acquire()
+        try:
+            self._RemoveAbandonedStaging()
+            return self._GarbageCollect()
+        finally:
+            self._lock.Release()
+
+    def _RemoveAbandonedStaging(self):
+        """Remove the leftovers of builds whose process is gone.
+
+        These are staging directories and manifests, and name
+        reservations.
+        """
+        for filename in os.listdir(self._output_root):
+            match = _STAGING_RE.match(filename)
+            if not match or _ProcessExists(int(match.group(1))):
+                continue
+            path = os.path.join(self._output_root, filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def _GarbageCollect(self):
         ts = self._FindTimestamps()
         current = self._LinkTimestamp(_CURRENT_LINK)
 
@@ -166,8 +505,63 @@ class VersionnedGenerator(object):
             return []
 
         to_gc = ts[ts.index(current)+1:]
+        reclaimed = 0
         for version in to_gc:
-            os.remove(os.path.join(self._output_root, '%s.MANIFEST' % version))
-            shutil.rmtree(os.path.join(self._output_root, version))
-
+            manifest = self._ManifestLocation(version)
+            reclaimed += os.path.getsize(manifest)
+            os.remove(manifest)
+            if os.path.isdir(self._SiteLocation(version)):
+                reclaimed += _TreeSize(self._SiteLocation(version))
+                shutil.rmtree(self._SiteLocation(version))
+            if os.path.exists(self._ArchiveLocation(version)):
+                reclaimed += os.path.getsize(self._ArchiveLocation(version))
+                os.remove(self._ArchiveLocation(version))
+
+        _GC_VERSIONS.Inc(len(to_gc))
+        _GC_BYTES.Inc(reclaimed)
         return to_gc
+
+    def IsPacked(self, ts):
+        """Return whether a version is only available as an archive."""
+        return (not os.path.isdir(self._SiteLocation(ts)) and
+                os.path.isfile(self._ArchiveLocation(ts)))
+
+    def PackVersions(self, keep=PACK_KEEP):
+        """Pack all but the most recent versions into archives.
+
+        The current and latest versions are never packed, since the
+        links point into them.
+
+        Args:
+          keep: the number of most recent versions to leave expanded.
+
+        Returns:
+          The list of versions that were packed.
+        """
+        self._lock.Acquire()
+        try:
+            return self._PackVersions(keep)
+        finally:
+            self._lock.Release()
+
+    def _PackVersions(self, keep):
+        ts = self._FindTimestamps()
+        linked = (self._LinkTimestamp(_CURRENT_LINK),
+                  self._LinkTimestamp(_LATEST_LINK))
+
+        packed = []
+        for version in ts[keep:]:
+            if version in linked or self.IsPacked(version):
+                continue
+            _PackTree(self._SiteLocation(version),
+                      self._ArchiveLocation(version))
+            shutil.rmtree(self._SiteLocation(version))
+            packed.append(version)
+        _PACKED.Inc(len(packed))
+        return packed
+
+    def _Expand(self, ts):
+        if not self.IsPacked(ts):
+            return
+        _UnpackTree(self._ArchiveLocation(ts), self._SiteLocation(ts))
+        os.remove(self._ArchiveLocation(ts))
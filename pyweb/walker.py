@@ -0,0 +1,208 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Input tree walking, with gitignore-style exclusion rules.
+
+The walker lists each directory once, reusing the stat information
+gathered while listing, and never descends into excluded directories.
+
+Exclusion rules come from a set of builtin patterns and from the
+.pywebignore file at the root of the input tree, which uses the
+gitignore syntax:
+
+  - blank lines and lines starting with '#' are ignored,
+  - a trailing '/' only matches directories,
+  - a pattern containing a '/' elsewhere is anchored to the input
+    root, otherwise it matches at any depth,
+  - '*', '?' and '[...]' match within a path component, and '**'
+    matches any number of directories,
+  - a leading '!' re-includes paths excluded by an earlier pattern.
+
+All patterns are compiled into a single regular expression.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import re
+import stat
+
+import util
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+IGNORE_FILE = '.pywebignore'
+
+# Hidden and underscore directories are build-only, and underscore
+# files, editor temporaries and lock files are never published.
+BUILTIN_RULES = [
+    '.*/',
+    '_*/',
+    '_*',
+    '.#*',
+    '*~',
+    IGNORE_FILE,
+]
+
+
+class _DirEntry(object):
+    """Minimal stand-in for os.DirEntry, when scandir is unavailable."""
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+
+def _ScanDir(path):
+    if _scandir is not None:
+        return list(_scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def _GlobToRegex(glob):
+    """Translate a gitignore glob to a regular expression string."""
+    bits = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            bits.append('(?:.*/)?')
+            i += 3
+        elif glob.startswith('**', i):
+            bits.append('.*')
+            i += 2
+        elif glob[i] == '*':
+            bits.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            bits.append('[^/]')
+            i += 1
+        elif glob[i] == '[' and ']' in glob[i+2:]:
+            end = glob.index(']', i + 2)
+            cls = glob[i+1:end]
+            if cls.startswith('!'):
+                cls = '^' + cls[1:]
+            bits.append('[%s]' % cls)
+            i = end + 1
+        else:
+            bits.append(re.escape(glob[i]))
+            i += 1
+    return ''.join(bits)
+
+
+class IgnoreRules(object):
+    """A compiled set of gitignore-style exclusion patterns."""
+    def __init__(self, patterns):
+        # Later patterns take precedence, so they come first in the
+        # alternation, and the first group that matched wins.
+        self._negated = []
+        dir_alternatives = []
+        file_alternatives = []
+        for pattern in reversed(patterns):
+            pattern = pattern.rstrip('\n\r')
+            if not pattern.strip() or pattern.startswith('#'):
+                continue
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if '/' in pattern:
+                regex = _GlobToRegex(pattern.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + _GlobToRegex(pattern)
+
+            group = 'r%d' % len(self._negated)
+            self._negated.append(negated)
+            alternative = '(?P<%s>%s)' % (group, regex)
+            dir_alternatives.append(alternative)
+            if not dir_only:
+                file_alternatives.append(alternative)
+
+        self._dir_re = self._Compile(dir_alternatives)
+        self._file_re = self._Compile(file_alternatives)
+
+    def _Compile(self, alternatives):
+        if not alternatives:
+            return None
+        return re.compile('^(?:%s)$' % '|'.join(alternatives))
+
+    def IsIgnored(self, rel_path, is_dir=False):
+        """Return True if the path, relative to the root, is excluded."""
+        regex = is_dir and self._dir_re or self._file_re
+        if regex is None:
+            return False
+        match = regex.match(rel_path)
+        if not match:
+            return False
+        return not self._negated[int(match.lastgroup[1:])]
+
+
+def LoadIgnoreRules(input_root, builtin_rules=BUILTIN_RULES):
+    """Load the exclusion rules for an input tree.
+
+    Args:
+      input_root: the root of the input tree.
+      builtin_rules: the patterns to apply before those of the
+                     tree's .pywebignore file.
+    """
+    patterns = list(builtin_rules)
+    ignore_file = os.path.join(input_root, IGNORE_FILE)
+    if os.path.isfile(ignore_file):
+        patterns.extend(util.ReadFileContent(ignore_file).splitlines())
+    return IgnoreRules(patterns)
+
+
+def Walk(root, rules):
+    """Walk a tree top-down, skipping excluded paths.
+
+    Yields:
+      (directory path, list of DirEntry for the files it contains)
+      for each directory, in sorted order, parents before children.
+    """
+    root = os.path.abspath(root)
+    pending = [root]
+    while pending:
+        dir_path = pending.pop()
+        rel_dir = util.PathAsSuffix(dir_path, root)
+        if rel_dir:
+            rel_dir += '/'
+
+        files = []
+        subdirs = []
+        for entry in sorted(_ScanDir(dir_path), key=lambda e: e.name):
+            is_dir = entry.is_dir()
+            if rules.IsIgnored(rel_dir + entry.name, is_dir):
+                continue
+            if not is_dir:
+                files.append(entry)
+            elif not entry.is_symlink():
+                # Like os.walk, don't follow symlinks to directories.
+                subdirs.append(entry.path)
+
+        yield dir_path, files
+
+        pending.extend(reversed(subdirs))
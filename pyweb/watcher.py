@@ -0,0 +1,114 @@
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Continuous regeneration of a website as its input tree changes.
+
+The watcher keeps a single Generator alive, so that processors and
+their caches stay warm, and polls the input tree for changes. Bursts
+of changes are batched: regeneration only starts once the tree has
+been stable for the debounce window. Each regeneration is incremental,
+so only the inputs affected by the changes are processed again.
+"""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import sys
+import time
+import traceback
+
+import deps
+import walker
+
+
+POLL_INTERVAL = 0.5
+DEBOUNCE_WINDOW = 0.3
+
+
+def Snapshot(root):
+    """Return a dict mapping every watched file under root to its stamp."""
+    # Underscore directories and files are not published, but are
+    # used while generating, so they must be watched too.
+    rules = walker.LoadIgnoreRules(root, ['.*/'])
+    snapshot = {}
+    for input_dir, files in walker.Walk(root, rules):
+        for entry in files:
+            snapshot[entry.path] = deps.Stamp(entry.path, entry.stat())
+    return snapshot
+
+
+def _CountChanges(old, new):
+    changed = set(old.keys()) ^ set(new.keys())
+    changed.update(p for p in new if p in old and old[p] != new[p])
+    return len(changed)
+
+
+def WaitForChanges(input_root, snapshot, poll_interval=POLL_INTERVAL,
+                   debounce=DEBOUNCE_WINDOW):
+    """Wait until the files under input_root differ from snapshot.
+
+    Returns:
+      The new snapshot of input_root, taken once the burst of changes
+      has settled.
+    """
+    while True:
+        time.sleep(poll_interval)
+        current = Snapshot(input_root)
+        if current != snapshot:
+            break
+
+    # Wait for the burst of changes to settle.
+    while True:
+        time.sleep(debounce)
+        settled = Snapshot(input_root)
+        if settled == current:
+            return current
+        current = settled
+
+
+def _Rebuild(gen, output_root, manifest_path, out):
+    start = time.time()
+    try:
+        processed = gen.Generate(output_root, manifest_path=manifest_path,
+                                 incremental=True)
+    except Exception:
+        traceback.print_exc(file=out)
+        out.write('Regeneration failed after %.3fs.\n' % (time.time() - start))
+    else:
+        written, unchanged = gen.WriteCounts()
+        out.write('Regenerated %d files in %.3fs '
+                  '(%d written, %d unchanged).\n' %
+                  (processed, time.time() - start, written, unchanged))
+    out.flush()
+
+
+def Watch(gen, input_root, output_root, manifest_path=None,
+          poll_interval=POLL_INTERVAL, debounce=DEBOUNCE_WINDOW,
+          out=sys.stdout):
+    """Regenerate input_root into output_root whenever it changes.
+
+    Never returns, interrupt with KeyboardInterrupt.
+
+    Args:
+      gen: the Generator for input_root.
+      input_root: the input tree to watch.
+      output_root: the output root to regenerate.
+      manifest_path: if set, the manifest to write on each generation.
+      poll_interval: seconds between checks of the input tree.
+      debounce: seconds the input tree must remain unchanged before
+                regeneration starts.
+      out: the stream to report regenerations on.
+    """
+    input_root = os.path.abspath(input_root)
+    snapshot = Snapshot(input_root)
+    _Rebuild(gen, output_root, manifest_path, out)
+
+    while True:
+        current = WaitForChanges(input_root, snapshot, poll_interval,
+                                 debounce)
+        out.write('%d changed files.\n' % _CountChanges(snapshot, current))
+        snapshot = current
+        _Rebuild(gen, output_root, manifest_path, out)
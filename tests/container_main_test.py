@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Tests for the pwg container script."""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyweb import builddaemon
+from pyweb import container
+from pyweb import container_main
+from pyweb import devserver
+from pyweb import outputcache
+
+
+class ContainerMainTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix='pywebgen-test-')
+        self._saved = (sys.argv, sys.stdout, os.environ.get(
+            outputcache.CACHE_DIR_ENV), devserver.RunDevServer,
+                       builddaemon.Serve)
+        os.environ.pop(outputcache.CACHE_DIR_ENV, None)
+        sys.stdout = StringIO.StringIO()
+        self._site = os.path.join(self._root, 'site')
+        container.Container.Create(self._site)
+
+        # The servers would run forever.
+        def RunDevServer(address, in_dir, out_dir):
+            pass
+        def Serve(env, socket_path):
+            raise KeyboardInterrupt()
+        devserver.RunDevServer = RunDevServer
+        builddaemon.Serve = Serve
+
+    def tearDown(self):
+        (sys.argv, sys.stdout, cache_dir, devserver.RunDevServer,
+         builddaemon.Serve) = self._saved
+        if cache_dir is not None:
+            os.environ[outputcache.CACHE_DIR_ENV] = cache_dir
+        shutil.rmtree(self._root)
+
+    def _Main(self, *args):
+        sys.argv = [os.path.join(self._site, 'pwg')] + list(args)
+        return container_main.main()
+
+    def testEveryCommandRuns(self):
+        commands = [
+            ['generate'],
+            ['versions'],
+            ['setcurrent', 'latest'],
+            ['gc'],
+            ['compile-templates'],
+            ['devel'],
+            ['serve-builds'],
+            ]
+        self.assertEqual(sorted(c[0] for c in commands),
+                         sorted(container_main._COMMANDS))
+        for command in commands:
+            self.assertEqual(self._Main(*command), 0, command)
+
+    def testUnknownCommand(self):
+        self.assertEqual(self._Main('frobnicate'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
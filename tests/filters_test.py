@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Tests for the pipeline filters."""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyweb import deps
+from pyweb import filters
+from pyweb import processors
+from pyweb import util
+
+
+class MinifyCssFilterTest(unittest.TestCase):
+    def _Minify(self, css):
+        return ''.join(filters.MinifyCssFilter().FilterChunks([css]))
+
+    def testMinify(self):
+        self.assertEqual(self._Minify('a  b ,\n c {\n  color: red ;\n}\n'
+                                      '/* comment */ d > e { x: y; }'),
+                         'a b,c{color:red}d>e{x:y}')
+
+    def testStringsAreKept(self):
+        self.assertEqual(
+            self._Minify('a { content: "x  /* y */ ;}" ; }\n'
+                         'b { font-family: \'A  B\', serif; }'),
+            'a{content:"x  /* y */ ;}"}b{font-family:\'A  B\',serif}')
+
+
+class InlineAssetsFilterTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix='pywebgen-test-')
+        self._page = os.path.join(self._root, 'index.html')
+        self._deps = deps.DependencyGraph()
+        self._filter = filters.InlineAssetsFilter()
+        self._filter.StartProcessing({
+            'input_root': self._root,
+            'dependencies': self._deps,
+            'processors': processors.GetProcessors(['CssYaml']),
+            })
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _Filter(self, html):
+        self._deps.Begin(self._page)
+        try:
+            return ''.join(self._filter.FilterFile([html], self._page))
+        finally:
+            self._deps.End()
+
+    def testMissingAssetsAreDependencies(self):
+        html = '<script src="/app.js"></script>'
+        self.assertEqual(self._Filter(html), html)
+        self.assertEqual(self._deps.Dependencies(self._page),
+                         set([os.path.join(self._root, 'app.js')]))
+
+    def testExternalAssetsAreLeftAlone(self):
+        html = '<script src="http://example.com/app.js"></script>'
+        self.assertEqual(self._Filter(html), html)
+        self.assertEqual(self._deps.Dependencies(self._page), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Tests for the processor output cache."""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyweb import generator
+from pyweb import outputcache
+from pyweb import processors
+from pyweb import util
+
+
+class OutputCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix='pywebgen-test-')
+        self._input = os.path.join(self._root, 'input')
+        util.CreateDir(self._input)
+        util.WriteFileContent(os.path.join(self._input, '_base.html'),
+                              '{% block body %}{% endblock %}'
+                              ' at {{timestamp}}')
+        util.WriteFileContent(os.path.join(self._input, 'stamped.html'),
+                              '{% extends "_base.html" %}'
+                              '{% block body %}{{output_root}}{% endblock %}')
+        util.WriteFileContent(os.path.join(self._input, 'plain.html'),
+                              'Hello')
+        self._cache = outputcache.OutputCache(
+            os.path.join(self._root, 'cache'))
+        self._gen = generator.Generator(self._input,
+                                        processors.DEFAULT_PROCESSORS,
+                                        output_cache=self._cache)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _Generate(self, name, timestamp):
+        output = os.path.join(self._root, name)
+        util.CreateDir(output)
+        self._gen.Generate(output, time.localtime(timestamp))
+        return output
+
+    def _Read(self, output, name):
+        return util.ReadFileContent(os.path.join(output, name))
+
+    def testRendersContextValuesAgain(self):
+        first = self._Generate('first', 0)
+        second = self._Generate('second', 86400)
+
+        for output, timestamp in ((first, 0), (second, 86400)):
+            self.assertEqual(self._Read(output, 'stamped.html'),
+                             '%s at %s' % (output, time.asctime(
+                                 time.localtime(timestamp))))
+        self.assertEqual(self._Read(second, 'plain.html'), 'Hello')
+        # Only the page not using the context comes from the cache.
+        self.assertEqual(self._cache.Stats()['hits'], 1)
+
+    def testReusesUnchangedContextValues(self):
+        output = self._Generate('output', 0)
+        self._Generate('output', 0)
+
+        self.assertEqual(self._Read(output, 'stamped.html'),
+                         '%s at %s' % (output, time.asctime(
+                             time.localtime(0))))
+        self.assertEqual(self._cache.Stats()['hits'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
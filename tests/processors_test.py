@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Tests for the input processors."""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyweb import generator
+from pyweb import util
+
+
+class HtmlJinjaProcessorTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix='pywebgen-test-')
+        self._input = os.path.join(self._root, 'input')
+        self._output = os.path.join(self._root, 'output')
+        util.CreateDir(self._input)
+        util.CreateDir(self._output)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _Render(self, template, use_processors=('HtmlJinja',)):
+        util.WriteFileContent(os.path.join(self._input, 'index.html'),
+                              template)
+        gen = generator.Generator(self._input, list(use_processors))
+        gen.Generate(self._output)
+        return util.ReadFileContent(os.path.join(self._output, 'index.html'))
+
+    def testTemplateContext(self):
+        names = ('timestamp', 'input_root', 'output_root', 'data', 'srcset',
+                 'bundle', 'dependencies', 'output', 'processors',
+                 'template_archive')
+        template = ' '.join('{{ %s is defined }}' % name for name in names)
+        self.assertEqual(
+            self._Render(template, ('HtmlJinja', 'Image', 'Bundle')),
+            ' '.join(['True'] * 6 + ['False'] * 4))
+
+    def testHelpersOnlyWithTheirProcessors(self):
+        self.assertEqual(self._Render('{{ srcset is defined }}'), 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
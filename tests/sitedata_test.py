@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Tests for the site data exposed to templates."""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyweb import deps
+from pyweb import sitedata
+from pyweb import util
+
+
+class SiteDataTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix='pywebgen-test-')
+        self._data_dir = os.path.join(self._root, sitedata.DATA_DIR)
+        util.CreateDir(self._data_dir)
+        util.WriteFileContent(os.path.join(self._data_dir, 'nav.json'),
+                              '["home"]')
+        self._deps = deps.DependencyGraph()
+        self._page = os.path.join(self._root, 'index.html')
+        self._deps.Begin(self._page)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _Load(self):
+        return sitedata.DataLoader().Load(self._root, self._deps)
+
+    def testGetItem(self):
+        self.assertEqual(self._Load()['nav'], ['home'])
+        self.assertEqual(self._deps.Dependencies(self._page),
+                         set([os.path.join(self._data_dir, 'nav.json')]))
+
+    def testListingDependsOnTheDirectory(self):
+        for List in (lambda d: d.keys(), list, len):
+            self._deps.Begin(self._page)
+            List(self._Load())
+            self.assertEqual(self._deps.Dependencies(self._page),
+                             set([self._data_dir]))
+
+    def testCollidingNames(self):
+        util.WriteFileContent(os.path.join(self._data_dir, 'nav.yaml'),
+                              '[home]')
+        self.assertRaises(sitedata.DataFileError, self._Load)
+
+    def testCollidingDirectory(self):
+        util.CreateDir(os.path.join(self._data_dir, 'nav'))
+        self.assertRaises(sitedata.DataFileError, self._Load)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 David Anderson
+#
+# Redistribution of this file is permitted under
+# the terms of the GNU Public License (GPL) version 2.
+
+"""Tests for the versionned website generator."""
+
+__author__ = 'David Anderson <dave@natulte.net>'
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyweb import deploy
+from pyweb import generator
+from pyweb import processors
+from pyweb import util
+from pyweb import versions
+
+
+class VersionnedGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix='pywebgen-test-')
+        self._input = os.path.join(self._root, 'input')
+        util.CreateDir(self._input)
+        util.WriteFileContent(os.path.join(self._input, 'index.html'),
+                              '{{output_root}}')
+        self._versions = os.path.join(self._root, 'versions')
+        self._gen = versions.VersionnedGenerator(self._versions)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _Leftovers(self):
+        return sorted(f for f in os.listdir(self._versions)
+                      if f.startswith('.') and f != '.lock')
+
+    def testGenerate(self):
+        ts, site, manifest, current = self._gen.Generate(
+            self._input, processors.DEFAULT_PROCESSORS)
+        self.assertTrue(current)
+        self.assertEqual(util.ReadFileContent(
+            os.path.join(site, 'index.html')), site)
+        self.assertEqual(self._gen.Versions(), ([ts], ts))
+        self.assertEqual(self._Leftovers(), [])
+
+    def testFailedGenerationLeavesNothing(self):
+        shutil.rmtree(self._input)
+        self.assertRaises(generator.MissingInputDirectory,
+                          self._gen.Generate, self._input,
+                          processors.DEFAULT_PROCESSORS)
+        self.assertEqual(os.listdir(self._versions), ['.lock'])
+
+    def testAbandonedReservationsAreRemoved(self):
+        # A build killed after reserving its name leaves these behind.
+        process = subprocess.Popen(['true'])
+        process.wait()
+        util.CreateDir(os.path.join(self._versions, '.staging-%d-0' %
+                                    process.pid))
+        util.WriteFileContent(os.path.join(
+            self._versions, '.reserved-%d-20080101-000000' % process.pid), '')
+
+        ts, _, _, _ = self._gen.Generate(self._input,
+                                         processors.DEFAULT_PROCESSORS)
+        self.assertNotEqual(ts, '20080101-000000')
+        self.assertEqual(self._gen.Versions(), ([ts], ts))
+        self.assertEqual(self._Leftovers(), [])
+
+    def testReservedNamesAreSkipped(self):
+        reserved = os.path.join(self._versions, '.reserved-%d-%s' % (
+            os.getpid(), '20080101-000000'))
+        util.WriteFileContent(reserved, '')
+
+        self._gen._lock.Acquire()
+        try:
+            name, reservation = self._gen._ReserveName('20080101-000000')
+        finally:
+            self._gen._lock.Release()
+        self.assertEqual(name, '20080101-000000.001')
+        self.assertEqual(self._Leftovers(), sorted(
+            [os.path.basename(reserved), os.path.basename(reservation)]))
+
+    def testDeployModeIsKept(self):
+        deploy_dir = os.path.join(self._root, 'deploy')
+        gen = versions.VersionnedGenerator(self._versions, deploy_dir,
+                                           link_deploy=True)
+        _, site, manifest, _ = gen.Generate(self._input,
+                                            processors.DEFAULT_PROCESSORS)
+        # Nothing but the website is served.
+        self.assertEqual(os.listdir(deploy_dir), ['index.html'])
+        self.assertTrue(os.path.islink(os.path.join(deploy_dir,
+                                                    'index.html')))
+
+        self.assertRaises(deploy.DeployModeError, deploy.Deploy,
+                          site, deploy_dir, manifest)
+        self.assertRaises(deploy.DeployModeError, deploy.Undeploy,
+                          site, deploy_dir, manifest)
+        deploy.LinkUndeploy(os.path.join(self._versions, 'current'),
+                            deploy_dir, manifest)
+        self.assertEqual(os.listdir(deploy_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()